@@ -1,14 +1,21 @@
 #!.venv/bin/python
 from flask import Flask
-from utils import ReverseProxied, r
-from models import db, User, Application, Book, Account, Category, Tag, Tally, UserBook, UserConfigure, BookConfigure
+from werkzeug.middleware.proxy_fix import ProxyFix
+from utils import ReverseProxied, Timing, r, Benchmark, FastJSONProvider, compress
+from models import db, Authorize, User, Application, Book, Account, Category, Tag, Tally, UserBook, UserConfigure, BookConfigure, TallyRollup, AccountBalance, TallyTerm, Seeder, Metrics, Sync, LoadShedder, Job, Replicas, BOOK_DELETED
 import config
 
 
 app = Flask(__name__)
 app.wsgi_app = ReverseProxied(app.wsgi_app)
 app.config.from_object(config)
+if app.config.get('PROXY_FIX_X_FOR'):
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])  # 只采信这几层可信代理追加的X-Forwarded-For
+app.json = FastJSONProvider(app)
+app.after_request(compress)
 db.init_app(app)
+metrics = Metrics(app)
+app.wsgi_app = Timing(app.wsgi_app, metrics)
 
 
 from v1.views import v1
@@ -20,11 +27,39 @@ from werkzeug.exceptions import HTTPException
 @app.errorhandler(HTTPException)
 def error_handler(e):
     if isinstance(e, HTTPException):
-        return r(e.code, e.description)
+        res = r(e.code, e.description)
+        res.headers.extend((k, v) for k, v in e.get_headers() if k != 'Content-Type')  # 如429、503的Retry-After
+        return res
     return r(500, str(e))
 
 
-from flask import session
+from flask import session, request
+@app.before_request
+def request_endpoint():
+    if 'request_stats' in request.environ:
+        request.environ['request_stats'].endpoint = request.endpoint
+
+@app.before_request
+def load_shedding():
+    if request.endpoint != 'prometheus_metrics':
+        LoadShedder.before_request()
+
+app.teardown_request(LoadShedder.teardown_request)
+
+@app.before_request
+def start_job_threads():
+    Job.start_threads()  # 每个worker进程收到第一个请求时启动，重启后队列中的任务不必等下一次入队
+
+@app.route('/metrics')
+def prometheus_metrics():
+    return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/debug/profiles')
+def debug_profiles():
+    if not app.debug:
+        return r(404, 'Not Found')
+    return r(data=list(reversed(metrics.profiler.recent)))
+
 @app.route('/')
 def index():
     return r(msg='Welcome!', data={'token': session.get('token')})
@@ -35,9 +70,11 @@ def login():
     return r(msg='Login Successful!')
 
 # flask initdb --drop
+from datetime import datetime
 import click
 import time
 import random
+import requests
 @app.cli.command()
 @click.option('--drop', is_flag=True, help='Create after drop.')
 def initdb(drop):
@@ -60,8 +97,8 @@ def initdb(drop):
 
     # add apps
     apps = [Application()._set({'app_id': i[0], 'app_name': i[1], 'secret_key': i[2], 'expirydate': i[3]}) for i in (
-        ('wx65c7fff6a12a1e2b','微信小程序','c0506c6421e192a6418fa0bf7e0e65a7', '2023-12-31 23:59:59'),
-        ('wb9705eb7ac2c98403','Web页','2567a5ec9705eb7ac2c984033e06189d', '2023-12-31 23:59:59'),
+        ('wx65c7fff6a12a1e2b','微信小程序','c0506c6421e192a6418fa0bf7e0e65a7', datetime(2099, 12, 31, 23, 59, 59)),
+        ('wb9705eb7ac2c98403','Web页','2567a5ec9705eb7ac2c984033e06189d', datetime(2099, 12, 31, 23, 59, 59)),
     )]
 
     # add accounts
@@ -130,5 +167,309 @@ def initdb(drop):
     db.session.commit()
 
 
+# flask replica-init
+@app.cli.command('replica-init')
+def replica_init():
+    '''把SQLite主库复制到本地SQLite读库(READ_REPLICAS)，再检查各读库是否可用'''
+    for key in app.config.get('READ_REPLICAS') or ():
+        try:
+            done = Replicas.init(key)
+        except Exception as e:
+            done = 'failed (%s)' % e
+        click.echo('%s: %s, %s' % (key, done, 'healthy' if Replicas.check(key) else 'unavailable'))
+
+
+# flask rollup --book-id 1
+@app.cli.command()
+@click.option('--book-id', type=int, multiple=True, help='重建的账本，默认全部账本')
+@click.option('--queue', is_flag=True, help='交给后台任务执行，不在本进程执行')
+def rollup(book_id, queue):
+    '''按记账记录重建汇总表'''
+    if queue:
+        click.echo('Queued job %s.' % Job.enqueue('rebuild_rollups', book_ids=list(book_id))['id'])
+        return
+    total = TallyRollup.rebuild(book_id)
+    click.echo('Rebuilt %d rollup rows.' % total)
+
+
+# flask search-index --book-id 1
+@app.cli.command('search-index')
+@click.option('--book-id', type=int, multiple=True, help='重建的账本，默认全部账本')
+def search_index(book_id):
+    '''按记账记录、分类及标签重建搜索索引'''
+    total = TallyTerm.rebuild(book_id)
+    click.echo('Indexed %d terms.' % total)
+
+
+# flask balances --fix
+@app.cli.command()
+@click.option('--account-id', type=int, multiple=True, help='检查的资金账户，默认全部账户')
+@click.option('--fix', is_flag=True, help='修正有偏差的余额')
+def balances(account_id, fix):
+    '''按记账记录重新计算资金账户余额，列出有偏差的账户'''
+    drift = AccountBalance.reconcile(list(account_id), fix)
+    for i in drift:
+        click.echo('account %(accountId)d: balance %(balance)s, expected %(expected)s; count %(count)d, expected %(expectedCount)d' % i)
+    click.echo('%s %d drifted accounts.' % ('Fixed' if fix else 'Found', len(drift)))
+
+
+# flask worker --threads 4
+@app.cli.command()
+@click.option('--threads', type=int, default=1, help='同时执行的任务数')
+def worker(threads):
+    '''执行队列中的后台任务，直到被中断'''
+    from threading import Thread
+    def target():
+        with app.app_context():
+            Job.work()
+    pool = [Thread(target=target, daemon=True) for _ in range(threads - 1)]
+    for i in pool:
+        i.start()
+    click.echo('Worker started with %d threads.' % threads)
+    Job.work()
+
+
+# flask purge-books
+@app.cli.command('purge-books')
+def purge_books():
+    '''为遗留的已删除账本(如worker崩溃后)重新提交清理任务'''
+    ids = db.session.scalars(db.select(Book.id).where(Book.state == BOOK_DELETED)).all()
+    for i in ids:
+        Job.enqueue('purge_book', book_id=i)
+    click.echo('Queued %d books.' % len(ids))
+
+
+
+# flask sync-prune --days 90
+@app.cli.command('sync-prune')
+@click.option('--days', type=int, help='保留最近N天的变更日志，默认SYNC_RETENTION_DAYS')
+def sync_prune(days):
+    '''清理过期的变更日志'''
+    total = Sync.prune(days or app.config.get('SYNC_RETENTION_DAYS', 90))
+    db.session.commit()
+    click.echo('Pruned %d changes.' % total)
+
+
+# flask seed --users 100 --tallies-per-book 10000
+@app.cli.command()
+@click.option('--users', type=int, default=10, help='用户数')
+@click.option('--books-per-user', type=int, default=2, help='每个用户的账本数')
+@click.option('--tallies-per-book', type=int, default=1000, help='每个账本的记账记录数')
+@click.option('--days', type=int, default=365, help='记录时间分布在最近N天内')
+@click.option('--seed', type=int, help='随机种子，种子相同生成的数据相同')
+def seed(users, books_per_user, tallies_per_book, days, seed):
+    '''生成压测用的用户、账本及记账记录'''
+    db.create_all()
+    result = Seeder(seed, app.config.get('IMPORT_BATCH_SIZE', 1000), days).run(users, books_per_user, tallies_per_book, echo=click.echo)
+    click.echo('Seeded %(users)d users, %(books)d books, %(tallies)d tallies, %(rollups)d rollup rows in %(seconds)ss.' % result)
+
+
+# flask bench --requests 500 --out bench.json --compare last.json
+@app.cli.command()
+@click.option('--requests', 'count', type=int, default=200, help='每个场景的请求数')
+@click.option('--concurrency', type=int, default=1, help='并发的客户端数')
+@click.option('--url', help='压测运行中的服务器(如gunicorn)，例如http://127.0.0.1:8000，默认用测试客户端')
+@click.option('--user-id', type=int, help='登录的用户，默认最后生成的用户')
+@click.option('--password', default='123456', help='用户密码')
+@click.option('--out', type=click.Path(dir_okay=False), help='结果保存到JSON文件')
+@click.option('--compare', type=click.File(encoding='utf-8'), help='与之前保存的JSON文件对比')
+@click.option('--accept-encoding', help='发送Accept-Encoding(如gzip、br)，压测压缩后的响应')
+@click.option('--rate-limit', is_flag=True, help='压测应用也限流，默认豁免')
+def bench(count, concurrency, url, user_id, password, out, compare, accept_encoding, rate_limit):
+    '''压测登录及常用的读接口，输出各场景的延迟、吞吐量及SQL数'''
+    import json
+    import re
+    from sqlalchemy import event, func
+    query = User.query.filter(User.password == Authorize.hash_password(password), User.mobile.isnot(None))
+    user: User = query.filter(User.id == user_id).first() if user_id else query.order_by(User.id.desc()).first()
+    application: Application = Application.query.filter(Application.expirydate > datetime.now()).order_by(Application.id).first()
+    if not user or not application:
+        raise click.ClickException('No user with that password or no unexpired application, run `flask seed` first.')
+    book_id = (user.configure.current_book_id if user.configure else 0) or db.session.query(UserBook.book_id).filter_by(user_id=user.id).scalar()
+    meta = {
+        'database': db.engine.dialect.name,
+        'target': url or 'test_client',
+        'user_id': user.id,
+        'book_id': book_id,
+        'tallies': db.session.query(func.count(Tally.id)).filter(Tally.book_id == book_id).scalar(),
+        'accept_encoding': accept_encoding,
+        'rate_limit': rate_limit,
+    }
+    exempt = application.app_id in app.config.get('RATE_LIMIT_EXEMPT_APPS', ())
+
+    counter = [0]
+    if url:
+        if app.config.get('RATE_LIMITS') and not exempt and not rate_limit:
+            click.echo('Warning: add %r to RATE_LIMIT_EXEMPT_APPS on the server, or most requests will get 429.' % application.app_id)
+        session = requests.Session()
+        def request(method, path, headers, json):
+            res = session.request(method, url.rstrip('/') + path, headers=headers, json=json, timeout=30)
+            sql = re.search(r'sql;desc="(\d+)"', res.headers.get('Server-Timing', ''))
+            counter[0] += int(sql.group(1)) if sql else 0
+            return res.status_code
+    else:
+        if not exempt and not rate_limit:
+            app.config['RATE_LIMIT_EXEMPT_APPS'] = (*app.config.get('RATE_LIMIT_EXEMPT_APPS', ()), application.app_id)
+        client = app.test_client()
+        def request(method, path, headers, json):
+            return client.open(path, method=method, headers=headers, json=json, buffered=True).status_code
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count_query(*args):
+            counter[0] += 1
+    db.session.remove()
+
+    login = {'mobile': user.mobile, 'password': password}
+    headers = {'appid': application.app_id, **({'Accept-Encoding': accept_encoding} if accept_encoding else {})}
+    token = client.post('/v1/authorize/login', json=login, headers=headers).json if not url else session.post(url.rstrip('/') + '/v1/authorize/login', json=login, headers=headers).json()
+    auth = {**headers, 'Authorization': 'Bearer %s' % (token.get('data') or {}).get('token')}
+    benchmark = Benchmark(request, lambda: counter[0], concurrency)
+    for name, method, path, headers, body in (
+        ('login', 'POST', '/v1/authorize/login', headers, login),
+        ('my', 'GET', '/v1/my', auth, None),
+        ('book', 'GET', '/v1/book/%d' % book_id, auth, None),
+        ('tallies', 'GET', '/v1/tallies?book-id=%d' % book_id, auth, None),
+        ('accounts', 'GET', '/v1/accounts?userId=%d' % user.id, auth, None),
+        ('categories', 'GET', '/v1/categories?limit=50', auth, None),
+    ):
+        benchmark.run(name, method, path, count, headers, body)
+        click.echo('%s done.' % name)
+    click.echo(benchmark.table(json.load(compare) if compare else None))
+    if out:
+        benchmark.save(out, meta)
+        click.echo('Saved to %s.' % out)
+
+
+
+# flask bench-import --rows 100000 --tagged 0.1 --seed 1
+@app.cli.command('bench-import')
+@click.option('--rows', type=int, default=100000, help='导入的记录数')
+@click.option('--tagged', type=float, default=0.1, help='带标签的记录占比')
+@click.option('--book-id', type=int, help='导入的账本，默认新生成一个没有记录的账本')
+@click.option('--seed', type=int, help='随机种子，种子相同生成的记录相同')
+def bench_import(rows, tagged, book_id, seed):
+    '''测量批量导入每秒写入的记录数'''
+    from models import TallyImporter, BookAccount, book_tree
+    from sqlalchemy import func
+    rand = random.Random(seed)
+    if not book_id:
+        Seeder(seed).run(1, 1, 0)
+        book_id = db.session.scalar(db.select(func.max(Book.id)))
+    categories = db.session.scalars(db.select(book_tree(Category, book_id).c.id)).all()
+    accounts = db.session.scalars(db.select(BookAccount.account_id).where(BookAccount.book_id == book_id)).all()
+    tags = db.session.scalars(db.select(book_tree(Tag, book_id).c.id)).all()
+    if not categories:
+        raise click.ClickException('Book %d has no categories.' % book_id)
+    now = int(time.time())
+    data = [{
+        'amount': '%.2f' % rand.uniform(1, 500),
+        'recordTimestamp': now - rand.randrange(365 * 86400),
+        'categoryId': rand.choice(categories),
+        'accountId': rand.choice(accounts) if accounts else None,
+        'remark': rand.choice(('早餐', '午饭', '晚饭', '打车', None)),
+        'tagIds': rand.sample(tags, 1) if tags and rand.random() < tagged else [],
+    } for _ in range(rows)]
+    begin = time.perf_counter()
+    result = TallyImporter(book_id, app.config.get('IMPORT_BATCH_SIZE', 1000)).run(data)
+    seconds = time.perf_counter() - begin
+    click.echo('book %d, %s: %d rows imported, %d rejected in %.2fs, %.0f rows/s' % (
+        book_id, db.engine.dialect.name, result['inserted'], len(result['rejected']), seconds, result['inserted'] / seconds))
+
+
+# flask bench-json --rows 500
+@app.cli.command('bench-json')
+@click.option('--rows', type=int, default=500, help='每个响应的记录数，相当于/v1/tallies的一页')
+@click.option('--rounds', type=int, default=50, help='每种情况运行的次数')
+@click.option('--book-id', type=int, help='读取记录的账本，默认记录最多的账本')
+def bench_json(rows, rounds, book_id):
+    '''对比/v1/tallies响应的JSON编码及压缩方式'''
+    from flask.json.provider import DefaultJSONProvider
+    from sqlalchemy import func
+    from utils.response_json import orjson, brotli, compressor
+    from v1.views import tally_fields
+    book_id = book_id or db.session.query(Tally.book_id).group_by(Tally.book_id).order_by(func.count(Tally.id).desc()).limit(1).scalar()
+    keys, relations, options = tally_fields('category,account')
+    tallies = Tally.query.filter(Tally.book_id == book_id).options(*options).order_by(
+        Tally.record_timestamp.desc(), Tally.id.desc()).limit(rows).all()
+    payload = {'code': 200, 'data': Tally._get_all(tallies, keys, relations)}
+    click.echo('book %s, %d tallies, %d rounds' % (book_id, len(tallies), rounds))
+
+    def timeit(fn):
+        fn()
+        begin = time.perf_counter()
+        for _ in range(rounds):
+            ret = fn()
+        return (time.perf_counter() - begin) * 1000 / rounds, ret
+
+    encoders = [('flask', DefaultJSONProvider(app)), ('json', FastJSONProvider(app, 'json'))]
+    if orjson is not None:
+        encoders.append(('orjson', FastJSONProvider(app, 'orjson')))
+    click.echo('\n%-10s %10s %10s %8s' % ('encoder', 'bytes', 'ms', 'speedup'))
+    base = None
+    for name, provider in encoders:
+        provider.compact = True
+        ms, data = timeit(lambda: provider.response(payload).get_data())
+        base = base or ms
+        click.echo('%-10s %10d %10.3f %7.1fx' % (name, len(data), ms, base / ms))
+
+    click.echo('\n%-10s %10s %8s %10s' % ('encoding', 'bytes', 'ratio', 'ms'))
+    click.echo('%-10s %10d %7.1f%% %10s' % ('identity', len(data), 100, '-'))
+    with app.app_context():
+        for encoding in ('gzip', 'br') if brotli is not None else ('gzip',):
+            def compressed():
+                process, _, finish = compressor(encoding)
+                return process(data) + finish()
+            ms, out = timeit(compressed)
+            click.echo('%-10s %10d %7.1f%% %10.3f' % (encoding, len(out), len(out) * 100 / len(data), ms))
+
+
+# flask bench-export --format xlsx
+@app.cli.command('bench-export')
+@click.option('--book-id', type=int, help='导出的账本，默认记录最多的账本')
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'xlsx']), default='csv', help='导出格式')
+@click.option('--start', type=int, help='开始时间戳')
+@click.option('--end', type=int, help='结束时间戳')
+def bench_export(book_id, fmt, start, end):
+    '''测量/v1/book/<id>/export每秒导出的记录数'''
+    from sqlalchemy import func
+    from models import TallyExport
+    from utils import csv_stream, xlsx_stream
+    import resource
+    book_id = book_id or db.session.query(Tally.book_id).group_by(Tally.book_id).order_by(func.count(Tally.id).desc()).limit(1).scalar()
+    export = TallyExport(book_id, start, end)
+    stream = csv_stream(TallyExport.HEADER, export.chunks()) if fmt == 'csv' else xlsx_stream(TallyExport.HEADER, export.chunks())
+    size = sum(len(i.encode() if isinstance(i, str) else i) for i in stream)
+    click.echo('book %s, %s: %d rows, %d bytes in %.2fs, %.0f rows/s, max rss %.1f MB' % (
+        book_id, fmt, export.count, size, export.seconds, export.rate, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+# flask profile --top 10
+@app.cli.command()
+@click.argument('files', nargs=-1, type=click.Path(exists=True, dir_okay=False))
+@click.option('--top', type=int, default=20, help='列出的语句数')
+@click.option('--json', 'as_json', is_flag=True, help='输出JSON')
+def profile(files, top, as_json):
+    '''汇总性能剖析报告，默认读取PROFILE_LOG文件'''
+    from models.profiler import Profiler
+    import json
+    files = files or Profiler.files(app.config.get('PROFILE_LOG') or 'profile.log')
+    if not files:
+        raise click.ClickException('No profile reports found.')
+    result = Profiler.summary(files, top)
+    if as_json:
+        click.echo(json.dumps(result, ensure_ascii=False, indent=2))
+        return
+    click.echo('%d requests in %d files.' % (result['requests'], len(files)))
+    click.echo('\nTop statements by total time:')
+    for i in result['top']:
+        click.echo('%10.1fms %6d runs %4d req  %s' % (i['ms'], i['count'], i['requests'], i['sql'][:160]))
+    click.echo('\nN+1 statements:')
+    for i in result['n_plus_one']:
+        click.echo('%6d runs in %d requests  %s\n    endpoints: %s\n    from: %s' % (
+            i['count'], i['n_plus_one'], i['sql'][:160], ', '.join(i['endpoints']), ', '.join(i['origins'])))
+    click.echo('\nSlow statements:')
+    for i in result['slow']:
+        click.echo('%10.1fms %s  %s\n    plan: %s' % (i['ms'], i['endpoint'], i['sql'][:160], json.dumps(i['plan'], ensure_ascii=False)))
+
+
 if __name__ == '__main__':
     app.run()
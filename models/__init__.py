@@ -1,21 +1,19 @@
 from typing import List, Optional
 from typing_extensions import Annotated
 from flask_sqlalchemy import SQLAlchemy
-from redis import ConnectionPool, StrictRedis
-from sqlalchemy import String, Text, SmallInteger, DECIMAL, ForeignKey
-from sqlalchemy.orm import relationship, Mapped, mapped_column
+from redis import RedisError
+from sqlalchemy import String, Text, SmallInteger, DECIMAL, ForeignKey, Index, select, and_, func
+from sqlalchemy.orm import relationship, selectinload, Mapped, mapped_column
 from datetime import datetime
-import re
+from collections import namedtuple, defaultdict
+from utils import LRUCache
+from .serializer import Serializer, to_snake, MAX_DEPTH
+from .cache import Cache
+from .replica import RoutingSession, Replicas, primary
+from .throttle import RateLimit, LoadShedder, TimedQueuePool
+from .wechat import WeChat
 
-# Redis连接参数
-REDIS_CONFIG = {
-    'host': '172.17.0.1',
-    'port': 6379,
-    'db': 0,
-    'decode_responses': True
-}
-
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession}, engine_options={'poolclass': TimedQueuePool})
 
 intpk = Annotated[int, mapped_column(primary_key=True, autoincrement=True)]
 str_name = Annotated[str, mapped_column(String(16), nullable=False, doc='名称')]
@@ -25,38 +23,30 @@ class Base(db.Model):
     __abstract__ = True
     __cloumns__ = tuple()
 
-    def _get(self, keys:list|tuple = None):
-        def __to_camel(s:str):
-            return re.sub(r'(_[a-z])', lambda x: x.group(1)[1].upper(), s.lower())
-        ret = {}
-        keys = keys or self.__cloumns__
-        for k in keys:
-            if hasattr(self, k):
-                def __get(base: Base):
-                    return base._get()
-                v = getattr(self, k)
-                if isinstance(v, list):
-                    v = [__get(i) for i in v]
-                elif isinstance(v, Base):
-                    v = __get(v)
-                ret[__to_camel(k)] = v
-        return ret
-
-    def _set(self, kv:dict):
-        def __to_snake(s:str):
-            return re.sub(r'([a-z])([A-Z])', r'\1_\2', s).lower()
+    def _get(self, keys:list|tuple = None, relations:list|tuple = None):
+        return Serializer.of(type(self), keys, relations).one(self)
+
+    @classmethod
+    def _get_all(cls, objs, keys:list|tuple = None, relations:list|tuple = None):
+        return Serializer.of(cls, keys, relations).many(objs)
+
+    def _set(self, kv:dict, commit:bool = True):
+        db.session.info.pop('replica', None)
         for k, v in kv.items():
-            k = __to_snake(k)
+            k = to_snake(k)
             if hasattr(self, k):
                 setattr(self, k, v)
         if not self.id:
             db.session.add(self)
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return self
 
-    def _del(self):
+    def _del(self, commit:bool = True):
+        db.session.info.pop('replica', None)
         db.session.delete(self)
-        db.session.commit()
+        if commit:
+            db.session.commit()
         return True
 
 
@@ -78,6 +68,18 @@ class User(Base):
     accounts: Mapped[List['Account']] = relationship(cascade="all, delete") # 1->n 单方向一对多，一方引用多方
     books: Mapped[List['Book']] = relationship(secondary='user_book', cascade="all, delete", back_populates='users') # n->n 多对多，双向引用
 
+    @classmethod
+    def _load_books(cls, users) -> list[list[dict]]:
+        '''用户的账本，不含已删除(等待清理)的账本'''
+        rows = db.session.execute(select(UserBook.user_id, Book).join(Book, Book.id == UserBook.book_id).where(
+            UserBook.user_id.in_([i.id for i in users]), Book.state != BOOK_DELETED).order_by(Book.id).options(
+            selectinload(Book.configure), selectinload(Book.accounts))).all()
+        dicts = dict(zip([i[1].id for i in rows], Book._get_all([i[1] for i in rows])))
+        books = defaultdict(list)
+        for user_id, book in rows:
+            books[user_id].append(dicts[book.id])
+        return [books[i.id] for i in users]
+
 class UserConfigure(Base):
     __tablename__ = 'user_configure'
     __cloumns__ = ('current_book_id',)
@@ -94,6 +96,8 @@ class Application(Base):
     secret_key: Mapped[str] = mapped_column(String(64), doc='密钥')
     expirydate: Mapped[datetime]
 
+BOOK_DELETED = 1  # Book.state：已删除，等待后台清理
+
 class Book(Base):
     __tablename__ = 'book'
     __cloumns__ = ('id', 'name', 'icon', 'remark', 'configure', 'accounts', 'categories', 'tags', 'created')
@@ -110,6 +114,14 @@ class Book(Base):
     tags: Mapped[List['Tag']] = relationship(secondary='book_tag', cascade="all, delete") # n->n 多对多，单向引用
     tallies: Mapped[List['Tally']] = relationship(lazy='dynamic', cascade="all, delete")
 
+    @classmethod
+    def _load_categories(cls, books) -> list[list[dict]]:
+        return book_trees(Category, books)
+
+    @classmethod
+    def _load_tags(cls, books) -> list[list[dict]]:
+        return book_trees(Tag, books)
+
 class BookConfigure(Base):
     __tablename__ = 'book_configure'
     __cloumns__ = ('budget', 'period')
@@ -125,9 +137,28 @@ class Account(Base):
     name: Mapped[str_name]
     icon: Mapped[str_remark] = mapped_column(doc='图标url')
     remark: Mapped[str_remark]
-    user_id: Mapped[int] = mapped_column(ForeignKey('user.id', ondelete='CASCADE')) # n->1
-
-class Category(Base):
+    user_id: Mapped[int] = mapped_column(ForeignKey('user.id', ondelete='CASCADE'), index=True) # n->1
+
+    @classmethod
+    def _load_balance(cls, accounts) -> list[str]:
+        '''账户余额，读取`AccountBalance`维护的值'''
+        balances = AccountBalance.of([i.id for i in accounts])
+        return [str(balances.get(i.id, 0)) for i in accounts]
+
+class Tree:
+    '''以pid自关联的树形模型，children由一次递归查询批量加载'''
+    @classmethod
+    def _load_children(cls, objs) -> list[list[dict]]:
+        ids = [i.id for i in objs]
+        nodes = db.session.scalars(select(cls).where(
+            cls.id.in_(select(subtree(cls, select(cls.id).where(cls.pid.in_(ids))).c.id))).order_by(cls.id)).all()
+        dicts = tree_dicts(cls, nodes)
+        children = defaultdict(list)
+        for i in nodes:
+            children[i.pid].append(dicts[i.id])
+        return [children[i] for i in ids]
+
+class Category(Base, Tree):
     __tablename__ = 'category'
     __cloumns__ = ('id', 'pid', 'name', 'type', 'icon', 'remark', 'seq', 'children')
     id: Mapped[intpk]
@@ -136,21 +167,24 @@ class Category(Base):
     icon: Mapped[str_remark] = mapped_column(doc='图标url')
     remark: Mapped[str_remark]
     seq: Mapped[int] = mapped_column(SmallInteger, default=int(0), doc='序号')
-    pid: Mapped[Optional[int]] = mapped_column(ForeignKey('category.id', ondelete='CASCADE'), doc='父ID') # n->1
+    pid: Mapped[Optional[int]] = mapped_column(ForeignKey('category.id', ondelete='CASCADE'), index=True, doc='父ID') # n->1
     children: Mapped[List['Category']] = relationship(cascade="all, delete") # 1->n 单方向一对多，一方引用多方
 
-class Tag(Base):
+class Tag(Base, Tree):
     __tablename__ = 'tag'
     __cloumns__ = ('id', 'pid', 'name', 'remark', 'seq', 'children')
     id: Mapped[intpk]
     name: Mapped[str_name]
     remark: Mapped[str_remark]
     seq: Mapped[int] = mapped_column(SmallInteger, default=int(0), doc='序号')
-    pid: Mapped[Optional[int]] = mapped_column(ForeignKey('tag.id', ondelete='CASCADE'), doc='父ID') # n->1
+    pid: Mapped[Optional[int]] = mapped_column(ForeignKey('tag.id', ondelete='CASCADE'), index=True, doc='父ID') # n->1
     children: Mapped[List['Tag']] = relationship(cascade="all, delete") # 1->n 单方向一对多，一方引用多方
 
 class Tally(Base):
     __tablename__ = 'tally'
+    __table_args__ = (
+        Index('ix_tally_book_id_record_timestamp_id', 'book_id', 'record_timestamp', 'id'), # 按账本+时间的游标分页
+    )
     __cloumns__ = ('id', 'amount', 'record_timestamp', 'remark', 'category_id', 'account_id', 'tags')
     id: Mapped[intpk]
     amount: Mapped[DECIMAL] = mapped_column(DECIMAL(13, 4), default=0, doc='金额')
@@ -159,6 +193,7 @@ class Tally(Base):
     book_id: Mapped[int] = mapped_column(ForeignKey('book.id', ondelete='CASCADE')) # n->1
     category_id: Mapped[int] = mapped_column(ForeignKey('category.id')) # n->1
     account_id: Mapped[Optional[int]] = mapped_column(ForeignKey('account.id')) # n->1
+    import_token: Mapped[Optional[str]] = mapped_column(String(32), index=True, doc='批量导入时标记同一条INSERT写入的记录，取得id后清除')
     category: Mapped['Category'] = relationship() # n->1 多方引用一方
     account: Mapped[Optional['Account']] = relationship() # n->1 多方引用一方
     tags: Mapped[List['Tag']] = relationship(secondary='tally_tag') # n->n 多对多，一方引用
@@ -190,6 +225,67 @@ class TallyTag(db.Model):
     tag_id: Mapped[int] = mapped_column(ForeignKey('tag.id', ondelete='CASCADE'), primary_key=True) # n->n
 
 
+def subtree(model: type[Category] | type[Tag], roots):
+    '''以`roots`(id子查询)为根的分类或标签(含所有子孙节点)id的递归CTE'''
+    tree = select(model.id).where(model.id.in_(roots)).cte(recursive=True)
+    return tree.union(select(model.id).join(tree, model.pid == tree.c.id))
+
+def book_tree(model: type[Category] | type[Tag], *book_ids: int):
+    '''账本下分类或标签(含所有子孙节点)id的递归CTE'''
+    assoc, fk = (BookCategory, BookCategory.category_id) if model is Category else (BookTag, BookTag.tag_id)
+    return subtree(model, select(fk).where(assoc.book_id.in_(book_ids)))
+
+def tree_dicts(model: type[Category] | type[Tag], nodes: list) -> dict[int, dict]:
+    '''把一次查出的节点在内存中组装为树，返回id到节点dict(已填充children)的映射'''
+    serializer = Serializer.of(model, [k for k in model.__cloumns__ if k != 'children'], ())
+    dicts = {}
+    for i in nodes:
+        dicts[i.id] = serializer.one(i)
+        dicts[i.id]['children'] = []
+    for i in nodes:
+        if i.pid in dicts and i.pid != i.id:
+            dicts[i.pid]['children'].append(dicts[i.id])
+    return dicts
+
+def book_trees(model: type[Category] | type[Tag], books: list) -> list[list[dict]]:
+    '''一次查询取得多个账本的分类或标签树，已作为下级出现的节点不再作为顶级节点重复返回'''
+    assoc, fk = (BookCategory, BookCategory.category_id) if model is Category else (BookTag, BookTag.tag_id)
+    ids = [i.id for i in books]
+    rows = db.session.execute(
+        select(model, assoc.book_id).outerjoin(assoc, and_(fk == model.id, assoc.book_id.in_(ids)))
+        .where(model.id.in_(select(book_tree(model, *ids).c.id))).order_by(model.id)).all()
+    nodes = list({i[0].id: i[0] for i in rows}.values())
+    dicts = tree_dicts(model, nodes)
+    linked = defaultdict(list)
+    for node, book_id in rows:
+        if book_id is not None:
+            linked[book_id].append(node.id)
+    ret = []
+    for book_id in ids:
+        descendants, stack = set(), [dicts[i] for i in linked[book_id]]
+        while stack:
+            for child in stack.pop()['children']:
+                if child['id'] not in descendants:
+                    descendants.add(child['id'])
+                    stack.append(child)
+        ret.append([dicts[i] for i in linked[book_id] if i not in descendants])
+    return ret
+
+
+def estimate_count(query, cap: int = 1000) -> tuple[int, bool]:
+    '''查询结果的总数：不超过`cap`时精确计数，否则MySQL取EXPLAIN的估算行数，返回(总数, 是否精确)'''
+    count = db.session.scalar(select(func.count()).select_from(query.limit(cap + 1).subquery()))
+    if count <= cap:
+        return count, True
+    conn = db.session.connection()
+    if conn.dialect.name == 'mysql':
+        compiled = query.statement.compile(dialect=conn.dialect)
+        row = conn.exec_driver_sql('EXPLAIN ' + str(compiled), compiled.params).mappings().first()
+        if row and row.get('rows'):
+            return max(int(row['rows']), count), False
+    return count, False
+
+
 class Permission(Base):
     __tablename__ = 'permission'
     id: Mapped[intpk]
@@ -199,15 +295,22 @@ class Permission(Base):
     remark: Mapped[str_remark]
 
 
-from flask import request
+from flask import request, current_app
 from authlib.jose import jwt, JoseError
 from functools import wraps
 from werkzeug.exceptions import Unauthorized, NotFound
-import requests
 import time
+
+APP_VERSION_KEY = 'cashbook:application:version'
+AppInfo = namedtuple('AppInfo', ('id', 'app_id', 'secret_key', 'expirydate'))
+
 class Authorize:
     app: Application
     user: User
+    __apps = LRUCache(maxsize=256)  # app_id -> AppInfo
+    __tokens = LRUCache(maxsize=10000)  # (app_id, token) -> payload
+    __version = None
+    __checked = 0
     def __init__(self, appid: str = None, **kwargs) -> None:
         self.appid = appid
         if kwargs.get('password'):
@@ -265,6 +368,10 @@ class Authorize:
         return User.query.filter_by(wx_openid=self.__get_wx_openid(code)).first()
 
     def __md5_base64(self, str: str):
+        return self.hash_password(str)
+
+    @staticmethod
+    def hash_password(str: str) -> str:
         """MD5加密 & Base64"""
         import hashlib, base64
         hmd5 = hashlib.md5(b'perfei#md5')
@@ -273,47 +380,108 @@ class Authorize:
 
     def __get_wx_openid(self, js_code:str) -> str | None:
         """通过微信auth.code2Session API 获取openid"""
-        req = dict(requests.get('https://api.weixin.qq.com/sns/jscode2session?', {
-            'appid': self.app.app_id,
-            'secret': self.app.secret_key,
-            'js_code': js_code, 
-            'grant_type': 'authorization_code'
-        }).json())
-        if 'errcode' in req and req['errcode'] != 0:
-            errmsg = {
-                -1: '微信系统繁忙',	
-                40029: 'code 无效',
-                45011: '请勿频繁操作',
-                40226: '微信用户被限制'
-            }
-            raise Unauthorized(errmsg.get(req['errcode'], '微信验证失败'))
-        return req.get('openid')
+        return WeChat.code2session(self.app.app_id, self.app.secret_key, js_code)
+
+    @classmethod
+    def cached_app(cls, appid: str) -> AppInfo | None:
+        """从进程内缓存获取应用，未命中时查询数据库"""
+        cls.__sync()
+        app = cls.__apps.get(appid)
+        if app is None:
+            row: Application = Application.query.filter_by(app_id=appid).first()
+            if not row:
+                return None
+            app = AppInfo(row.id, row.app_id, row.secret_key, row.expirydate)
+            cls.__apps.set(appid, app, ex=current_app.config.get('AUTH_CACHE_TTL', 60))
+        return app
+
+    @classmethod
+    def verify_token(cls, app: AppInfo, token: str) -> dict:
+        """校验token，已校验过的token在`exp`之前直接从缓存返回"""
+        key = (app.app_id, token)
+        data = cls.__tokens.get(key)
+        if data is None:
+            try:
+                data = dict(jwt.decode(token, app.secret_key))
+            except Exception:
+                raise Unauthorized('登录凭证无效')
+            if time.time() > data.get('exp', 0):
+                raise Unauthorized('凭证已到期')
+            cls.__tokens.maxsize = current_app.config.get('AUTH_TOKEN_CACHE_SIZE', 10000)
+            cls.__tokens.set(key, data, exat=data['exp'])
+        return data
+
+    @classmethod
+    def expire_app(cls):
+        """应用变更后使所有worker的应用及token缓存失效"""
+        cls.__apps.clear()
+        cls.__tokens.clear()
+        try:
+            cls.__version = str(Cache().incr(APP_VERSION_KEY))
+        except RedisError:
+            pass
+
+    @classmethod
+    def __sync(cls):
+        """定期比对Redis中的版本号，版本变化时清空本地缓存"""
+        now = time.time()
+        if now - cls.__checked < current_app.config.get('AUTH_CACHE_CHECK_INTERVAL', 1):
+            return
+        cls.__checked = now
+        try:
+            version = Cache().get(APP_VERSION_KEY)
+        except RedisError:
+            return
+        if version != cls.__version:
+            cls.__apps.clear()
+            cls.__tokens.clear()
+            cls.__version = version
 
     @staticmethod
     def login_required(view_func):
         @wraps(view_func)
         def verify_token(*args, **kwargs):
-            print(view_func.__name__, request.method)
-            app: Application = Application.query.filter_by(app_id=request.headers.get('appid')).first()
+            appid = request.headers.get('appid')
+            app = Authorize.cached_app(appid) if appid else None
             if not app:
                 raise Unauthorized('非法客户端')
             try:
-                data = jwt.decode(request.headers['Authorization'].split(None, 1)[1], app.secret_key)
+                token = request.headers['Authorization'].split(None, 1)[1]
             except Exception:
                 raise Unauthorized('登录凭证无效')
-            if time.time() > data.get('exp', 0): 
-                raise Unauthorized('凭证已到期')
-            return view_func(*args, user_id=data.get('aud'), **kwargs)
+            data = Authorize.verify_token(app, token)
+            user_id = data.get('aud')
+            RateLimit.check(request.endpoint, appid, user_id)
+            if not Replicas.enabled():
+                return view_func(*args, user_id=user_id, **kwargs)
+            if request.method == 'GET':
+                try:
+                    sticky = Replicas.sticky(user_id)
+                except RedisError:
+                    sticky = True
+                if not sticky:
+                    db.session.info['replica'] = Replicas.choose()
+                return view_func(*args, user_id=user_id, **kwargs)
+            try:
+                return view_func(*args, user_id=user_id, **kwargs)
+            finally:
+                try:
+                    Replicas.stick(user_id)
+                except RedisError:
+                    pass
         return verify_token
 
 
-class Cache:
-    redis = None
-    def __init__(self) -> None:
-        self.redis = StrictRedis(connection_pool=ConnectionPool(**REDIS_CONFIG))
-
-    def get(self, key: str):
-        return self.redis.get(key)
-
-    def set(self, key: str, value='', ex=300):
-        return self.redis.set(key, value, ex=ex)
+from .rollup import TallyRollup, PERIODS, period_bucket
+from .balance import AccountBalance
+from .search import TallyTerm
+from .analytics import Analytics
+from .export import TallyExport
+from .budget import Budget
+from .sync import Change, Sync
+from .importer import TallyImporter
+from .version import Version
+from .seed import Seeder
+from .metrics import Metrics
+from .batch import Batch, BatchError
+from .jobs import Job
@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from sqlalchemy import BigInteger, select, cast, func
+from . import db, Book, Category, Tally
+from .rollup import PERIODS, period_bucket
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+INCOME, EXPENSE = 1, -1  # 分类类型
+SLOT = 1800  # 按半小时的时间片换算周期编号，整点及半点时区的周期边界都落在时间片边界上
+CHUNK = 10000  # 每次从游标读取的行数
+UNIT = 10000  # 金额以万分之一元为单位读成整数(与DECIMAL(13, 4)一致)按整数单位合计，2**53内没有浮点误差，输出时才换算成元
+
+
+def period_range(period: str, timestamp: int) -> tuple[int, int]:
+    '''时间戳所在周期的[开始, 结束)时间戳(服务器本地时区)'''
+    d = datetime.fromtimestamp(timestamp)
+    day = datetime(d.year, d.month, d.day)
+    if period == 'day':
+        start, end = day, day + timedelta(days=1)
+    elif period == 'week':
+        start = day - timedelta(days=day.weekday())
+        end = start + timedelta(days=7)
+    elif period == 'month':
+        start, end = datetime(d.year, d.month, 1), datetime(d.year + d.month // 12, d.month % 12 + 1, 1)
+    else:
+        start, end = datetime(d.year, 1, 1), datetime(d.year + 1, 1, 1)
+    return int(start.timestamp()), int(end.timestamp())
+
+
+def period_sequence(period: str, start: int, end: int) -> list[tuple[int, int]]:
+    '''[start, end)内的连续周期：[(周期编号, 开始时间戳)]'''
+    ret = []
+    while start < end:
+        ret.append((period_bucket(period, start), start))
+        start = period_range(period, start)[1]
+    return ret
+
+
+class Analytics:
+    '''账本收支趋势及预算预测
+
+    按账本、时间范围把记账记录的(记录时间, 金额, 分类类型, 分类)四列经Core连接分批读入NumPy整数数组，不生成ORM对象；
+    时间按半小时时间片去重后换算周期编号(与汇总表一致)，再用`bincount`、`cumsum`向量化计算各序列。
+    结果由`Version.cached`按账本的`book:<id>`、`tallies:<id>`版本号缓存。
+    '''
+    @staticmethod
+    def available() -> bool:
+        return np is not None
+
+    @staticmethod
+    def columns(book_id: int, start: int, end: int):
+        '''[start, end)内记账记录的(记录时间, 金额(`UNIT`), 分类类型, 分类id)，每行一条记录的二维整数数组'''
+        query = select(Tally.record_timestamp, cast(func.round(Tally.amount * UNIT), BigInteger), Category.type, Tally.category_id).join(
+            Category, Category.id == Tally.category_id).where(
+            Tally.book_id == book_id, Tally.record_timestamp >= start, Tally.record_timestamp < end).execution_options(yield_per=CHUNK)
+        chunks = [np.array([tuple(i) for i in rows], dtype=np.int64) for rows in db.session.connection().execute(query).partitions()]
+        return np.concatenate(chunks) if chunks else np.empty((0, 4), dtype=np.int64)
+
+    @staticmethod
+    def bucket_index(period: str, timestamps, buckets: list[int]):
+        '''每个时间戳所在周期在`buckets`(升序)中的下标'''
+        slots, inverse = np.unique(timestamps // SLOT, return_inverse=True)
+        slot_buckets = np.fromiter((period_bucket(period, int(i) * SLOT) for i in slots), dtype=np.int64, count=len(slots))
+        return np.searchsorted(np.asarray(buckets, dtype=np.int64), slot_buckets)[inverse]
+
+    @staticmethod
+    def trend(book: Book, period: str = 'month', periods: int = 12, window: int = 3, now: int = None) -> dict:
+        '''最近`periods`个周期的收入、支出、结余，支出的`window`期移动平均、环比变化、各分类占比，及当前预算周期的预测'''
+        now = now or int(time.time())
+        start = period_range(period, now)[0]
+        for _ in range(periods - 1):
+            start = period_range(period, start - 1)[0]
+        end = period_range(period, now)[1]
+        buckets = [i for i, _ in period_sequence(period, start, end)]
+        configure = book.configure
+        budget_period = configure.period if configure and configure.period in PERIODS else 'month'
+        budget_start, budget_end = period_range(budget_period, now)
+
+        data = Analytics.columns(book.id, min(start, budget_start), max(end, budget_end))
+        timestamps, amounts, types, categories = data[:, 0], data[:, 1], data[:, 2], data[:, 3]
+        size = len(buckets)
+
+        mask = (timestamps >= start) & (timestamps < end)
+        index = Analytics.bucket_index(period, timestamps[mask], buckets)
+        expense_mask = types[mask] == EXPENSE
+        income = np.bincount(index, weights=np.where(types[mask] == INCOME, amounts[mask], 0), minlength=size)
+        expense = np.bincount(index, weights=np.where(expense_mask, amounts[mask], 0), minlength=size)
+        moving = np.full(size, np.nan)
+        if size >= window:
+            cumsum = np.concatenate(([0.0], np.cumsum(expense)))
+            moving[window - 1:] = (cumsum[window:] - cumsum[:-window]) / window
+        previous = np.concatenate(([np.nan], expense[:-1]))
+        change = expense - previous
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change_rate = np.where(previous > 0, change / previous, np.nan)
+
+        ids, category_index = np.unique(categories[mask][expense_mask], return_inverse=True)
+        matrix = np.bincount(category_index * size + index[expense_mask], weights=amounts[mask][expense_mask],
+                             minlength=len(ids) * size).reshape(len(ids), size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            shares = np.where(expense > 0, matrix / expense, 0)
+        order = np.argsort(-matrix.sum(axis=1), kind='stable')
+
+        return {
+            'period': period,
+            'window': window,
+            'buckets': buckets,
+            'income': _series(income / UNIT),
+            'expense': _series(expense / UNIT),
+            'net': _series((income - expense) / UNIT),
+            'movingAverage': _series(moving / UNIT),
+            'change': _series(change / UNIT),
+            'changeRate': _series(change_rate),
+            'categoryShare': [{'categoryId': int(ids[i]), 'share': _series(shares[i])} for i in order],
+            'forecast': Analytics.forecast(timestamps, amounts, types, budget_period, budget_start, budget_end,
+                                           Decimal(configure.budget or 0) if configure else Decimal(0), now),
+        }
+
+    @staticmethod
+    def forecast(timestamps, amounts, types, period: str, start: int, end: int, budget: Decimal, now: int) -> dict:
+        '''当前预算周期按日累计的支出，及按已过时间的支出速度预测的周期末支出，`amounts`以`UNIT`为单位'''
+        days = period_sequence('day', start, end)
+        mask = (timestamps >= start) & (timestamps < end) & (types == EXPENSE)
+        daily = np.bincount(Analytics.bucket_index('day', timestamps[mask], [i for i, _ in days]), weights=amounts[mask], minlength=len(days))
+        cumulative = np.cumsum(daily)
+        today = max(0, sum(1 for _, i in days if i <= now) - 1)
+        elapsed = min(1.0, max(now - start, 1) / (end - start))
+        spent, to_date = float(cumulative[-1]) / UNIT, float(cumulative[today]) / UNIT
+        projected = to_date / elapsed + (spent - to_date)  # 今天之后的记录(预先记下的支出)按原额计入
+        return {
+            'period': period,
+            'bucket': period_bucket(period, now),
+            'budget': float(budget),
+            'spent': round(spent, 4),
+            'elapsed': round(elapsed, 4),
+            'cumulative': _series(cumulative / UNIT),
+            'projected': round(projected, 4),
+            'overBudget': bool(budget) and projected > float(budget),
+        }
+
+
+def _series(values) -> list:
+    return [None if np.isnan(i) else round(float(i), 4) for i in values]
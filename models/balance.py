@@ -0,0 +1,125 @@
+from collections import namedtuple, defaultdict
+from decimal import Decimal
+from sqlalchemy import DECIMAL, ForeignKey, event, inspect, select, func
+from sqlalchemy.orm import Mapped, mapped_column, Session
+from . import db, Base, Account, Category, Tally
+from .rollup import upsert_add, _tally_values
+
+CENT = Decimal('0.0001')  # DECIMAL(17, 4)
+BalanceDelta = namedtuple('BalanceDelta', ('account_id', 'category_id', 'amount', 'count'))
+
+
+class AccountBalance(Base):
+    '''资金账户余额：收入分类(type=1)的记录加、支出分类(type=-1)的记录减、不记收支(type=0)的不变，
+    随记账记录及分类类型的修改在同一事务中增量维护，读取时不再汇总记账记录'''
+    __tablename__ = 'account_balance'
+    __cloumns__ = ('account_id', 'balance', 'count')
+    account_id: Mapped[int] = mapped_column(ForeignKey('account.id', ondelete='CASCADE'), primary_key=True)
+    balance: Mapped[DECIMAL] = mapped_column(DECIMAL(17, 4), default=0, doc='余额')
+    count: Mapped[int] = mapped_column(default=0, doc='笔数')
+
+    @staticmethod
+    def of(account_ids: list | tuple) -> dict[int, Decimal]:
+        rows = db.session.execute(select(AccountBalance.account_id, AccountBalance.balance).where(AccountBalance.account_id.in_(account_ids)))
+        return {i: balance for i, balance in rows}
+
+    @staticmethod
+    def reconcile(account_ids: list | tuple = None, fix: bool = False, batch_size: int = 1000) -> list[dict]:
+        '''从记账记录重新计算余额，返回与已记录余额不一致的账户；`fix`时把差额累加到余额上
+
+        修正写入的是差额而不是重算的值，同时进行的记账对余额的增量不会被覆盖。
+        '''
+        if not account_ids:
+            account_ids = db.session.scalars(select(Account.id).order_by(Account.id)).all()
+        drift = []
+        for i in range(0, len(account_ids), batch_size):
+            ids = account_ids[i:i + batch_size]
+            expected = {id: (Decimal(str(balance or 0)).quantize(CENT), count) for id, balance, count in db.session.execute(
+                select(Tally.account_id, func.sum(Tally.amount * func.coalesce(Category.type, 0)), func.count(Tally.id))
+                .outerjoin(Category, Category.id == Tally.category_id).where(Tally.account_id.in_(ids)).group_by(Tally.account_id))}
+            actual = {id: (Decimal(str(balance or 0)).quantize(CENT), count) for id, balance, count in db.session.execute(
+                select(AccountBalance.account_id, AccountBalance.balance, AccountBalance.count).where(AccountBalance.account_id.in_(ids)))}
+            values = []
+            for id in ids:
+                balance, count = expected.get(id, (Decimal(0), 0))
+                old_balance, old_count = actual.get(id, (Decimal(0), 0))
+                if balance != old_balance or count != old_count:
+                    drift.append({'accountId': id, 'balance': str(old_balance), 'expected': str(balance), 'count': old_count, 'expectedCount': count})
+                    values.append({'account_id': id, 'balance': balance - old_balance, 'count': count - old_count})
+            if fix and values:
+                upsert_add(db.session.connection(), AccountBalance.__table__, values, ('balance', 'count'))
+            db.session.commit()
+        return drift
+
+
+def apply_balance_deltas(session: Session, deltas: list[BalanceDelta], types: dict = None):
+    '''按分类类型把记账记录的增量累加到账户余额，`types`为已知的{分类id: 类型}'''
+    deltas = [i for i in deltas if i.account_id is not None]
+    if not deltas:
+        return
+    conn = session.connection()
+    types = dict(types or {})
+    missing = {i.category_id for i in deltas} - set(types) - {None}
+    if missing:
+        types.update(conn.execute(select(Category.id, Category.type).where(Category.id.in_(missing))).all())
+    acc = defaultdict(lambda: [Decimal(0), 0])
+    for i in deltas:
+        item = acc[i.account_id]
+        item[0] += Decimal(str(i.amount or 0)) * (types.get(i.category_id) or 0)
+        item[1] += i.count
+    values = [{'account_id': k, 'balance': v[0], 'count': v[1]} for k, v in acc.items() if v[0] or v[1]]
+    if values:
+        upsert_add(conn, AccountBalance.__table__, values, ('balance', 'count'))
+
+
+def balance_deltas(session: Session) -> list[BalanceDelta]:
+    '''收集本次flush中新增、修改、删除的记账记录对余额的影响，修改前后都按修改后的分类类型计算'''
+    keys = ('account_id', 'category_id', 'amount')
+    deltas = []
+    for obj in session.new:
+        if isinstance(obj, Tally):
+            deltas.append(BalanceDelta(*_tally_values(obj, False, keys), 1))
+    for obj in session.deleted:
+        if isinstance(obj, Tally):
+            old = _tally_values(obj, True, keys)
+            deltas.append(BalanceDelta(*old[:2], -Decimal(str(old[2] or 0)), -1))
+    for obj in session.dirty:
+        if isinstance(obj, Tally) and session.is_modified(obj):
+            old, new = _tally_values(obj, True, keys), _tally_values(obj, False, keys)
+            if old != new:
+                deltas.append(BalanceDelta(*old[:2], -Decimal(str(old[2] or 0)), -1))
+                deltas.append(BalanceDelta(*new, 1))
+    return deltas
+
+
+@event.listens_for(Session, 'before_flush')
+def _before_flush(session: Session, flush_context, instances):
+    '''分类类型改变时按flush前属于该分类的记录修正余额，本次flush中移入、移出该分类的记录由`_after_flush`处理'''
+    for obj in session.dirty:
+        if not isinstance(obj, Category) or obj.id is None:
+            continue
+        history = inspect(obj).attrs['type'].history
+        if not history.deleted or not history.added or (history.deleted[0] or 0) == (history.added[0] or 0):
+            continue
+        sign = (history.added[0] or 0) - (history.deleted[0] or 0)
+        conn = session.connection()
+        values = [{'account_id': id, 'balance': amount * sign, 'count': 0} for id, amount in conn.execute(
+            select(Tally.account_id, func.sum(Tally.amount)).where(Tally.category_id == obj.id, Tally.account_id.isnot(None))
+            .group_by(Tally.account_id)) if amount]
+        if values:
+            upsert_add(conn, AccountBalance.__table__, values, ('balance',))
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session: Session, flush_context):
+    apply_balance_deltas(session, balance_deltas(session))
+
+
+def subtract_tallies(session: Session, *criteria):
+    '''批量删除(不经过flush)记账记录前，从余额中减去符合`criteria`的记录'''
+    conn = session.connection()
+    values = [{'account_id': id, 'balance': -(balance or 0), 'count': -count} for id, balance, count in conn.execute(
+        select(Tally.account_id, func.sum(Tally.amount * func.coalesce(Category.type, 0)), func.count(Tally.id))
+        .outerjoin(Category, Category.id == Tally.category_id).where(Tally.account_id.isnot(None), *criteria).group_by(Tally.account_id))]
+    if values:
+        upsert_add(conn, AccountBalance.__table__, values, ('balance', 'count'))
@@ -0,0 +1,166 @@
+from flask import current_app
+from redis import RedisError
+from sqlalchemy import select, update
+from sqlalchemy.exc import SQLAlchemyError
+from . import db, BOOK_DELETED, User, Book, Account, Category, Tag, Tally, UserBook, to_snake
+from .importer import TallyImporter
+from .jobs import Job
+
+RESOURCES = {  # 类型: (模型, 可修改的字段, 仅新建时可用的字段, 未找到时的提示)
+    'book': (Book, ('name', 'icon', 'remark'), (), '账本不存在'),
+    'account': (Account, ('name', 'icon', 'remark'), (), '资金账户不存在'),
+    'category': (Category, ('name', 'type', 'icon', 'remark', 'seq', 'pid'), ('book_id',), '分类不存在'),
+    'tag': (Tag, ('name', 'remark', 'seq', 'pid'), ('book_id',), '标签不存在'),
+    'tally': (Tally, ('amount', 'record_timestamp', 'remark', 'category_id', 'account_id', 'tag_ids'), ('book_id',), '记录不存在'),
+}
+
+
+class BatchError(Exception):
+    '''批量操作失败，`index`为出错的操作序号(提交时出错为None)'''
+    def __init__(self, msg: str, index: int = None) -> None:
+        super().__init__(msg if index is None else '第%d个操作失败：%s' % (index + 1, msg))
+        self.index = index
+
+
+class Batch:
+    '''在一个事务中执行多个增删改操作，全部成功才提交，任一失败全部回滚
+
+    每个操作：`{"op": "create|update|delete", "type": "book|account|category|tag|tally", "id": 1, "data": {...}, "ref": "t1"}`，
+    `ref`为新建对象命名，之后的操作可在`id`或`data`的值中用`"@t1"`引用它的id。
+    所有修改最后一次flush、一次commit；记账记录的新建、修改按`TallyImporter`的规则校验。
+    '''
+    def __init__(self, user_id: int) -> None:
+        self.user_id = user_id
+        self.user = None
+        self.refs = {}
+        self.books = []
+        self.purges = []
+        self.importers = {}
+
+    def run(self, operations: list) -> list[dict]:
+        if not isinstance(operations, list) or not operations:
+            raise BatchError('参数错误')
+        if len(operations) > current_app.config.get('BATCH_MAX_OPERATIONS', 100):
+            raise BatchError('操作数量超过上限')
+        try:
+            results = []
+            with db.session.no_autoflush:
+                for index, operation in enumerate(operations):
+                    try:
+                        results.append(self.apply(operation))
+                    except ValueError as e:
+                        raise BatchError(str(e), index)
+            db.session.flush()
+            if self.books:
+                db.session.execute(update(UserBook).where(
+                    UserBook.user_id == self.user_id, UserBook.book_id.in_([i.id for i in self.books])).values(permission=7))
+            ret = [{'status': 204} if obj is None else {'status': status, 'data': obj._get()} for status, obj in results]
+            db.session.commit()
+            for book_id in self.purges:  # 删除的账本与DELETE /v1/book/<id>一样由后台任务清理
+                try:
+                    Job.enqueue('purge_book', self.user_id, book_id=book_id)
+                except RedisError:  # 已提交，清理任务留给 flask purge-books 补交
+                    current_app.logger.warning('purge_book %d not queued', book_id, exc_info=True)
+        except BatchError:
+            db.session.rollback()
+            raise
+        except SQLAlchemyError:
+            db.session.rollback()
+            current_app.logger.warning('batch failed', exc_info=True)
+            raise BatchError('数据写入失败')
+        return ret
+
+    def apply(self, operation: dict) -> tuple[int, object]:
+        if not isinstance(operation, dict):
+            raise ValueError('操作格式错误')
+        op, type = operation.get('op'), operation.get('type')
+        if type not in RESOURCES:
+            raise ValueError('不支持的资源类型')
+        model, fields, create_fields, missing = RESOURCES[type]
+        data = operation.get('data') or {}
+        if not isinstance(data, dict):
+            raise ValueError('data格式错误')
+        data = {to_snake(k): self.resolve(v) for k, v in data.items()}
+        allowed = fields + create_fields if op == 'create' else fields
+        if not set(data) <= set(allowed):
+            raise ValueError('不支持的字段: %s' % ','.join(sorted(set(data) - set(allowed))))
+        if type in ('category', 'tag'):
+            self.importers.clear()
+        if op == 'create':
+            obj = getattr(self, 'create_' + type)(model, data)
+            if operation.get('ref'):
+                self.refs[str(operation['ref'])] = obj
+            return 201, obj
+        obj = db.session.get(model, self.resolve(operation.get('id')))
+        if obj is None or (model is Book and obj.state == BOOK_DELETED):
+            raise ValueError(missing)
+        if op == 'delete' and model is Book:
+            obj.state = BOOK_DELETED
+            self.purges.append(obj.id)
+            return 204, None
+        if op == 'delete':
+            obj._del(commit=False)
+            return 204, None
+        if op != 'update':
+            raise ValueError('不支持的操作: %s' % op)
+        if type == 'tally':
+            self.set_tally(obj, {'amount': obj.amount, 'record_timestamp': obj.record_timestamp, 'category_id': obj.category_id,
+                                 'account_id': obj.account_id, 'remark': obj.remark, 'tag_ids': [i.id for i in obj.tags], **data})
+        else:
+            obj._set(data, commit=False)
+        return 200, obj
+
+    def resolve(self, value):
+        '''把`"@ref"`替换为本批次中新建对象的id'''
+        if isinstance(value, list):
+            return [self.resolve(i) for i in value]
+        if isinstance(value, str) and value.startswith('@'):
+            obj = self.refs.get(value[1:])
+            if obj is None:
+                raise ValueError('引用不存在: %s' % value)
+            if obj.id is None:
+                db.session.flush()
+            return obj.id
+        return value
+
+    def create_book(self, model, data: dict) -> Book:
+        book = Book()._set(data, commit=False)
+        if self.user is None:
+            self.user = db.session.get(User, self.user_id)
+        self.user.books.append(book)
+        self.books.append(book)
+        return book
+
+    def create_account(self, model, data: dict) -> Account:
+        return Account(user_id=self.user_id)._set(data, commit=False)
+
+    def create_category(self, model, data: dict):
+        book_id = data.pop('book_id', None)
+        if data.get('pid') is None:
+            book = db.session.get(Book, book_id) if book_id else None
+            if book is None or book.state == BOOK_DELETED:
+                raise ValueError('账本不存在')
+        obj = model()._set(data, commit=False)
+        if data.get('pid') is None:
+            (book.categories if model is Category else book.tags).append(obj)
+        return obj
+
+    create_tag = create_category
+
+    def create_tally(self, model, data: dict) -> Tally:
+        tally = Tally(book_id=data.get('book_id'))
+        self.set_tally(tally, data)
+        db.session.add(tally)
+        return tally
+
+    def set_tally(self, tally: Tally, data: dict):
+        book_id = tally.book_id
+        if book_id not in self.importers:
+            book = db.session.get(Book, book_id) if book_id is not None else None
+            if book is None or book.state == BOOK_DELETED:
+                raise ValueError('账本不存在')
+            self.importers[book_id] = TallyImporter(book_id)
+        row = self.importers[book_id].parse(data)
+        for k in ('amount', 'record_timestamp', 'category_id', 'account_id', 'remark'):
+            setattr(tally, k, row[k])
+        tally.tags = db.session.scalars(select(Tag).where(Tag.id.in_(row['tag_ids']))).all() if row['tag_ids'] else []
@@ -0,0 +1,56 @@
+from decimal import Decimal
+from flask import current_app
+from redis import RedisError
+from sqlalchemy import func
+from . import db, primary, Book, Category, Cache
+from .rollup import TallyRollup, PERIODS, period_bucket
+from .version import Version
+import time
+
+EXPENSE = -1  # 支出分类类型
+UNIT = 10000  # 合计以万分之一元为单位存为整数，与DECIMAL(13, 4)一致
+BUDGET_KEY = 'cashbook:budget:%s:%s:%s:%s'  # book_id, period, bucket, version
+
+
+class Budget:
+    '''账本预算消费
+
+    周期内的支出合计从汇总表求和，按账本的`book:<id>`(分类类型、预算配置)及`tallies:<id>`(记账记录)版本号
+    缓存在Redis中，查询预算余额为O(1)。版本号在写入提交后才失效，提交前读出的旧合计只会写到旧版本号的key，
+    不会覆盖提交后的合计。
+    '''
+    @staticmethod
+    def status(book: Book) -> dict:
+        configure = book.configure
+        period = configure.period if configure and configure.period in PERIODS else 'month'
+        budget = configure.budget if configure else None
+        bucket = period_bucket(period, int(time.time()))
+        spent = Budget.spent(book.id, period, bucket)
+        return {
+            'period': period,
+            'bucket': bucket,
+            'budget': None if budget is None else str(budget),
+            'spent': str(spent),
+            'remaining': None if budget is None else str(budget - spent),
+        }
+
+    @staticmethod
+    def spent(book_id: int, period: str, bucket: int) -> Decimal:
+        '''周期内的支出合计'''
+        try:
+            key = BUDGET_KEY % (book_id, period, bucket, '-'.join(Version.get(i % book_id) for i in ('book:%d', 'tallies:%d')))
+            units = Cache().get(key)
+        except RedisError:
+            key = units = None
+        if units is None:
+            with primary(db.session):  # 读库可能落后，新版本号下只缓存主库的数据
+                amount = db.session.query(func.sum(TallyRollup.amount)).join(Category, Category.id == TallyRollup.category_id).filter(
+                    TallyRollup.book_id == book_id, TallyRollup.period == period, TallyRollup.bucket == bucket,
+                    Category.type == EXPENSE).scalar() or 0
+            units = int(Decimal(amount) * UNIT)
+            if key is not None:
+                try:
+                    Cache().set(key, units, ex=current_app.config.get('BUDGET_CACHE_TTL', 3600))
+                except RedisError:
+                    pass
+        return (Decimal(int(units)) / UNIT).quantize(Decimal('0.0001'))
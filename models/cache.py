@@ -0,0 +1,276 @@
+from flask import current_app, has_app_context
+from redis import ConnectionPool, StrictRedis
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from collections import defaultdict, deque
+from threading import Condition, RLock
+from utils import LRUCache
+import math
+import time
+
+# Redis连接参数默认值，可在配置`REDIS_CONFIG`中覆盖
+REDIS_CONFIG = {
+    'host': '172.17.0.1',
+    'port': 6379,
+    'db': 0,
+    'socket_connect_timeout': 1,
+}
+
+# 令牌桶：按Redis时间补充令牌后取`cost`个，返回还需等待的秒数(0为取到)；ARGV: 每秒令牌数, 桶容量, cost
+TOKEN_BUCKET = '''
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = t[1] + t[2] / 1000000
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = math.min(burst, (tonumber(bucket[1]) or burst) + math.max(0, now - (tonumber(bucket[2]) or now)) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+'''
+
+
+class RedisUnavailable(RedisConnectionError):
+    '''Redis熔断期间直接抛出，不发起连接'''
+
+
+class RedisBackend:
+    '''Redis缓存后端，进程内共享一个连接池
+
+    连接失败或超时后`retry_seconds`秒内不再连接Redis，直接抛出`RedisUnavailable`，
+    调用方按原有的RedisError处理退回本地，不必每个请求都等一次连接超时。
+    '''
+    def __init__(self, config: dict, retry_seconds: float = 5) -> None:
+        self.redis = StrictRedis(connection_pool=ConnectionPool(**{**REDIS_CONFIG, **config, 'decode_responses': True}))
+        self.token_bucket_script = self.redis.register_script(TOKEN_BUCKET)
+        self.retry_seconds = retry_seconds
+        self.down_until = 0.0
+
+    def call(self, func, *args, **kwargs):
+        '''执行一次Redis操作，熔断期间直接失败，连接失败或超时时开始熔断'''
+        if time.monotonic() < self.down_until:
+            raise RedisUnavailable('Redis不可用，%.0f秒后重试' % (self.down_until - time.monotonic()))
+        try:
+            return func(*args, **kwargs)
+        except (RedisConnectionError, RedisTimeoutError):
+            self.down_until = time.monotonic() + self.retry_seconds
+            raise
+
+    def get(self, key: str):
+        return self.call(self.redis.get, key)
+
+    def set(self, key: str, value, ex: int = None, nx: bool = False):
+        return self.call(self.redis.set, key, value, ex=ex, nx=nx)
+
+    def delete(self, *keys: str):
+        return self.call(self.redis.delete, *keys) if keys else 0
+
+    def incr(self, key: str, amount: int = 1):
+        return self.call(self.redis.incr, key, amount)
+
+    def mget(self, keys: list) -> list:
+        return self.call(self.redis.mget, keys) if keys else []
+
+    def hgetall(self, key: str) -> dict:
+        return self.call(self.redis.hgetall, key)
+
+    def take(self, key: str, rate: float, burst: int, cost: int = 1) -> float:
+        return float(self.call(self.token_bucket_script, keys=[key], args=[rate, burst, cost]))
+
+    def lpush(self, key: str, *values):
+        return self.call(self.redis.lpush, key, *values)
+
+    def brpop(self, key: str, timeout: int = 0):
+        item = self.call(self.redis.brpop, key, timeout)
+        return None if item is None else item[1]
+
+    def pipeline(self) -> 'RedisPipeline':
+        return RedisPipeline(self)
+
+
+class RedisPipeline:
+    '''Redis管道，命令在`execute`时一次发送'''
+    def __init__(self, backend: RedisBackend) -> None:
+        self.backend = backend
+        self.pipe = backend.redis.pipeline(transaction=False)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.pipe.reset()
+
+    def get(self, key: str):
+        self.pipe.get(key)
+
+    def set(self, key: str, value, ex: int = None, nx: bool = False):
+        self.pipe.set(key, value, ex=ex, nx=nx)
+
+    def delete(self, *keys: str):
+        self.pipe.delete(*keys)
+
+    def incr(self, key: str, amount: int = 1):
+        self.pipe.incr(key, amount)
+
+    def hincrbyfloat(self, key: str, field: str, amount: float = 1.0):
+        self.pipe.hincrbyfloat(key, field, amount)
+
+    def execute(self) -> list:
+        return self.backend.call(self.pipe.execute)
+
+
+class MemoryBackend:
+    '''进程内缓存后端，接口与`RedisBackend`一致，按TTL过期并按LRU淘汰，无需Redis服务'''
+    def __init__(self, maxsize: int = 10000) -> None:
+        self.data = LRUCache(maxsize=maxsize)
+        self.lock = RLock()
+        self.lists = defaultdict(deque)  # 列表不参与LRU淘汰
+        self.pushed = Condition(self.lock)
+
+    def get(self, key: str):
+        return self.data.get(key)
+
+    def set(self, key: str, value, ex: int = None, nx: bool = False):
+        with self.lock:
+            if nx and self.data.get(key) is not None:
+                return None
+            exat = None if ex is None else time.time() + ex
+            return self.data.set(key, value if isinstance(value, str) else str(value), exat=exat)
+
+    def delete(self, *keys: str):
+        with self.lock:
+            return sum(self.data.pop(k) is not None for k in keys)
+
+    def incr(self, key: str, amount: int = 1):
+        with self.lock:
+            value = int(self.data.get(key, 0)) + amount
+            self.data.set(key, str(value), exat=self.data.expire_at(key))
+            return value
+
+    def mget(self, keys: list) -> list:
+        return [self.data.get(k) for k in keys]
+
+    def hincrbyfloat(self, key: str, field: str, amount: float = 1.0):
+        with self.lock:
+            hash = self.data.get(key)
+            if hash is None:
+                hash = {}
+                self.data.set(key, hash)
+            hash[field] = repr(float(hash.get(field, 0)) + amount)
+            return hash[field]
+
+    def hgetall(self, key: str) -> dict:
+        with self.lock:
+            return dict(self.data.get(key) or {})
+
+    def take(self, key: str, rate: float, burst: int, cost: int = 1) -> float:
+        with self.lock:
+            now = time.time()
+            tokens, ts = self.data.get(key) or (burst, now)
+            tokens = min(burst, tokens + max(0, now - ts) * rate)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / rate
+            self.data.set(key, (tokens - cost if not wait else tokens, now), exat=now + math.ceil(burst / rate) + 1)
+            return wait
+
+    def lpush(self, key: str, *values):
+        with self.lock:
+            self.lists[key].extendleft(values)
+            self.pushed.notify(len(values))
+            return len(self.lists[key])
+
+    def brpop(self, key: str, timeout: int = 0):
+        with self.lock:
+            if not self.pushed.wait_for(lambda: self.lists[key], timeout or None):
+                return None
+            return self.lists[key].pop()
+
+    def pipeline(self) -> 'MemoryPipeline':
+        return MemoryPipeline(self)
+
+
+class MemoryPipeline:
+    '''进程内管道，命令在`execute`时持锁依次执行'''
+    def __init__(self, backend: MemoryBackend) -> None:
+        self.backend = backend
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.commands.clear()
+
+    def __getattr__(self, name: str):
+        if name not in ('get', 'set', 'delete', 'incr', 'hincrbyfloat'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self) -> list:
+        with self.backend.lock:
+            ret = [getattr(self.backend, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        self.commands.clear()
+        return ret
+
+
+class Cache:
+    '''缓存
+
+    后端由配置`CACHE_BACKEND`指定：`redis`(默认，连接参数`REDIS_CONFIG`，连不上后`REDIS_RETRY_SECONDS`秒内不再重试)或`memory`(进程内，容量`CACHE_MEMORY_SIZE`)，
+    每个进程只创建一次后端及其连接池。
+    '''
+    __backend = None
+
+    def __init__(self) -> None:
+        if Cache.__backend is None:
+            config = current_app.config if has_app_context() else {}
+            if config.get('CACHE_BACKEND', 'redis') == 'memory':
+                Cache.__backend = MemoryBackend(config.get('CACHE_MEMORY_SIZE', 10000))
+            else:
+                Cache.__backend = RedisBackend(config.get('REDIS_CONFIG', {}), config.get('REDIS_RETRY_SECONDS', 5))
+        self.backend = Cache.__backend
+
+    @staticmethod
+    def reset():
+        '''丢弃当前后端，下次使用时按配置重新创建'''
+        Cache.__backend = None
+
+    def get(self, key: str):
+        return self.backend.get(key)
+
+    def set(self, key: str, value='', ex=300, nx: bool = False):
+        return self.backend.set(key, value, ex=ex, nx=nx)
+
+    def delete(self, *keys: str):
+        return self.backend.delete(*keys)
+
+    def incr(self, key: str, amount: int = 1):
+        return self.backend.incr(key, amount)
+
+    def mget(self, keys: list) -> list:
+        '''批量读取，返回与`keys`顺序一致的值列表'''
+        return self.backend.mget(list(keys))
+
+    def hgetall(self, key: str) -> dict:
+        return self.backend.hgetall(key)
+
+    def take(self, key: str, rate: float, burst: int, cost: int = 1) -> float:
+        '''令牌桶：每秒补充`rate`个、最多`burst`个，取`cost`个，返回还需等待的秒数(0为取到)'''
+        return self.backend.take(key, rate, burst, cost)
+
+    def lpush(self, key: str, *values):
+        return self.backend.lpush(key, *values)
+
+    def brpop(self, key: str, timeout: int = 0):
+        '''从列表右端取出一项，列表为空时最多等待`timeout`秒(0为一直等待)，超时返回None'''
+        return self.backend.brpop(key, timeout)
+
+    def mset(self, mapping: dict, ex=300):
+        '''批量写入，一次往返完成'''
+        with self.pipeline() as pipe:
+            for k, v in mapping.items():
+                pipe.set(k, v, ex=ex)
+            return pipe.execute()
+
+    def pipeline(self):
+        '''管道，命令在`execute()`时一次执行'''
+        return self.backend.pipeline()
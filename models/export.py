@@ -0,0 +1,87 @@
+from collections import defaultdict
+from datetime import datetime
+from flask import current_app
+from sqlalchemy import select
+from utils import keyset_chunks
+from . import db, book_tree, Account, Category, Tag, Tally, BookAccount, TallyTag
+import time
+
+TYPES = {1: '收入', -1: '支出', 0: '不计收支'}
+SLOT = 900  # 时区偏移及夏令时切换都在15分钟边界上，同一时间片内只格式化一次
+
+
+class TallyExport:
+    '''账本账单导出
+
+    记账记录按(记录时间, id)的键集分批读取，每批是一次取完的带LIMIT的查询，只取列不生成ORM对象；
+    分类、资金账户、标签名预先查出账本的全部节点作为对照表，每批只查一次本批记录的标签关联，内存占用与总行数无关。
+    '''
+    HEADER = ['时间', '类型', '分类', '金额', '资金账户', '标签', '备注']
+
+    def __init__(self, book_id: int, start: int = None, end: int = None, chunk_size: int = None) -> None:
+        self.book_id, self.start, self.end = book_id, start, end
+        self.chunk_size = chunk_size or current_app.config.get('EXPORT_CHUNK_SIZE', 2000)
+        self.count, self.seconds = 0, 0.0
+        self._slot = None
+
+    def lookups(self) -> tuple[dict, dict, dict]:
+        '''{分类id: (名称, 类型)}、{资金账户id: 名称}、{标签id: 名称}'''
+        categories = {id: (name, type) for id, name, type in db.session.execute(
+            select(Category.id, Category.name, Category.type).where(Category.id.in_(select(book_tree(Category, self.book_id).c.id))))}
+        accounts = dict(db.session.execute(select(Account.id, Account.name).join(
+            BookAccount, BookAccount.account_id == Account.id).where(BookAccount.book_id == self.book_id)).all())
+        tags = dict(db.session.execute(select(Tag.id, Tag.name).where(Tag.id.in_(select(book_tree(Tag, self.book_id).c.id)))).all())
+        return categories, accounts, tags
+
+    def chunks(self):
+        '''按记录时间顺序逐批生成行(`HEADER`各列)，结束后`count`、`seconds`为导出的行数及耗时'''
+        begin = time.perf_counter()
+        categories, accounts, tags = self.lookups()
+        query = db.session.query(Tally.id, Tally.record_timestamp, Tally.amount, Tally.category_id, Tally.account_id, Tally.remark).filter(
+            Tally.book_id == self.book_id)
+        if self.start is not None:
+            query = query.filter(Tally.record_timestamp >= self.start)
+        if self.end is not None:
+            query = query.filter(Tally.record_timestamp <= self.end)
+        query = query.order_by(Tally.record_timestamp, Tally.id)
+        for rows in keyset_chunks(query, (Tally.record_timestamp, Tally.id), chunk_size=self.chunk_size):
+            links = db.session.execute(select(TallyTag.tally_id, TallyTag.tag_id).where(TallyTag.tally_id.in_([i[0] for i in rows]))).all()
+            self._fill(rows, links, categories, accounts, tags)
+            names = defaultdict(list)
+            for tally_id, tag_id in links:
+                names[tally_id].append(tags.get(tag_id, ''))
+            chunk = []
+            for id, record_timestamp, amount, category_id, account_id, remark in rows:
+                name, type = categories.get(category_id, ('', 0))
+                chunk.append([self._format(record_timestamp), TYPES.get(type, ''), name,
+                              amount, accounts.get(account_id, ''), ' '.join(names[id]), remark or ''])
+            self.count += len(chunk)
+            yield chunk
+        self.seconds = time.perf_counter() - begin
+        current_app.logger.info('export book %d: %d rows in %.2fs, %.0f rows/s', self.book_id, self.count, self.seconds, self.rate)
+
+    def _format(self, timestamp: int) -> str:
+        '''记录时间(服务器本地时区)，记录按时间排序，缓存当前时间片的日期及小时'''
+        slot, offset = divmod(timestamp, SLOT)
+        if slot != self._slot:
+            d = datetime.fromtimestamp(slot * SLOT)
+            self._slot, self._prefix, self._minute = slot, d.strftime('%Y-%m-%d %H:'), d.minute
+        return '%s%02d:%02d' % (self._prefix, self._minute + offset // 60, offset % 60)
+
+    @property
+    def rate(self) -> float:
+        '''每秒导出的行数'''
+        return self.count / self.seconds if self.seconds else 0.0
+
+    @staticmethod
+    def _fill(rows, links, categories: dict, accounts: dict, tags: dict):
+        '''记录引用了不在账本下的分类、资金账户、标签(如已解除关联)时补查名称'''
+        for lookup, missing, query in (
+            (categories, {i[3] for i in rows}, lambda ids: ((id, (name, type)) for id, name, type in db.session.execute(
+                select(Category.id, Category.name, Category.type).where(Category.id.in_(ids))))),
+            (accounts, {i[4] for i in rows}, lambda ids: db.session.execute(select(Account.id, Account.name).where(Account.id.in_(ids))).all()),
+            (tags, {i[1] for i in links}, lambda ids: db.session.execute(select(Tag.id, Tag.name).where(Tag.id.in_(ids))).all()),
+        ):
+            missing -= set(lookup) | {None}
+            if missing:
+                lookup.update(query(missing))
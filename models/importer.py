@@ -0,0 +1,144 @@
+from decimal import Decimal, InvalidOperation
+from sqlalchemy import select, insert, update, bindparam, text
+from . import db, Category, Tag, Tally, TallyTag, BookAccount, book_tree, to_snake
+from .rollup import TallyDelta, apply_tally_deltas
+from .balance import BalanceDelta, apply_balance_deltas
+from .sync import log_inserted_tallies
+from .search import index_tallies
+import uuid
+
+MAX_AMOUNT = Decimal('999999999.9999')  # DECIMAL(13, 4)
+
+
+class TallyImporter:
+    '''批量导入记账记录
+
+    分类、资金账户、标签按账本各一次查询校验，合法的记录按`batch_size`条一组
+    以一条多行INSERT写入并取得各自的id(见`insert_tallies`)，
+    全部在同一事务中提交，不合法的记录逐条返回原因。
+
+    每条记录的字段：`amount`, `recordTimestamp`, `categoryId`, `accountId`, `remark`, `tagIds`(列表或以`;`分隔)
+    '''
+    def __init__(self, book_id: int, batch_size: int = 1000) -> None:
+        self.book_id = book_id
+        self.batch_size = batch_size
+        self.categories = set(db.session.scalars(select(book_tree(Category, book_id).c.id)))
+        self.accounts = set(db.session.scalars(select(BookAccount.account_id).where(BookAccount.book_id == book_id)))
+        self.tags = set(db.session.scalars(select(book_tree(Tag, book_id).c.id)))
+        self.statements = {}  # 行数 -> 多行INSERT语句
+
+    def run(self, rows) -> dict:
+        inserted, rejected, batch = 0, [], []
+        for index, row in enumerate(rows):
+            try:
+                batch.append(self.parse(row))
+            except ValueError as e:
+                rejected.append({'row': index, 'error': str(e)})
+                continue
+            if len(batch) >= self.batch_size:
+                inserted += self.insert(batch)
+                batch = []
+        if batch:
+            inserted += self.insert(batch)
+        db.session.commit()
+        return {'inserted': inserted, 'rejected': rejected}
+
+    def parse(self, row: dict) -> dict:
+        '''校验并转换一条记录，不合法时抛出ValueError'''
+        if not isinstance(row, dict):
+            raise ValueError('记录格式错误')
+        row = {to_snake(k): v for k, v in row.items() if v not in (None, '')}
+        try:
+            amount = Decimal(str(row.get('amount')))
+        except InvalidOperation:
+            raise ValueError('金额无效')
+        if not amount.is_finite() or amount < 0 or amount > MAX_AMOUNT:  # 收支方向由分类类型决定
+            raise ValueError('金额无效')
+        try:
+            record_timestamp = int(row.get('record_timestamp'))
+        except (TypeError, ValueError):
+            raise ValueError('记录时间无效')
+        try:
+            category_id = int(row.get('category_id'))
+        except (TypeError, ValueError):
+            raise ValueError('分类无效')
+        if category_id not in self.categories:
+            raise ValueError('分类不属于该账本')
+        account_id = row.get('account_id')
+        if account_id is not None:
+            try:
+                account_id = int(account_id)
+            except (TypeError, ValueError):
+                raise ValueError('资金账户无效')
+            if account_id not in self.accounts:
+                raise ValueError('资金账户不属于该账本')
+        tag_ids = row.get('tag_ids') or []
+        if isinstance(tag_ids, str):
+            tag_ids = [i for i in tag_ids.split(';') if i.strip()]
+        try:
+            tag_ids = {int(i) for i in tag_ids}
+        except (TypeError, ValueError):
+            raise ValueError('标签无效')
+        if not tag_ids <= self.tags:
+            raise ValueError('标签不属于该账本')
+        remark = row.get('remark')
+        if remark is not None and len(str(remark)) > 255:
+            raise ValueError('备注过长')
+        return {
+            'book_id': self.book_id,
+            'amount': amount,
+            'record_timestamp': record_timestamp,
+            'category_id': category_id,
+            'account_id': account_id,
+            'remark': None if remark is None else str(remark),
+            'tag_ids': tag_ids,
+        }
+
+    def insert(self, batch: list[dict]) -> int:
+        '''写入一组记录及其标签关联，变更日志、搜索索引按本组写入的id记录'''
+        conn = db.session.connection()
+        ids = self.insert_tallies(conn, [{k: v for k, v in i.items() if k != 'tag_ids'} for i in batch])
+        links = [{'tally_id': id, 'tag_id': tag_id} for id, i in zip(ids, batch) for tag_id in i['tag_ids']]
+        if links:
+            conn.execute(insert(TallyTag.__table__), links)
+        log_inserted_tallies(db.session, self.book_id, ids)
+        index_tallies(db.session, ids, replace=False)
+        apply_tally_deltas(db.session, [
+            TallyDelta(i['book_id'], i['category_id'], i['record_timestamp'], i['amount'], 1) for i in batch])
+        apply_balance_deltas(db.session, [BalanceDelta(i['account_id'], i['category_id'], i['amount'], 1) for i in batch])
+        return len(batch)
+
+    def insert_tallies(self, conn, values: list[dict]) -> list[int]:
+        '''以一条多行INSERT写入记账记录，返回与`values`顺序一致的id
+
+        同一条INSERT分配的自增id随行的顺序递增(SQLite、InnoDB，与自增锁模式无关)：支持RETURNING的数据库
+        (SQLite、MariaDB)取回本条语句的id排序即可；MySQL给本组记录写上随机的`import_token`，写入后按它查出id再清除。
+        都不按写入前后的最大id推算，并发写入的记录不会混进本组。
+        '''
+        table = Tally.__table__
+        returning = conn.dialect.insert_returning
+        token = None if returning else uuid.uuid4().hex
+        params = {'%s_%d' % (k, n): v for n, i in enumerate(values) for k, v in {**i, 'import_token': token}.items()}
+        result = conn.execute(self.statement(conn, len(values), returning), params)
+        if returning:
+            return sorted(result.scalars())
+        marked = (table.c.book_id == self.book_id) & (table.c.import_token == token)
+        ids = conn.scalars(select(table.c.id).where(marked).order_by(table.c.id)).all()
+        conn.execute(update(table).where(marked).values(import_token=None))
+        return ids
+
+    def statement(self, conn, rows: int, returning: bool):
+        '''`rows`行的多行INSERT，参数名为`<列名>_<行号>`
+
+        多行VALUES的Insert对象不进SQLAlchemy的编译缓存，每批都要重新编译上千个参数，这里写成`text()`，
+        同样行数的批次共用语句，只编译一次。
+        '''
+        if rows not in self.statements:
+            table, quote = Tally.__table__, conn.dialect.identifier_preparer.quote
+            keys = ('book_id', 'amount', 'record_timestamp', 'category_id', 'account_id', 'remark', 'import_token')
+            sql = 'INSERT INTO %s (%s) VALUES %s' % (quote(table.name), ', '.join(quote(k) for k in keys),
+                                                    ', '.join('(%s)' % ', '.join(':%s_%d' % (k, n) for k in keys) for n in range(rows)))
+            if returning:
+                sql += ' RETURNING %s' % quote('id')
+            self.statements[rows] = text(sql).bindparams(*[bindparam('%s_%d' % (k, n), type_=table.c[k].type) for n in range(rows) for k in keys])
+        return self.statements[rows]
@@ -0,0 +1,173 @@
+from flask import current_app
+from redis import RedisError
+from sqlalchemy import select, delete, func
+from threading import Thread, Lock
+from . import db, Cache, BOOK_DELETED, Book, BookConfigure, BookAccount, BookCategory, BookTag, UserBook, Category, Tag, Tally, TallyTag, book_tree
+from .rollup import TallyRollup
+from .balance import subtract_tallies
+from .search import TallyTerm
+from .importer import TallyImporter
+import json
+import os
+import time
+import uuid
+
+JOB_KEY = 'cashbook:job:%s'  # id -> 任务状态JSON
+QUEUE_KEY = 'cashbook:jobs'  # 待执行任务的列表，左进右出
+
+
+class Job:
+    '''后台任务
+
+    `Job.enqueue(name, user_id, **kwargs)`记录任务状态后放入队列，立即返回；执行者是每个Web进程内的
+    `JOB_WORKER_THREADS`个线程(收到第一个请求时启动)，或单独运行的`flask worker`进程(此时可把线程数设为0)。
+    任务函数以`@Job.register(name)`注册，参数为`progress(done, total)`及入队时的`kwargs`，返回值为任务结果；
+    任务状态保留`JOB_TTL`秒，由`GET /v1/jobs/<id>`查询。
+    '''
+    handlers = {}
+    __lock = Lock()
+    __threads = (None, [])  # (进程号, 线程)，fork出的worker进程重新启动线程
+
+    @classmethod
+    def register(cls, name: str):
+        def decorator(func):
+            cls.handlers[name] = func
+            return func
+        return decorator
+
+    @classmethod
+    def enqueue(cls, name: str, user_id: int = None, **kwargs) -> dict:
+        now = int(time.time())
+        job = {'id': uuid.uuid4().hex, 'name': name, 'userId': user_id, 'status': 'queued', 'progress': None,
+               'result': None, 'error': None, 'created': now, 'updated': now}
+        cls.save(job)
+        Cache().lpush(QUEUE_KEY, json.dumps({'id': job['id'], 'name': name, 'kwargs': kwargs}, default=str))
+        cls.start_threads()
+        return job
+
+    @staticmethod
+    def get(id: str) -> dict | None:
+        value = Cache().get(JOB_KEY % id)
+        return None if value is None else json.loads(value)
+
+    @staticmethod
+    def save(job: dict):
+        job['updated'] = int(time.time())
+        Cache().set(JOB_KEY % job['id'], json.dumps(job, default=str), ex=current_app.config.get('JOB_TTL', 86400))
+
+    @classmethod
+    def run(cls, task: dict):
+        '''执行出队的任务，异常时回滚并记为失败'''
+        job = cls.get(task['id']) or {'id': task['id'], 'name': task['name'], 'userId': None, 'created': int(time.time())}
+        job.update(status='running', progress=None, error=None)
+        cls.save(job)
+
+        def progress(done: int, total: int = None):
+            job['progress'] = {'done': done, 'total': total}
+            cls.save(job)
+
+        try:
+            handler = cls.handlers.get(task['name'])
+            if handler is None:
+                raise ValueError('未知的任务: %s' % task['name'])
+            job['result'] = handler(progress, **task['kwargs'])
+            job['status'] = 'done'
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.exception('job %s %s failed', task['name'], task['id'])
+            job.update(status='failed', error=str(e))
+        finally:
+            db.session.remove()
+        cls.save(job)
+
+    @classmethod
+    def work(cls, timeout: int = 5, stop=None):
+        '''循环取出任务执行，`stop()`为真时退出'''
+        while stop is None or not stop():
+            try:
+                value = Cache().brpop(QUEUE_KEY, timeout)
+            except RedisError:
+                current_app.logger.warning('job queue unavailable', exc_info=True)
+                time.sleep(timeout)
+                continue
+            if value is not None:
+                cls.run(json.loads(value))
+
+    @classmethod
+    def start_threads(cls):
+        count = current_app.config.get('JOB_WORKER_THREADS', 1)
+        if not count or cls.__threads[0] == os.getpid():
+            return
+        app = current_app._get_current_object()
+        with cls.__lock:
+            if cls.__threads[0] == os.getpid():
+                return
+            def target():
+                with app.app_context():
+                    cls.work()
+            threads = [Thread(target=target, name='job-worker-%d' % i, daemon=True) for i in range(count)]
+            for i in threads:
+                i.start()
+            cls.__threads = (os.getpid(), threads)
+
+
+@Job.register('purge_book')
+def purge_book(progress, book_id: int) -> dict:
+    '''清理已删除的账本：分批删除记账记录(同时从资金账户余额中减去)及其索引，再删除汇总、分类、标签及关联，每批单独提交'''
+    book = db.session.get(Book, book_id)
+    if book is None:
+        return {'tallies': 0}
+    if book.state != BOOK_DELETED:
+        raise ValueError('账本未删除')
+    chunk = current_app.config.get('JOB_CHUNK_SIZE', 1000)
+    total = db.session.scalar(select(func.count(Tally.id)).where(Tally.book_id == book_id))
+    done = 0
+    progress(done, total)
+    while True:
+        ids = db.session.scalars(select(Tally.id).where(Tally.book_id == book_id).limit(chunk)).all()
+        if not ids:
+            break
+        subtract_tallies(db.session, Tally.id.in_(ids))
+        db.session.execute(delete(TallyTag).where(TallyTag.tally_id.in_(ids)))
+        db.session.execute(delete(TallyTerm).where(TallyTerm.tally_id.in_(ids)))
+        db.session.execute(delete(Tally).where(Tally.id.in_(ids)), execution_options={'synchronize_session': False})
+        db.session.commit()
+        done += len(ids)
+        progress(done, total)
+    db.session.execute(delete(TallyRollup).where(TallyRollup.book_id == book_id))
+    for model, assoc in ((Category, BookCategory), (Tag, BookTag)):
+        ids = db.session.scalars(select(book_tree(model, book_id).c.id)).all()
+        db.session.execute(delete(assoc).where(assoc.book_id == book_id))
+        for i in range(0, len(ids), chunk):
+            db.session.execute(delete(model).where(model.id.in_(ids[i:i + chunk])), execution_options={'synchronize_session': False})
+    for model in (BookAccount, UserBook, BookConfigure):
+        db.session.execute(delete(model).where(model.book_id == book_id))
+    db.session.execute(delete(Book).where(Book.id == book_id), execution_options={'synchronize_session': False})
+    db.session.commit()
+    return {'tallies': done}
+
+
+@Job.register('rebuild_rollups')
+def rebuild_rollups(progress, book_ids: list = None) -> dict:
+    book_ids = book_ids or db.session.scalars(select(Book.id).where(Book.state != BOOK_DELETED)).all()
+    total = 0
+    for index, book_id in enumerate(book_ids):
+        total += TallyRollup.rebuild([book_id])
+        progress(index + 1, len(book_ids))
+    return {'books': len(book_ids), 'rows': total}
+
+
+@Job.register('import_tallies')
+def import_tallies(progress, book_id: int, rows: list) -> dict:
+    book = db.session.get(Book, book_id)
+    if book is None or book.state == BOOK_DELETED:
+        raise ValueError('账本不存在')
+    progress(0, len(rows))
+    result = TallyImporter(book_id, current_app.config.get('IMPORT_BATCH_SIZE', 1000)).run(rows)
+    progress(len(rows), len(rows))
+    return result
+
+
+@Job.register('reindex_search')
+def reindex_search(progress, category_ids: list = (), tag_ids: list = ()) -> dict:
+    return {'rows': TallyTerm.reindex(category_ids, tag_ids)}
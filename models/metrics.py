@@ -0,0 +1,126 @@
+from collections import defaultdict
+from redis import RedisError
+from threading import Lock
+from utils.metrics import RequestStats
+from . import Cache
+from .profiler import Profiler
+import random
+import time
+
+METRICS_KEY = 'cashbook:metrics'  # hash: 指标名\t标签\t后缀 -> 累计值
+
+HISTOGRAMS = (  # 指标名, 说明, 取值, 分桶上界
+    ('cashbook_request_seconds', '请求总耗时(秒)', lambda i: i.wall, (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)),
+    ('cashbook_request_db_seconds', '请求内SQL执行耗时(秒)', lambda i: i.db, (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)),
+    ('cashbook_request_statements', '请求内执行的SQL条数', lambda i: i.statements, (0, 1, 2, 5, 10, 20, 50, 100, 200)),
+    ('cashbook_request_rows', '请求内读取及写入的行数', lambda i: i.rows, (0, 1, 10, 100, 1000, 10000, 100000)),
+    ('cashbook_response_bytes', '响应体大小(字节)', lambda i: i.size, (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)),
+)
+
+
+class Metrics:
+    '''按接口统计请求的Prometheus指标
+
+    各worker在本地累加，每`METRICS_FLUSH_INTERVAL`秒用一次管道把增量累加到Redis的hash中，
+    `/metrics`读取的是所有worker的合计，gunicorn多进程下也能得到完整的数据。
+
+    配置`SLOW_REQUEST_TRACE`开启后，按`SLOW_REQUEST_SAMPLE_RATE`的比例记录请求内每条SQL，
+    其中耗时超过`SLOW_REQUEST_MS`毫秒的请求把SQL明细写入日志；需要分析的请求交给`Profiler`。
+    '''
+    def __init__(self, app) -> None:
+        self.app = app
+        self.profiler = Profiler(app)
+        self.lock = Lock()
+        self.values = defaultdict(float)
+        self.flushed = time.time()
+
+    def sample(self, environ: dict) -> str | None:
+        '''请求是否记录每条SQL：`profile`为分析，`trace`为慢请求日志'''
+        if self.profiler.enabled(environ):
+            return 'profile'
+        config = self.app.config
+        if config.get('SLOW_REQUEST_TRACE', False) and random.random() < config.get('SLOW_REQUEST_SAMPLE_RATE', 1.0):
+            return 'trace'
+        return None
+
+    def observe(self, stats: RequestStats):
+        endpoint = stats.endpoint or 'unmatched'
+        labels = 'endpoint="%s",method="%s"' % (endpoint, stats.method)
+        with self.lock:
+            self.values['cashbook_requests_total\t%s,status="%d"\t' % (labels, stats.status)] += 1
+            for name, _, value, buckets in HISTOGRAMS:
+                value = value(stats)
+                for le in buckets:
+                    if value <= le:
+                        self.values['%s\t%s,le="%s"\t_bucket' % (name, labels, le)] += 1
+                        break
+                self.values['%s\t%s\t_sum' % (name, labels)] += value
+                self.values['%s\t%s\t_count' % (name, labels)] += 1
+        if stats.trace is not None and stats.wall * 1000 >= self.app.config.get('SLOW_REQUEST_MS', 1000):
+            self.app.logger.warning('slow request %s %s %d %.1fms, db %.1fms, %d statements, %d rows, %d bytes\n%s',
+                stats.method, stats.path, stats.status, stats.wall * 1000, stats.db * 1000, stats.statements, stats.rows, stats.size,
+                '\n'.join('  %.1fms %s %r' % (i[0] * 1000, ' '.join(i[1].split()), i[2]) for i in stats.trace))
+        if stats.sample == 'profile':
+            self.profiler.report(stats)
+        if time.time() - self.flushed >= self.app.config.get('METRICS_FLUSH_INTERVAL', 5):
+            self.flush()
+
+    def flush(self):
+        '''把本地累加的增量写入Redis'''
+        with self.lock:
+            values, self.values = self.values, defaultdict(float)
+            self.flushed = time.time()
+        if not values:
+            return
+        try:
+            with self.app.app_context(), Cache().pipeline() as pipe:
+                for field, value in values.items():
+                    pipe.hincrbyfloat(METRICS_KEY, field, value)
+                pipe.execute()
+        except RedisError:
+            with self.lock:  # 写入失败的增量留在本地，下次再写
+                for field, value in values.items():
+                    self.values[field] += value
+            self.app.logger.warning('flush metrics failed', exc_info=True)
+
+    def render(self) -> str:
+        '''Prometheus文本格式，直方图分桶为累计值；Redis不可用时只输出本worker未写入的本地累计值'''
+        self.flush()
+        try:
+            fields = Cache().hgetall(METRICS_KEY)
+        except RedisError:
+            self.app.logger.warning('read metrics failed, rendering local counters', exc_info=True)
+            with self.lock:
+                fields = dict(self.values)
+        values = defaultdict(dict)
+        for field, value in fields.items():
+            name, labels, suffix = field.split('\t')
+            values[name][(labels, suffix)] = float(value)
+        lines = []
+        if values['cashbook_requests_total']:
+            lines += ['# HELP cashbook_requests_total 请求数', '# TYPE cashbook_requests_total counter']
+            lines += ['cashbook_requests_total{%s} %s' % (labels, _number(v)) for (labels, _), v in sorted(values['cashbook_requests_total'].items())]
+        for name, help, _, buckets in HISTOGRAMS:
+            series = defaultdict(dict)
+            for (labels, suffix), v in values[name].items():
+                if suffix == '_bucket':
+                    labels, le = labels.rsplit(',le=', 1)
+                    series[labels][float(le.strip('"'))] = v
+                else:
+                    series[labels][suffix] = v
+            if not series:
+                continue
+            lines += ['# HELP %s %s' % (name, help), '# TYPE %s histogram' % name]
+            for labels, v in sorted(series.items()):
+                total = 0
+                for le in buckets:
+                    total += v.get(float(le), 0)
+                    lines.append('%s_bucket{%s,le="%s"} %s' % (name, labels, le, _number(total)))
+                lines.append('%s_bucket{%s,le="+Inf"} %s' % (name, labels, _number(v.get('_count', 0))))
+                lines.append('%s_sum{%s} %s' % (name, labels, _number(v.get('_sum', 0))))
+                lines.append('%s_count{%s} %s' % (name, labels, _number(v.get('_count', 0))))
+        return '\n'.join(lines) + '\n'
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if value == int(value) else repr(value)
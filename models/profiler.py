@@ -0,0 +1,153 @@
+from collections import defaultdict, deque
+from logging.handlers import RotatingFileHandler
+from utils.metrics import RequestStats
+from . import db
+import glob
+import json
+import logging
+import os
+import random
+import re
+import time
+
+_IN = re.compile(r'\bIN\s*\(\s*(?:\?|%s|%\(\w+\)s|:\w+)(?:\s*,\s*(?:\?|%s|%\(\w+\)s|:\w+))*\s*\)', re.I)
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PARAM = re.compile(r'%\(\w+\)s|%s|:\w+|\?')
+
+
+def normalize_sql(statement: str) -> str:
+    '''归一化SQL：参数、常量统一为`?`，`IN (?, ?, ...)`统一为`IN (...)`，合并空白'''
+    statement = ' '.join(statement.split())
+    statement = _IN.sub('IN (...)', statement)
+    statement = _PARAM.sub('?', _LITERAL.sub('?', statement))
+    return statement
+
+
+class Profiler:
+    '''按请求分析SQL
+
+    配置`PROFILE_ENABLED`开启后，带请求头`X-Profile: 1`或按`PROFILE_SAMPLE_RATE`抽中的请求记录每条SQL及发起它的代码位置，
+    请求结束后按归一化的SQL分组：同一语句在一个请求内执行超过`PROFILE_N_PLUS_ONE`次的标记为N+1，
+    耗时超过`PROFILE_EXPLAIN_MS`毫秒的SELECT另开连接取执行计划。
+    报告以JSON行写入`PROFILE_LOG`(按worker进程分文件，按大小轮转)，调试模式下最近的报告可在`/debug/profiles`查看，
+    `flask profile`汇总报告文件。
+    '''
+    def __init__(self, app) -> None:
+        self.app = app
+        self.recent = deque(maxlen=app.config.get('PROFILE_KEEP', 100))
+        self.logger = None
+
+    def enabled(self, environ: dict) -> bool:
+        config = self.app.config
+        if not config.get('PROFILE_ENABLED', False):
+            return False
+        return environ.get('HTTP_X_PROFILE') == '1' or random.random() < config.get('PROFILE_SAMPLE_RATE', 0.0)
+
+    def report(self, stats: RequestStats) -> dict:
+        config = self.app.config
+        groups = defaultdict(lambda: {'count': 0, 'ms': 0.0, 'max_ms': 0.0, 'origins': set()})
+        slow = []
+        for elapsed, statement, parameters, origin in stats.trace:
+            group = groups[normalize_sql(statement)]
+            group['count'] += 1
+            group['ms'] += elapsed * 1000
+            group['max_ms'] = max(group['max_ms'], elapsed * 1000)
+            if origin:
+                group['origins'].add(origin)
+            if elapsed * 1000 >= config.get('PROFILE_EXPLAIN_MS', 100):
+                slow.append({'sql': ' '.join(statement.split()), 'ms': round(elapsed * 1000, 3), 'params': _jsonable(parameters),
+                             'plan': self.explain(statement, parameters)})
+        limit = config.get('PROFILE_N_PLUS_ONE', 5)
+        report = {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'method': stats.method,
+            'path': stats.path,
+            'endpoint': stats.endpoint,
+            'status': stats.status,
+            'ms': round(stats.wall * 1000, 3),
+            'db_ms': round(stats.db * 1000, 3),
+            'statements': stats.statements,
+            'rows': stats.rows,
+            'groups': sorted(({'sql': sql, 'count': i['count'], 'ms': round(i['ms'], 3), 'max_ms': round(i['max_ms'], 3),
+                               'origins': sorted(i['origins']), 'n_plus_one': i['count'] > limit} for sql, i in groups.items()),
+                             key=lambda i: -i['ms']),
+            'slow': slow,
+        }
+        self.recent.append(report)
+        self.write(report)
+        return report
+
+    def explain(self, statement: str, parameters) -> list | None:
+        '''另开连接取查询语句的执行计划，不影响请求所用的连接及事务'''
+        if statement.lstrip().split(None, 1)[0].upper() not in ('SELECT', 'WITH') or isinstance(parameters, list):
+            return None
+        try:
+            with self.app.app_context(), db.engine.connect() as conn:
+                prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+                return [_jsonable(dict(i)) for i in conn.exec_driver_sql(prefix + statement, parameters).mappings()]
+        except Exception as e:
+            return [{'error': str(e)}]
+
+    def write(self, report: dict):
+        path = self.app.config.get('PROFILE_LOG')
+        if not path:
+            return
+        if self.logger is None:
+            root, ext = os.path.splitext(path)
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            handler = RotatingFileHandler('%s.%d%s' % (root, os.getpid(), ext or '.log'), encoding='utf-8',
+                maxBytes=self.app.config.get('PROFILE_LOG_BYTES', 10 * 1024 * 1024), backupCount=self.app.config.get('PROFILE_LOG_BACKUPS', 5))
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger = logging.getLogger('cashbook.profile.%d' % os.getpid())
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            self.logger.addHandler(handler)
+        self.logger.info(json.dumps(report, ensure_ascii=False, default=str))
+
+    @staticmethod
+    def summary(paths: list[str], top: int = 20) -> dict:
+        '''汇总报告文件：按归一化的SQL统计总耗时，列出N+1语句及慢语句'''
+        groups = defaultdict(lambda: {'requests': 0, 'count': 0, 'ms': 0.0, 'max_ms': 0.0, 'n_plus_one': 0, 'endpoints': set(), 'origins': set()})
+        requests, slow = 0, []
+        for path in paths:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        report = json.loads(line)
+                    except ValueError:
+                        continue
+                    requests += 1
+                    for i in report['groups']:
+                        group = groups[i['sql']]
+                        group['requests'] += 1
+                        group['count'] += i['count']
+                        group['ms'] += i['ms']
+                        group['max_ms'] = max(group['max_ms'], i['max_ms'])
+                        group['n_plus_one'] += i['n_plus_one']
+                        group['endpoints'].add(report['endpoint'] or report['path'])
+                        group['origins'].update(i['origins'])
+                    slow += [{**i, 'endpoint': report['endpoint']} for i in report['slow']]
+        groups = [{'sql': sql, **i, 'endpoints': sorted(i['endpoints']), 'origins': sorted(i['origins'])} for sql, i in groups.items()]
+        return {
+            'requests': requests,
+            'top': sorted(groups, key=lambda i: -i['ms'])[:top],
+            'n_plus_one': sorted((i for i in groups if i['n_plus_one']), key=lambda i: -i['count'])[:top],
+            'slow': sorted(slow, key=lambda i: -i['ms'])[:top],
+        }
+
+    @staticmethod
+    def files(path: str) -> list[str]:
+        '''`PROFILE_LOG`对应的所有worker的报告文件(含轮转的旧文件)'''
+        root, ext = os.path.splitext(path)
+        return sorted(glob.glob('%s.*%s*' % (root, ext or '.log')))
+
+
+def _jsonable(value):
+    if isinstance(value, dict):
+        return {k: _jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_jsonable(i) for i in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    return str(value)
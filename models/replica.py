@@ -0,0 +1,161 @@
+from contextlib import contextmanager
+from flask import current_app
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from threading import Thread, Lock
+from .cache import Cache
+import os
+import random
+import time
+
+STICKY_KEY = 'cashbook:sticky:%d'  # user_id，写入后一段时间内该用户的读请求走主库
+
+
+class RoutingSession(Session):
+    '''按`info['replica']`把查询路由到读库的会话
+
+    `info['replica']`为`SQLALCHEMY_BINDS`中读库的key，只有SELECT且会话中没有待写入的对象时才走读库，
+    flush及其他语句都走主库。
+    '''
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        key = self.info.get('replica')
+        if key and bind is None and not self._flushing and getattr(clause, 'is_select', False) \
+                and not (self.new or self.dirty or self.deleted):
+            return self._db.engines[key]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@contextmanager
+def primary(session: Session):
+    '''在此范围内的查询都走主库'''
+    key = session.info.pop('replica', None)
+    try:
+        yield session
+    finally:
+        if key is not None:
+            session.info['replica'] = key
+
+
+class Replicas:
+    '''读库池
+
+    配置`READ_REPLICAS`列出`SQLALCHEMY_BINDS`中读库的key，每个worker进程在首次选择读库时启动一个检查线程，
+    每`REPLICA_CHECK_INTERVAL`秒检查一次各读库：连接失败或MySQL复制延迟超过`REPLICA_MAX_LAG`秒的读库暂不使用，
+    连接断开的读库立即标记为不可用，请求只读取检查结果。用户写入后`REPLICA_STICKY_SECONDS`秒内的读请求走主库，
+    保证读到自己的写入。
+    '''
+    __health = {}  # key -> 是否可用，首次检查完成前走主库
+    __checker = 0  # 已启动检查线程的进程id
+    __lock = Lock()
+
+    @staticmethod
+    def enabled() -> bool:
+        return bool(current_app.config.get('READ_REPLICAS'))
+
+    @classmethod
+    def choose(cls) -> str | None:
+        '''随机选一个可用的读库，没有可用的返回None'''
+        cls.start_checker()
+        keys = [i for i in current_app.config.get('READ_REPLICAS') or () if cls.healthy(i)]
+        return random.choice(keys) if keys else None
+
+    @classmethod
+    def healthy(cls, key: str) -> bool:
+        return cls.__health.get(key, False)
+
+    @classmethod
+    def watch(cls, stop=None):
+        '''循环检查各读库，`stop()`为真时退出'''
+        while stop is None or not stop():
+            for key in current_app.config.get('READ_REPLICAS') or ():
+                cls.__health[key] = cls.check(key)
+            time.sleep(current_app.config.get('REPLICA_CHECK_INTERVAL', 5))
+
+    @classmethod
+    def start_checker(cls):
+        if cls.__checker == os.getpid():
+            return
+        app = current_app._get_current_object()
+        with cls.__lock:
+            if cls.__checker == os.getpid():
+                return
+            def target():
+                with app.app_context():
+                    cls.watch()
+            Thread(target=target, name='replica-checker', daemon=True).start()
+            cls.__checker = os.getpid()
+
+    @staticmethod
+    def check(key: str) -> bool:
+        try:
+            with current_app.extensions['sqlalchemy'].engines[key].connect() as conn:
+                conn.exec_driver_sql('SELECT 1')
+                if conn.dialect.name in ('mysql', 'mariadb'):
+                    lag = replication_lag(conn)
+                    if lag is False or (lag is not None and lag > current_app.config.get('REPLICA_MAX_LAG', 5)):
+                        current_app.logger.warning('replica %s lag %s', key, lag)
+                        return False
+        except Exception as e:
+            current_app.logger.warning('replica %s unavailable: %s', key, e)
+            return False
+        return True
+
+    @staticmethod
+    def init(key: str) -> str:
+        '''准备本地读库：主库、读库都是SQLite时把主库整个复制过去，其它SQLite读库只建表；
+        MySQL等读库的表结构和数据由复制同步，不做处理。返回所做的操作'''
+        db = current_app.extensions['sqlalchemy']
+        engine = db.engines[key]
+        if engine.dialect.name != 'sqlite':
+            return 'skipped'
+        if db.engine.dialect.name != 'sqlite':
+            db.metadata.create_all(engine)
+            return 'created'
+        src, dst = db.engine.raw_connection(), engine.raw_connection()
+        try:
+            src.driver_connection.backup(dst.driver_connection)
+        finally:
+            src.close()
+            dst.close()
+        return 'copied'
+
+    @classmethod
+    def down(cls, key: str):
+        cls.__health[key] = False
+
+    @staticmethod
+    def sticky(user_id: int) -> bool:
+        return Cache().get(STICKY_KEY % user_id) is not None
+
+    @staticmethod
+    def stick(user_id: int):
+        Cache().set(STICKY_KEY % user_id, 1, ex=current_app.config.get('REPLICA_STICKY_SECONDS', 5))
+
+
+def replication_lag(conn) -> int | None | bool:
+    '''MySQL复制延迟秒数：不是从库返回None，复制中断返回False'''
+    for statement in ('SHOW REPLICA STATUS', 'SHOW SLAVE STATUS'):
+        try:
+            row = conn.exec_driver_sql(statement).mappings().first()
+        except Exception:
+            continue
+        if row is None:
+            return None
+        lag = row.get('Seconds_Behind_Source', row.get('Seconds_Behind_Master'))
+        return False if lag is None else int(lag)
+    return None
+
+
+@event.listens_for(Engine, 'handle_error')
+def _handle_error(context):
+    if not context.is_disconnect or context.engine is None:
+        return
+    try:
+        engines = current_app.extensions['sqlalchemy'].engines
+        keys = current_app.config.get('READ_REPLICAS') or ()
+    except RuntimeError:
+        return
+    for key in keys:
+        if engines.get(key) is context.engine:
+            Replicas.down(key)
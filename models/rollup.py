@@ -0,0 +1,154 @@
+from collections import namedtuple, defaultdict
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import String, DECIMAL, ForeignKey, event, inspect, select, delete, insert, update, func
+from sqlalchemy.dialects import mysql, sqlite, postgresql
+from sqlalchemy.orm import Mapped, mapped_column, Session
+from . import db, Base, Book, Category, Tally
+
+PERIODS = ('day', 'week', 'month', 'year')
+
+TallyDelta = namedtuple('TallyDelta', ('book_id', 'category_id', 'record_timestamp', 'amount', 'count'))
+
+
+def period_bucket(period: str, timestamp: int) -> int:
+    '''时间戳所在的周期编号(服务器本地时区)：day=20231231, week=202352(ISO周), month=202312, year=2023'''
+    d = datetime.fromtimestamp(timestamp)
+    if period == 'day':
+        return d.year * 10000 + d.month * 100 + d.day
+    if period == 'week':
+        year, week, _ = d.isocalendar()
+        return year * 100 + week
+    if period == 'month':
+        return d.year * 100 + d.month
+    return d.year
+
+
+class TallyRollup(Base):
+    '''按账本、周期、分类汇总的收支合计，随记账记录在同一事务中增量维护'''
+    __tablename__ = 'tally_rollup'
+    __cloumns__ = ('bucket', 'category_id', 'amount', 'count')
+    book_id: Mapped[int] = mapped_column(ForeignKey('book.id', ondelete='CASCADE'), primary_key=True)
+    period: Mapped[str] = mapped_column(String(8), primary_key=True, doc='统计周期day|week|month|year')
+    bucket: Mapped[int] = mapped_column(primary_key=True, doc='周期编号')
+    category_id: Mapped[int] = mapped_column(ForeignKey('category.id', ondelete='CASCADE'), primary_key=True)
+    amount: Mapped[DECIMAL] = mapped_column(DECIMAL(17, 4), default=0, doc='合计金额')
+    count: Mapped[int] = mapped_column(default=0, doc='笔数')
+
+    @staticmethod
+    def summary(book_id: int, period: str = 'month', start: int = None, end: int = None, by: str = 'category') -> list[dict]:
+        '''按周期及分类(`by=category`)或收支类型(`by=type`)汇总'''
+        key = TallyRollup.category_id if by == 'category' else Category.type
+        query = db.session.query(TallyRollup.bucket, key, func.sum(TallyRollup.amount), func.sum(TallyRollup.count)).filter(
+            TallyRollup.book_id == book_id, TallyRollup.period == period)
+        if by != 'category':
+            query = query.join(Category, Category.id == TallyRollup.category_id)
+        if start is not None:
+            query = query.filter(TallyRollup.bucket >= period_bucket(period, start))
+        if end is not None:
+            query = query.filter(TallyRollup.bucket <= period_bucket(period, end))
+        rows = query.group_by(TallyRollup.bucket, key).having(func.sum(TallyRollup.count) != 0).order_by(TallyRollup.bucket, key)
+        name = 'categoryId' if by == 'category' else 'type'
+        return [{'bucket': i[0], name: i[1], 'amount': str(i[2]), 'count': int(i[3])} for i in rows]
+
+    @staticmethod
+    def rebuild(book_ids: list | tuple = None, batch_size: int = 1000) -> int:
+        '''从记账记录重建汇总，不指定账本时重建全部，返回写入的行数'''
+        if not book_ids:
+            book_ids = db.session.scalars(select(Book.id)).all()
+        total = 0
+        for book_id in book_ids:
+            db.session.execute(delete(TallyRollup).where(TallyRollup.book_id == book_id))
+            rows = db.session.execute(
+                select(Tally.book_id, Tally.category_id, Tally.record_timestamp, Tally.amount).where(Tally.book_id == book_id)
+                .execution_options(yield_per=10000))
+            values = _rollup_values(TallyDelta(*i, 1) for i in rows)
+            for i in range(0, len(values), batch_size):
+                db.session.execute(insert(TallyRollup), values[i:i + batch_size])
+            db.session.commit()
+            total += len(values)
+        return total
+
+
+def _rollup_values(deltas) -> list[dict]:
+    acc = defaultdict(lambda: [Decimal(0), 0])
+    for i in deltas:
+        if i.book_id is None or i.category_id is None or i.record_timestamp is None:
+            continue
+        for period in PERIODS:
+            item = acc[(i.book_id, period, period_bucket(period, i.record_timestamp), i.category_id)]
+            item[0] += Decimal(str(i.amount or 0))
+            item[1] += i.count
+    return [{'book_id': k[0], 'period': k[1], 'bucket': k[2], 'category_id': k[3], 'amount': v[0], 'count': v[1]}
+            for k, v in acc.items() if v[0] or v[1]]
+
+
+def apply_tally_deltas(session: Session, deltas: list[TallyDelta]):
+    '''在当前事务中把记账记录的增量累加到汇总表，受影响账本的`tallies:<book_id>`版本号暂存在`session.info`中，提交后失效'''
+    values = _rollup_values(deltas)
+    if not values:
+        return
+    session.info.setdefault('versions', set()).update('tallies:%d' % i.book_id for i in deltas if i.book_id is not None)
+    upsert_add(session.connection(), TallyRollup.__table__, values, ('amount', 'count'))
+
+
+def upsert_add(conn, table, values: list[dict], columns: tuple):
+    '''按主键累加`columns`，行不存在时插入'''
+    if conn.dialect.name == 'mysql':
+        stmt = mysql.insert(table)
+        conn.execute(stmt.on_duplicate_key_update(**{k: table.c[k] + stmt.inserted[k] for k in columns}), values)
+    elif conn.dialect.name in ('sqlite', 'postgresql'):
+        stmt = (sqlite if conn.dialect.name == 'sqlite' else postgresql).insert(table)
+        conn.execute(stmt.on_conflict_do_update(
+            index_elements=[i.name for i in table.primary_key], set_={k: table.c[k] + stmt.excluded[k] for k in columns}), values)
+    else:
+        for i in values:
+            pk = [c == i[c.name] for c in table.primary_key]
+            if not conn.execute(update(table).where(*pk).values(**{k: table.c[k] + i[k] for k in columns})).rowcount:
+                conn.execute(insert(table), i)
+
+
+def _tally_values(obj: Tally, old: bool, keys: tuple = ('book_id', 'category_id', 'record_timestamp', 'amount')) -> tuple:
+    '''记录修改前(`old`)或修改后的`keys`字段值'''
+    state = inspect(obj)
+    ret = []
+    for key in keys:
+        history = state.attrs[key].history
+        if old and history.deleted:
+            ret.append(history.deleted[0])
+        elif not old and history.added:
+            ret.append(history.added[0])
+        elif history.unchanged:
+            ret.append(history.unchanged[0])
+        else:
+            ret.append(getattr(obj, key))
+    return tuple(ret)
+
+
+def tally_deltas(session: Session) -> list[TallyDelta]:
+    '''收集本次flush中新增、修改、删除的记账记录对汇总的影响'''
+    deleted_books = {i.id for i in session.deleted if isinstance(i, Book)}
+    deltas = []
+    for obj in session.new:
+        if isinstance(obj, Tally):
+            deltas.append(TallyDelta(*_tally_values(obj, False), 1))
+    for obj in session.deleted:
+        if isinstance(obj, Tally):
+            old = _tally_values(obj, True)
+            if old[0] not in deleted_books:
+                deltas.append(TallyDelta(*old[:3], -Decimal(str(old[3] or 0)), -1))
+    for obj in session.dirty:
+        if isinstance(obj, Tally) and session.is_modified(obj):
+            old, new = _tally_values(obj, True), _tally_values(obj, False)
+            if old != new:
+                deltas.append(TallyDelta(*old[:3], -Decimal(str(old[3] or 0)), -1))
+                deltas.append(TallyDelta(*new, 1))
+    return deltas
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session: Session, flush_context):
+    deleted_books = [i.id for i in session.deleted if isinstance(i, Book)]
+    if deleted_books:
+        session.connection().execute(delete(TallyRollup).where(TallyRollup.book_id.in_(deleted_books)))
+    apply_tally_deltas(session, tally_deltas(session))
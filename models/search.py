@@ -0,0 +1,199 @@
+from collections import defaultdict
+from flask import current_app
+from redis import RedisError
+from sqlalchemy import String, SmallInteger, ForeignKey, Index, event, inspect, select, insert, delete, union_all, func
+from sqlalchemy.orm import Mapped, mapped_column, Session
+from utils import keyset
+from . import db, Base, Book, Category, Tag, Tally, TallyTag
+import re
+
+TERM_LENGTH = 32
+TOKEN = re.compile(r'[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+|[0-9a-z]+')  # 连续的汉字或字母数字
+REMARK, TAG, CATEGORY = 4, 2, 1  # 词出现的位置，相关度按匹配的位置累加
+INDEXED = ('book_id', 'record_timestamp', 'remark', 'category_id', 'tags')  # 影响索引的记账记录字段
+
+
+def tokenize(text: str) -> set[str]:
+    '''索引的词：汉字按相邻二字切分并加上每段的末字，字母数字串整体(小写)'''
+    ret = set()
+    for token in TOKEN.findall((text or '').lower()):
+        if token.isascii():
+            ret.add(token[:TERM_LENGTH])
+        else:
+            ret.update(token[i:i + 2] for i in range(len(token) - 1))
+            ret.add(token[-1])
+    return ret
+
+
+def query_terms(q: str) -> list[list[tuple[str, bool]]]:
+    '''查询的词按关键词分组：[[(词, 是否前缀匹配)]]，单个汉字及字母数字串按前缀匹配，
+    多个汉字切分为不重叠的二字(奇数个字时末两字与前面重叠)，"餐饮美食"只查"餐饮"、"美食"'''
+    ret = []
+    for token in TOKEN.findall(q.lower()):
+        if token.isascii():
+            ret.append([(token[:TERM_LENGTH], True)])
+        elif len(token) == 1:
+            ret.append([(token, True)])
+        else:
+            ret.append([(token[i:i + 2], False) for i in sorted({*range(0, len(token) - 1, 2), len(token) - 2})])
+    return ret
+
+
+class TallyTerm(Base):
+    '''记账记录的倒排索引：备注、分类名、标签名分词后每个(账本, 词, 记录)一行，随记账记录在同一事务中维护
+
+    主键按(账本, 词, 位置, 记录时间)排序，单个词的搜索直接按主键顺序分页，不需排序。
+    '''
+    __tablename__ = 'tally_term'
+    __table_args__ = (
+        Index('ix_tally_term_tally_id', 'tally_id'),
+    )
+    book_id: Mapped[int] = mapped_column(ForeignKey('book.id', ondelete='CASCADE'), primary_key=True)
+    term: Mapped[str] = mapped_column(String(TERM_LENGTH), primary_key=True)
+    weight: Mapped[int] = mapped_column(SmallInteger, primary_key=True, doc='出现的位置：4备注 2标签 1分类')
+    record_timestamp: Mapped[int] = mapped_column(primary_key=True)
+    tally_id: Mapped[int] = mapped_column(ForeignKey('tally.id', ondelete='CASCADE'), primary_key=True)
+
+    @staticmethod
+    def search(book_id: int, q: str, start: int = None, end: int = None, limit: int = 50, cursor: tuple = None) -> tuple[list, tuple | None]:
+        '''按相关度、记录时间倒序搜索，所有词都须匹配；返回([(记录id, 相关度)], 下一页游标)
+
+        连写的关键词(如"晚饭和张三"中的"和张")可能有跨越备注与标签的二字组合，账本中没有的二字不参与匹配，
+        但每个关键词至少要有一个二字存在。
+        '''
+        terms = []
+        for group in query_terms(q):
+            if len(group) > 1:
+                group = [i for i in group if db.session.scalar(
+                    select(TallyTerm.tally_id).where(TallyTerm.book_id == book_id, TallyTerm.term == i[0]).limit(1)) is not None]
+                if not group:
+                    return [], None
+            terms += group
+        terms = list(dict.fromkeys(terms))[:current_app.config.get('SEARCH_MAX_TERMS', 8)]
+        if not terms:
+            return [], None
+        ranges = [TallyTerm.book_id == book_id]
+        if start is not None:
+            ranges.append(TallyTerm.record_timestamp >= start)
+        if end is not None:
+            ranges.append(TallyTerm.record_timestamp <= end)
+        if len(terms) == 1 and not terms[0][1]:  # 单个词直接按主键顺序取一页
+            tally_id, score, record_timestamp = TallyTerm.tally_id, TallyTerm.weight, TallyTerm.record_timestamp
+            query = select(tally_id, score.label('score'), record_timestamp).where(TallyTerm.term == terms[0][0], *ranges)
+        else:
+            subs = []
+            for term, prefix in terms:
+                query = select(TallyTerm.tally_id, TallyTerm.record_timestamp, TallyTerm.weight).where(term_match(term, prefix), *ranges)
+                if prefix:  # 前缀可能匹配同一记录的多个词
+                    query = select(TallyTerm.tally_id, TallyTerm.record_timestamp, func.max(TallyTerm.weight).label('weight')).where(
+                        term_match(term, prefix), *ranges).group_by(TallyTerm.tally_id, TallyTerm.record_timestamp)
+                subs.append(query)
+            matched = union_all(*subs).subquery()
+            hits = select(matched.c.tally_id, matched.c.record_timestamp, func.sum(matched.c.weight).label('score')).group_by(
+                matched.c.tally_id, matched.c.record_timestamp).having(func.count() == len(terms)).subquery()
+            tally_id, score, record_timestamp = hits.c.tally_id, hits.c.score, hits.c.record_timestamp
+            query = select(tally_id, score, record_timestamp)
+        if cursor:
+            query = query.where(keyset((score, record_timestamp, tally_id), cursor, desc=True))
+        rows = db.session.execute(query.order_by(score.desc(), record_timestamp.desc(), tally_id.desc()).limit(limit + 1)).all()
+        next = (int(rows[limit - 1].score), rows[limit - 1].record_timestamp, rows[limit - 1].tally_id) if len(rows) > limit else None
+        return [(i.tally_id, int(i.score)) for i in rows[:limit]], next
+
+    @staticmethod
+    def rebuild(book_ids: list | tuple = None, batch_size: int = 1000) -> int:
+        '''重建索引，不指定账本时重建全部，每批单独提交，返回写入的行数'''
+        if not book_ids:
+            book_ids = db.session.scalars(select(Book.id)).all()
+        total = 0
+        for book_id in book_ids:
+            db.session.execute(delete(TallyTerm).where(TallyTerm.book_id == book_id))
+            ids = db.session.scalars(select(Tally.id).where(Tally.book_id == book_id).order_by(Tally.id)).all()
+            for i in range(0, len(ids), batch_size):
+                total += index_tallies(db.session, ids[i:i + batch_size], replace=False)
+                db.session.commit()
+            db.session.commit()
+        return total
+
+    @staticmethod
+    def reindex(category_ids: list | tuple = (), tag_ids: list | tuple = (), batch_size: int = 1000) -> int:
+        '''分类、标签改名后重建引用它们的记账记录的索引'''
+        ids = set()
+        if category_ids:
+            ids.update(db.session.scalars(select(Tally.id).where(Tally.category_id.in_(category_ids))))
+        if tag_ids:
+            ids.update(db.session.scalars(select(TallyTag.tally_id).where(TallyTag.tag_id.in_(tag_ids))))
+        ids, total = sorted(ids), 0
+        for i in range(0, len(ids), batch_size):
+            total += index_tallies(db.session, ids[i:i + batch_size])
+            db.session.commit()
+        return total
+
+
+def term_match(term: str, prefix: bool):
+    if not prefix:
+        return TallyTerm.term == term
+    if db.session.get_bind().dialect.name == 'sqlite':  # SQLite的LIKE不区分大小写，用不上索引
+        return (TallyTerm.term >= term) & (TallyTerm.term < term[:-1] + chr(ord(term[-1]) + 1))
+    return TallyTerm.term.startswith(term)
+
+
+def index_tallies(session: Session, ids: list, replace: bool = True) -> int:
+    '''按数据库中的当前状态重建记账记录`ids`的索引，返回写入的行数'''
+    conn = session.connection()
+    if replace:
+        conn.execute(delete(TallyTerm).where(TallyTerm.tally_id.in_(ids)))
+    rows = conn.execute(select(Tally.id, Tally.book_id, Tally.record_timestamp, Tally.remark, Category.name)
+                        .outerjoin(Category, Category.id == Tally.category_id).where(Tally.id.in_(ids))).all()
+    tags = defaultdict(list)
+    for tally_id, name in conn.execute(select(TallyTag.tally_id, Tag.name).join(Tag, Tag.id == TallyTag.tag_id).where(TallyTag.tally_id.in_(ids))):
+        tags[tally_id].append(name)
+    values = []
+    for id, book_id, record_timestamp, remark, category in rows:
+        weights = defaultdict(int)
+        for weight, texts in ((REMARK, (remark,)), (TAG, tags[id]), (CATEGORY, (category,))):
+            for text in texts:
+                for term in tokenize(text):
+                    weights[term] |= weight
+        values += [{'book_id': book_id, 'term': term, 'record_timestamp': record_timestamp, 'tally_id': id, 'weight': weight}
+                   for term, weight in weights.items()]
+    if values:
+        conn.execute(insert(TallyTerm), values)
+    return len(values)
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session: Session, flush_context):
+    changed, deleted = [], []
+    for obj in session.new:
+        if isinstance(obj, Tally):
+            changed.append(obj.id)
+    for obj in session.dirty:
+        if isinstance(obj, Tally) and any(inspect(obj).attrs[k].history.has_changes() for k in INDEXED):
+            changed.append(obj.id)
+        elif isinstance(obj, (Category, Tag)) and inspect(obj).attrs['name'].history.has_changes():
+            session.info.setdefault('search_reindex', defaultdict(set))[type(obj).__name__.lower()].add(obj.id)
+    for obj in session.deleted:
+        if isinstance(obj, Tally):
+            deleted.append(obj.id)
+    if deleted:
+        session.connection().execute(delete(TallyTerm).where(TallyTerm.tally_id.in_(deleted)))
+    if changed:
+        index_tallies(session, changed)
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session: Session):
+    '''分类、标签改名可能涉及大量记账记录，提交后交给后台任务重建'''
+    reindex = session.info.pop('search_reindex', None)
+    if not reindex:
+        return
+    from .jobs import Job
+    try:
+        Job.enqueue('reindex_search', category_ids=sorted(reindex['category']), tag_ids=sorted(reindex['tag']))
+    except RedisError:
+        current_app.logger.warning('reindex_search not queued', exc_info=True)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session: Session):
+    session.info.pop('search_reindex', None)
@@ -0,0 +1,133 @@
+from datetime import datetime, date, timedelta
+from decimal import Decimal
+from sqlalchemy import select, insert, func
+from . import db, User, UserConfigure, Application, Book, BookConfigure, Account, Category, Tag, Tally, UserBook, BookAccount, BookCategory, BookTag, TallyTag, Authorize
+from .rollup import TallyRollup
+from .balance import AccountBalance
+from .search import TallyTerm
+import random
+import time
+
+ACCOUNTS = ('现金钱包', '支付宝', '微信', '银行卡', '信用卡')
+CATEGORIES = (  # 名称, 类型, 子分类(名称, 金额中位数, 权重)
+    ('支出', -1, (('餐饮美食', 35, 40), ('生活日用', 60, 15), ('交通出行', 15, 15), ('休闲玩乐', 120, 6), ('服饰美容', 200, 5),
+                  ('人情社交', 300, 4), ('家居家电', 500, 2), ('教育运动', 300, 2), ('房租水电', 2000, 1), ('其他支出', 80, 3))),
+    ('收入', 1, (('工资薪酬', 9000, 3), ('生意投资', 1500, 1), ('奖金补贴', 2000, 1), ('其他收入', 200, 1))),
+    ('不记收支', 0, (('借款还款', 1000, 1), ('转账', 500, 2))),
+)
+TAGS = ('亲友圈', ('张三', '李四', '王五', '赵六', '麻七'))
+REMARKS = ('早餐', '午饭', '晚饭', '打车', '地铁', '超市', '外卖', '咖啡', '话费', '红包')
+
+
+class Seeder:
+    '''批量生成模拟数据，用于在接近生产规模的数据上观察接口表现
+
+    id在写入前按各表当前最大值顺延分配，所有记录以executemany按`batch_size`条一组写入，
+    不经过ORM的flush，写完后统一重建汇总表。金额按分类取对数正态分布，分类按权重抽取，
+    记账时间分布在最近`days`天内且白天居多，`seed`相同时生成的数据相同。
+    '''
+    def __init__(self, seed: int = None, batch_size: int = 5000, days: int = 365, password: str = '123456') -> None:
+        self.random = random.Random(seed)
+        self.batch_size = batch_size
+        self.days = days
+        self.password = Authorize.hash_password(password)
+        self.ids = {}
+
+    def next_id(self, model) -> int:
+        if model not in self.ids:
+            self.ids[model] = (db.session.scalar(select(func.max(model.id))) or 0) + 1
+        id = self.ids[model]
+        self.ids[model] += 1
+        return id
+
+    def insert(self, model, rows: list[dict]):
+        if not rows:
+            return
+        conn = db.session.connection()
+        for i in range(0, len(rows), self.batch_size):
+            conn.execute(insert(model.__table__), rows[i:i + self.batch_size])
+
+    def run(self, users: int, books_per_user: int = 2, tallies_per_book: int = 1000, echo=None) -> dict:
+        '''生成`users`个用户，每人`books_per_user`个账本，每个账本`tallies_per_book`条记账记录'''
+        start, book_ids, account_ids, tallies = time.time(), [], [], 0
+        self.application()
+        mobile = (db.session.scalar(select(func.max(User.mobile)).where(User.mobile.like('199%'))) or '19900000000')
+        for n in range(users):
+            user_id = self.next_id(User)
+            self.insert(User, [{'id': user_id, 'mobile': str(int(mobile) + n + 1), 'nick_name': '用户%d' % user_id, 'password': self.password}])
+            accounts = [{'id': self.next_id(Account), 'name': i, 'user_id': user_id} for i in ACCOUNTS[:self.random.randint(2, len(ACCOUNTS))]]
+            self.insert(Account, accounts)
+            account_ids += [i['id'] for i in accounts]
+            books = [self.book(user_id, [i['id'] for i in accounts]) for _ in range(books_per_user)]
+            self.insert(UserConfigure, [{'user_id': user_id, 'current_book_id': books[0][0]}])
+            for book_id, categories, tags in books:
+                tallies += self.tallies(book_id, [i['id'] for i in accounts], categories, tags, tallies_per_book)
+                book_ids.append(book_id)
+            db.session.commit()
+            if echo:
+                echo('user %d: %d books, %d tallies, %.1fs' % (user_id, len(book_ids), tallies, time.time() - start))
+        rollups = TallyRollup.rebuild(book_ids)
+        balances = len(AccountBalance.reconcile(account_ids, fix=True))
+        TallyTerm.rebuild(book_ids)
+        return {'users': users, 'books': len(book_ids), 'tallies': tallies, 'rollups': rollups, 'balances': balances,
+                'seconds': round(time.time() - start, 2)}
+
+    def application(self) -> str:
+        '''没有未过期的应用时新建一个，登录及压测需要；返回其AppID'''
+        app_id = db.session.scalar(select(Application.app_id).where(Application.expirydate > datetime.now()).order_by(Application.id))
+        if app_id is None:
+            id = self.next_id(Application)
+            app_id = 'seed%014x' % self.random.getrandbits(56)
+            self.insert(Application, [{'id': id, 'app_id': app_id, 'app_name': '压测应用%d' % id,
+                                       'secret_key': '%032x' % self.random.getrandbits(128), 'expirydate': datetime.now() + timedelta(days=3650)}])
+        return app_id
+
+    def book(self, user_id: int, accounts: list[int]) -> tuple[int, list[tuple], list[int]]:
+        '''生成账本及其分类、标签，返回(账本id, [(分类id, 类型, 金额中位数, 权重)], [标签id])'''
+        book_id = self.next_id(Book)
+        self.insert(Book, [{'id': book_id, 'name': '账本%d' % book_id}])
+        self.insert(BookConfigure, [{'book_id': book_id, 'budget': self.random.choice((0, 1000, 3000, 5000)), 'period': 'month'}])
+        self.insert(UserBook, [{'user_id': user_id, 'book_id': book_id, 'permission': 7}])
+        self.insert(BookAccount, [{'book_id': book_id, 'account_id': i} for i in accounts])
+        rows, categories = [], []
+        for name, type, children in CATEGORIES:
+            pid = self.next_id(Category)
+            rows.append({'id': pid, 'pid': None, 'name': name, 'type': type, 'seq': 0})
+            for seq, (child, median, weight) in enumerate(children):
+                id = self.next_id(Category)
+                rows.append({'id': id, 'pid': pid, 'name': child, 'type': type, 'seq': seq})
+                categories.append((id, type, median, weight))
+        self.insert(Category, rows)
+        self.insert(BookCategory, [{'book_id': book_id, 'category_id': i['id']} for i in rows if i['pid'] is None])
+        pid = self.next_id(Tag)
+        tags = [{'id': pid, 'pid': None, 'name': TAGS[0], 'seq': 0}]
+        tags += [{'id': self.next_id(Tag), 'pid': pid, 'name': name, 'seq': seq} for seq, name in enumerate(TAGS[1])]
+        self.insert(Tag, tags)
+        self.insert(BookTag, [{'book_id': book_id, 'tag_id': pid}])
+        return book_id, categories, [i['id'] for i in tags[1:]]
+
+    def tallies(self, book_id: int, accounts: list[int], categories: list[tuple], tags: list[int], count: int) -> int:
+        rand, now = self.random, int(time.time())
+        today = int(datetime.combine(date.today(), datetime.min.time()).timestamp())
+        weights = [i[3] for i in categories]
+        tallies, tally_tags = [], []
+        for category_id, type, median, _ in rand.choices(categories, weights, k=count):
+            id = self.next_id(Tally)
+            amount = Decimal(str(round(min(median * rand.lognormvariate(0, 0.8), 999999999), 2)))
+            tallies.append({
+                'id': id,
+                'book_id': book_id,
+                'amount': amount,
+                'record_timestamp': min(now, today - rand.randrange(self.days) * 86400 + int(rand.triangular(7, 23, 13) * 3600)),
+                'category_id': category_id,
+                'account_id': rand.choice(accounts) if rand.random() < 0.9 else None,
+                'remark': rand.choice(REMARKS) if rand.random() < 0.3 else None,
+            })
+            if rand.random() < 0.05:
+                tally_tags += [{'tally_id': id, 'tag_id': i} for i in rand.sample(tags, rand.randint(1, 2))]
+            if len(tallies) >= self.batch_size:
+                self.insert(Tally, tallies)
+                tallies = []
+        self.insert(Tally, tallies)
+        self.insert(TallyTag, tally_tags)
+        return count
@@ -0,0 +1,109 @@
+from functools import lru_cache
+from operator import attrgetter
+from sqlalchemy import inspect, Numeric, DateTime, Date
+from werkzeug.http import http_date
+import re
+
+MAX_DEPTH = 5  # 关联对象最大递归层数
+
+
+@lru_cache(maxsize=1024)
+def to_camel(s: str) -> str:
+    return re.sub(r'(_[a-z])', lambda x: x.group(1)[1].upper(), s.lower())
+
+
+@lru_cache(maxsize=1024)
+def to_snake(s: str) -> str:
+    return re.sub(r'([a-z])([A-Z])', r'\1_\2', s).lower()
+
+
+class Serializer:
+    '''按模型类预编译的序列化器，输出与`Base._get`一致
+
+    - `keys`: 输出的字段，默认为模型的`__cloumns__`
+    - `relations`: 需要展开的关联，None为全部展开；可用`.`指定下级关联，如`('tags', 'tags.children')`
+    - `depth`: 关联最大递归层数，超出的关联不输出
+
+    模型定义了类方法`_load_<key>(objs)`时，该字段由它批量加载(返回与`objs`顺序一致的值列表)，不再逐个访问关联。
+    '''
+    __compiled = {}
+
+    @classmethod
+    def of(cls, model, keys: list | tuple = None, relations: list | tuple = None, depth: int = MAX_DEPTH) -> 'Serializer':
+        keys = tuple(keys or model.__cloumns__)
+        if relations is not None:
+            relations = tuple(sorted(set(relations)))
+        key = (model, keys, relations, depth)
+        serializer = cls.__compiled.get(key)
+        if serializer is None:
+            serializer = cls.__compiled[key] = cls(model, keys, relations, depth)
+        return serializer
+
+    def __init__(self, model, keys: tuple, relations: tuple | None, depth: int) -> None:
+        mapper = inspect(model)
+        includes = None if relations is None else {i.split('.', 1)[0] for i in relations}
+        attrs, self.keys, self.converters, self.loaders = [], [], [], []
+        for k in keys:
+            loader = getattr(model, '_load_' + k, None)
+            if loader is not None:
+                if depth > 0 and (includes is None or k in includes):
+                    self.loaders.append((to_camel(k), loader))
+                continue
+            if k in mapper.relationships:
+                rel = mapper.relationships[k]
+                if depth <= 0 or rel.lazy == 'dynamic' or (includes is not None and k not in includes):
+                    continue
+                sub = None if relations is None else tuple(i[len(k) + 1:] for i in relations if i.startswith(k + '.'))
+                child = Serializer.of(rel.mapper.class_, relations=sub, depth=depth - 1)
+                conv = child.many if rel.uselist else child.one
+            elif k in mapper.column_attrs:
+                column_type = mapper.column_attrs[k].columns[0].type
+                if isinstance(column_type, Numeric) and column_type.asdecimal:
+                    conv = str
+                elif isinstance(column_type, (DateTime, Date)):
+                    conv = http_date
+                else:
+                    conv = None
+            elif hasattr(model, k):
+                conv = None
+            else:
+                continue
+            attrs.append(k)
+            self.keys.append(to_camel(k))
+            if conv is not None:
+                self.converters.append((to_camel(k), conv))
+        if len(attrs) == 1:
+            getter = attrgetter(attrs[0])
+            self.__values = lambda obj: (getter(obj),)
+        elif attrs:
+            self.__values = attrgetter(*attrs)
+        else:
+            self.__values = lambda obj: ()
+
+    def __one(self, obj) -> dict:
+        ret = dict(zip(self.keys, self.__values(obj)))
+        for k, conv in self.converters:
+            v = ret[k]
+            if v is not None:
+                ret[k] = conv(v)
+        return ret
+
+    def one(self, obj) -> dict | None:
+        '''序列化单个对象'''
+        if obj is None:
+            return None
+        if self.loaders:
+            return self.many((obj,))[0]
+        return self.__one(obj)
+
+    def many(self, objs) -> list[dict]:
+        '''批量序列化对象列表'''
+        one = self.__one
+        if not self.loaders:
+            return [one(i) for i in objs]
+        objs = list(objs)
+        ret = [one(i) for i in objs]
+        for k, loader in self.loaders:
+            for item, value in zip(ret, loader(objs) if objs else ()):
+                item[k] = value
+        return ret
@@ -0,0 +1,197 @@
+from collections import defaultdict
+from sqlalchemy import BigInteger, Integer, String, Index, DDL, event, inspect, select, insert, update, delete, func
+from sqlalchemy.orm import Mapped, mapped_column, Session
+from typing import Optional
+from . import db, primary, BOOK_DELETED, Book, Account, Category, Tag, Tally, UserBook, BookCategory, BookTag, TallyTag
+import time
+
+TYPES = {'book': Book, 'account': Account, 'category': Category, 'tag': Tag, 'tally': Tally}
+NAMES = {v: k for k, v in TYPES.items()}
+SYNC_KEYS = {  # 同步时各类型输出的字段，不展开下级树
+    'book': ('id', 'name', 'icon', 'remark', 'configure', 'created'),
+    'account': ('id', 'name', 'icon', 'remark'),
+    'category': ('id', 'pid', 'name', 'type', 'icon', 'remark', 'seq'),
+    'tag': ('id', 'pid', 'name', 'remark', 'seq'),
+    'tally': ('id', 'amount', 'record_timestamp', 'remark', 'category_id', 'account_id'),
+}
+
+
+class Change(db.Model):
+    '''变更日志，自增id即变更序号；账本、资金账户、分类、标签、记账记录的每次新增、修改、删除各记一行
+
+    账本内的数据按`book_id`、资金账户按`user_id`归属，删除的对象以`deleted=1`的行作为墓碑保留。
+    '''
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        Index('ix_change_log_book_id_id', 'book_id', 'id'),
+        Index('ix_change_log_user_id_id', 'user_id', 'id'),
+    )
+    id: Mapped[int] = mapped_column(BigInteger().with_variant(Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    type: Mapped[str] = mapped_column(String(16), doc='book|account|category|tag|tally')
+    obj_id: Mapped[int]
+    book_id: Mapped[Optional[int]] = mapped_column(doc='所属账本')
+    user_id: Mapped[Optional[int]] = mapped_column(doc='所属用户(资金账户)')
+    deleted: Mapped[int] = mapped_column(default=0, doc='1为删除')
+    created: Mapped[int] = mapped_column(default=lambda: int(time.time()))
+
+
+class ChangeSeq(db.Model):
+    '''变更日志的提交锁，只有一行
+
+    写入变更日志的事务在提交前先更新这一行再写入变更日志，行锁持有到提交，自增id因此按提交顺序分配。
+    '''
+    __tablename__ = 'change_seq'
+    id: Mapped[int] = mapped_column(primary_key=True)
+    value: Mapped[int] = mapped_column(BigInteger().with_variant(Integer, 'sqlite'), default=0, doc='已提交的写入变更日志的事务数')
+
+
+event.listen(ChangeSeq.__table__, 'after_create', DDL('INSERT INTO change_seq (id, value) VALUES (1, 0)'))
+
+
+class Sync:
+    '''按变更序号增量同步
+
+    `since`为上次返回的游标，每页最多`limit`条变更，同一对象的多次变更只返回最后的状态。
+    变更日志在事务提交前持`ChangeSeq`的行锁写入，变更序号与提交顺序一致，读到的最大序号之前的变更都已提交，
+    游标不会越过晚提交的事务。
+    '''
+    def __init__(self, user_id: int) -> None:
+        self.user_id = user_id
+
+    @staticmethod
+    def head() -> int:
+        return db.session.scalar(select(func.max(Change.id))) or 0
+
+    @staticmethod
+    def expired(since: int) -> bool:
+        '''游标之后的变更是否已被清理'''
+        first = db.session.scalar(select(func.min(Change.id)))
+        return first is not None and since < first - 1
+
+    def page(self, since: int, limit: int) -> dict:
+        with primary(db.session):  # 读库并行回放时不保证按主库的提交顺序可见
+            return self.__page(since, limit)
+
+    def __page(self, since: int, limit: int) -> dict:
+        books = select(UserBook.book_id).where(UserBook.user_id == self.user_id)
+        rows = db.session.scalars(select(Change).where(Change.book_id.in_(books), Change.id > since).order_by(Change.id).limit(limit + 1)).all()
+        rows += db.session.scalars(select(Change).where(Change.user_id == self.user_id, Change.id > since).order_by(Change.id).limit(limit + 1)).all()
+        rows = sorted({i.id: i for i in rows}.values(), key=lambda i: i.id)
+        more = len(rows) > limit
+        rows = rows[:limit]
+        latest = {}
+        for i in rows:
+            latest[(i.type, i.obj_id, i.book_id)] = i
+        upserted, deleted = defaultdict(list), defaultdict(list)
+        books = defaultdict(lambda: defaultdict(list))  # type -> obj_id -> [book_id]
+        for (kind, obj_id, book_id), i in latest.items():
+            if i.deleted:
+                deleted[kind].append({'id': obj_id, 'bookId': book_id})
+            else:
+                books[kind][obj_id].append(book_id)
+        for kind, model in TYPES.items():
+            if not books[kind]:
+                continue
+            objs = db.session.scalars(select(model).where(model.id.in_(books[kind]))).all()
+            tags = defaultdict(list)
+            if kind == 'tally' and objs:
+                for tally_id, tag_id in db.session.execute(select(TallyTag.tally_id, TallyTag.tag_id).where(TallyTag.tally_id.in_([i.id for i in objs]))):
+                    tags[tally_id].append(tag_id)
+            for obj, data in zip(objs, model._get_all(objs, SYNC_KEYS[kind], ('configure',) if kind == 'book' else ())):
+                if kind == 'tally':
+                    data['tagIds'] = tags[obj.id]
+                if kind == 'book':
+                    upserted[kind].append(data)
+                else:
+                    upserted[kind] += [{**data, 'bookId': book_id} for book_id in books[kind][obj.id]]
+            for obj_id in set(books[kind]) - {i.id for i in objs}:
+                deleted[kind].append({'id': obj_id, 'bookId': None})
+        cursor = rows[-1].id if rows else since
+        return {'cursor': cursor, 'more': more, 'upserted': upserted, 'deleted': deleted}
+
+    @staticmethod
+    def prune(days: int) -> int:
+        '''清理`days`天前的变更日志，游标早于清理位置的客户端需要全量同步'''
+        return db.session.execute(delete(Change).where(Change.created < int(time.time()) - days * 86400)).rowcount
+
+
+def tree_books(session: Session, objs) -> dict[tuple, set]:
+    '''分类、标签所属的账本：{(模型, id): {book_id}}'''
+    ret = defaultdict(set)
+    conn = session.connection()
+    for model, assoc, fk in ((Category, BookCategory, BookCategory.category_id), (Tag, BookTag, BookTag.tag_id)):
+        ids = {i.id for i in objs if isinstance(i, model) and i.id is not None}
+        if not ids:
+            continue
+        ancestors = select(model.id.label('id'), model.id.label('node'), model.pid).where(model.id.in_(ids)).cte(recursive=True)
+        ancestors = ancestors.union(select(ancestors.c.id, model.id, model.pid).join(ancestors, model.id == ancestors.c.pid))
+        for id, book_id in conn.execute(select(ancestors.c.id, assoc.book_id).join(assoc, fk == ancestors.c.node)):
+            ret[(model, id)].add(book_id)
+    return ret
+
+
+def log_inserted_tallies(session: Session, book_id: int, ids: list[int]):
+    '''记录批量写入(不经过flush)的账本`book_id`的记账记录`ids`'''
+    now = int(time.time())
+    session.info.setdefault('changes', []).extend(
+        {'type': 'tally', 'obj_id': i, 'book_id': book_id, 'user_id': None, 'deleted': 0, 'created': now} for i in ids)
+
+
+@event.listens_for(Session, 'before_flush')
+def _before_flush(session: Session, flush_context, instances):
+    deleted = [i for i in session.deleted if isinstance(i, (Category, Tag))]
+    if deleted:
+        session.info.setdefault('tree_books', {}).update(tree_books(session, deleted))
+
+
+@event.listens_for(Session, 'after_flush')
+def _after_flush(session: Session, flush_context):
+    changed = [(i, 0) for i in session.new] + [(i, 0) for i in session.dirty if session.is_modified(i)] + [(i, 1) for i in session.deleted]
+    changed = [(i, deleted) for i, deleted in changed if type(i) in NAMES]
+    books = session.info.pop('tree_books', {})
+    if not changed:
+        return
+    books.update(tree_books(session, [i for i, deleted in changed if not deleted]))
+    pending = [i for i, _ in changed if isinstance(i, (Category, Tag)) and not books.get((type(i), i.id))]
+    while pending:  # 级联删除的下级节点沿用上级节点的账本
+        resolved = [i for i in pending if books.get((type(i), i.pid))]
+        for i in resolved:
+            books[(type(i), i.id)] = books[(type(i), i.pid)]
+        if not resolved:
+            break
+        pending = [i for i in pending if i not in resolved]
+    now, rows = int(time.time()), []
+    for obj, deleted in changed:
+        row = {'type': NAMES[type(obj)], 'obj_id': obj.id, 'book_id': None, 'user_id': None, 'deleted': deleted, 'created': now}
+        if isinstance(obj, Book) and obj.state == BOOK_DELETED:  # 清理后账本不再属于任何用户，按用户记录墓碑
+            users = session.connection().scalars(select(UserBook.user_id).where(UserBook.book_id == obj.id))
+            rows += [{**row, 'book_id': obj.id, 'user_id': i, 'deleted': 1} for i in users]
+        elif isinstance(obj, Book):
+            rows.append({**row, 'book_id': obj.id})
+        elif isinstance(obj, Account):
+            rows.append({**row, 'user_id': obj.user_id})
+        elif isinstance(obj, Tally):
+            history = inspect(obj).attrs['book_id'].history
+            if not deleted and history.deleted and history.deleted[0] is not None:
+                rows.append({**row, 'book_id': history.deleted[0], 'deleted': 1})
+            rows.append({**row, 'book_id': obj.book_id})
+        else:
+            rows += [{**row, 'book_id': i} for i in books.get((type(obj), obj.id)) or (None,)]
+    session.info.setdefault('changes', []).extend(rows)
+
+
+@event.listens_for(Session, 'before_commit')
+def _before_commit(session: Session):
+    '''flush后持`ChangeSeq`的行锁写入本事务的变更日志，并发提交的事务在此排队'''
+    session.flush()
+    rows = session.info.pop('changes', None)
+    if rows:
+        conn = session.connection()
+        if not conn.execute(update(ChangeSeq).where(ChangeSeq.id == 1).values(value=ChangeSeq.value + 1)).rowcount:
+            conn.execute(insert(ChangeSeq).values(id=1, value=1))
+        conn.execute(insert(Change), rows)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session: Session):
+    session.info.pop('changes', None)
@@ -0,0 +1,100 @@
+from functools import wraps
+from flask import current_app, request, g
+from redis import RedisError
+from sqlalchemy.pool import QueuePool
+from threading import Lock
+from werkzeug.exceptions import TooManyRequests, ServiceUnavailable
+from .cache import Cache, MemoryBackend
+import math
+import time
+
+RATE_KEY = 'cashbook:rate:%s:%s'  # endpoint, 身份(appid:user_id 或 appid:ip)
+POOL_WAIT_HALF_LIFE = 1.0  # 取连接等待时间的估计值每秒衰减一半，停止取连接后逐渐恢复
+
+
+class RateLimit:
+    '''令牌桶限流
+
+    配置`RATE_LIMITS`按接口(endpoint，未列出的用`default`)设置`(每秒令牌数, 桶容量)`，
+    登录后的接口按appid及用户计数，登录接口按appid及客户端IP计数，`RATE_LIMIT_EXEMPT_APPS`中的appid(如压测应用)不限流。
+    桶保存在Redis中由Lua脚本原子更新，所有worker共享；Redis不可用时(及之后`REDIS_RETRY_SECONDS`秒的熔断期内)退回每个worker各自的进程内令牌桶。
+    客户端IP取连接地址，只有配置了`PROXY_FIX_X_FOR`时才按可信代理的X-Forwarded-For取，防止伪造该请求头绕过限流。
+    '''
+    __local = None
+
+    @classmethod
+    def check(cls, endpoint: str, *identity):
+        limits = current_app.config.get('RATE_LIMITS') or {}
+        rule = limits.get(endpoint) or limits.get('default')
+        if not rule or (identity and identity[0] in current_app.config.get('RATE_LIMIT_EXEMPT_APPS', ())):
+            return
+        rate, burst = rule
+        key = RATE_KEY % (endpoint, ':'.join(str(i) for i in identity))
+        try:
+            wait = Cache().take(key, rate, burst)
+        except RedisError:
+            if cls.__local is None:
+                cls.__local = MemoryBackend(current_app.config.get('CACHE_MEMORY_SIZE', 10000))
+            wait = cls.__local.take(key, rate, burst)
+        if wait:
+            raise TooManyRequests('请求过于频繁，请稍后重试', retry_after=max(1, math.ceil(wait)))
+
+    @classmethod
+    def limited(cls, view_func):
+        '''未登录接口的限流，按appid及客户端IP计数'''
+        @wraps(view_func)
+        def wrapper(*args, **kwargs):
+            cls.check(request.endpoint, request.headers.get('appid'), request.remote_addr)  # 配置了`PROXY_FIX_X_FOR`时已是代理转发的客户端IP
+            return view_func(*args, **kwargs)
+        return wrapper
+
+
+class LoadShedder:
+    '''过载保护
+
+    每个worker统计取数据库连接的等待时间(指数衰减的平均值)及正在处理的请求数，
+    等待超过`LOAD_SHED_POOL_WAIT_MS`毫秒或请求数达到`LOAD_SHED_MAX_CONCURRENCY`时，
+    新请求直接返回503并带上`Retry-After`，不再排队等连接。
+    '''
+    __lock = Lock()
+    __wait = 0.0
+    __observed = 0.0
+    __inflight = 0
+
+    @classmethod
+    def observe(cls, wait: float):
+        with cls.__lock:
+            current = cls.pool_wait()
+            cls.__wait = current + (wait - current) * 0.2
+            cls.__observed = time.time()
+
+    @classmethod
+    def pool_wait(cls) -> float:
+        '''当前取连接等待时间的估计值(秒)'''
+        return cls.__wait * 0.5 ** ((time.time() - cls.__observed) / POOL_WAIT_HALF_LIFE)
+
+    @classmethod
+    def before_request(cls):
+        config = current_app.config
+        limit, wait_ms = config.get('LOAD_SHED_MAX_CONCURRENCY', 0), config.get('LOAD_SHED_POOL_WAIT_MS', 0)
+        with cls.__lock:
+            if (limit and cls.__inflight >= limit) or (wait_ms and cls.pool_wait() * 1000 > wait_ms):
+                raise ServiceUnavailable('服务繁忙，请稍后重试', retry_after=config.get('LOAD_SHED_RETRY_AFTER', 1))
+            cls.__inflight += 1
+        g.shed_counted = True
+
+    @classmethod
+    def teardown_request(cls, exc=None):
+        if g.pop('shed_counted', False):
+            with cls.__lock:
+                cls.__inflight -= 1
+
+
+class TimedQueuePool(QueuePool):
+    '''记录取连接等待时间的连接池，交给`LoadShedder`判断是否过载'''
+    def connect(self):
+        begin = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            LoadShedder.observe(time.perf_counter() - begin)
@@ -0,0 +1,118 @@
+from flask import current_app, request, Response
+from redis import RedisError
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from . import User, UserConfigure, Book, BookConfigure, Account, Category, Tag, UserBook, BookAccount, BookCategory, BookTag, Cache, db, primary
+import uuid
+
+VERSION_KEY = 'cashbook:version:%s'  # book:<id> | user:<id> | tallies:<book_id>
+PAYLOAD_KEY = 'cashbook:payload:%s:%s'  # key, version
+
+
+class Version:
+    '''账本、用户数据的版本号
+
+    依赖的模型(账本、配置、资金账户、分类、标签、用户)提交修改后版本号失效，
+    下次读取时生成新的版本号，用于缓存序列化结果及生成ETag；
+    `tallies:<book_id>`在账本的记账记录增删改(影响汇总的字段)提交后失效。
+    '''
+    @staticmethod
+    def get(key: str) -> str:
+        cache = Cache()
+        version = cache.get(VERSION_KEY % key)
+        if version is None:
+            cache.set(VERSION_KEY % key, uuid.uuid4().hex, ex=current_app.config.get('VERSION_CACHE_TTL', 86400), nx=True)
+            version = cache.get(VERSION_KEY % key)
+        return version
+
+    @staticmethod
+    def bump(keys):
+        try:
+            Cache().delete(*[VERSION_KEY % i for i in keys])
+        except RedisError:
+            pass
+
+    @staticmethod
+    def cached(key: str, build, depends: tuple = None) -> Response:
+        '''按版本号读穿缓存`build()`生成的响应，客户端ETag与当前版本一致时直接返回304；
+        `depends`为决定缓存是否有效的版本号，默认为`key`本身'''
+        try:
+            version = '-'.join(Version.get(i) for i in depends or (key,))
+        except RedisError:
+            return build()
+        etag = '%s-%s' % (key.replace(':', '-'), version)
+        if request.if_none_match.contains_weak(etag):  # 压缩后的响应为弱ETag
+            res = current_app.response_class(status=304)
+            res.set_etag(etag)
+            return res
+        try:
+            body = Cache().get(PAYLOAD_KEY % (key, version))
+        except RedisError:
+            body = None
+        if body is None:
+            with primary(db.session):  # 读库可能落后，新版本号下只缓存主库的数据
+                res = build()
+            if res.status_code != 200:
+                return res
+            try:
+                Cache().set(PAYLOAD_KEY % (key, version), res.get_data(as_text=True), ex=current_app.config.get('PAYLOAD_CACHE_TTL', 3600))
+            except RedisError:
+                pass
+        else:
+            res = current_app.response_class(body, mimetype='application/json')
+        res.set_etag(etag)
+        return res
+
+
+def dependent_keys(session: Session, objs) -> set[str]:
+    '''修改这些对象会影响到的账本、用户版本号'''
+    users, books, accounts, categories, tags = set(), set(), set(), set(), set()
+    for obj in objs:
+        if isinstance(obj, User):
+            users.add(obj.id)
+        elif isinstance(obj, UserConfigure):
+            users.add(obj.user_id)
+        elif isinstance(obj, Book):
+            books.add(obj.id)
+        elif isinstance(obj, BookConfigure):
+            books.add(obj.book_id)
+        elif isinstance(obj, Account):
+            users.add(obj.user_id)
+            accounts.add(obj.id)
+        elif isinstance(obj, (Category, Tag)):
+            (categories if isinstance(obj, Category) else tags).update((obj.id, obj.pid))
+    conn = session.connection()
+    accounts.discard(None)
+    if accounts:
+        books.update(conn.scalars(select(BookAccount.book_id).where(BookAccount.account_id.in_(accounts))))
+    for model, ids, assoc, fk in ((Category, categories, BookCategory, BookCategory.category_id), (Tag, tags, BookTag, BookTag.tag_id)):
+        ids.discard(None)
+        if ids:
+            ancestors = select(model.id, model.pid).where(model.id.in_(ids)).cte(recursive=True)
+            ancestors = ancestors.union(select(model.id, model.pid).join(ancestors, model.id == ancestors.c.pid))
+            books.update(conn.scalars(select(assoc.book_id).where(fk.in_(select(ancestors.c.id)))))
+    books.discard(None)
+    if books:
+        users.update(conn.scalars(select(UserBook.user_id).where(UserBook.book_id.in_(books))))
+    users.discard(None)
+    return {'book:%d' % i for i in books} | {'user:%d' % i for i in users}
+
+
+@event.listens_for(Session, 'before_flush')
+def _before_flush(session: Session, flush_context, instances):
+    objs = [i for i in (*session.new, *session.dirty, *session.deleted)
+            if isinstance(i, (User, UserConfigure, Book, BookConfigure, Account, Category, Tag))]
+    if objs:
+        session.info.setdefault('versions', set()).update(dependent_keys(session, objs))
+
+
+@event.listens_for(Session, 'after_commit')
+def _after_commit(session: Session):
+    keys = session.info.pop('versions', None)
+    if keys:
+        Version.bump(keys)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _after_rollback(session: Session):
+    session.info.pop('versions', None)
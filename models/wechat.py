@@ -0,0 +1,91 @@
+from flask import current_app
+from redis import RedisError
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from werkzeug.exceptions import Unauthorized, ServiceUnavailable
+from .cache import Cache
+import requests
+import time
+
+CODE_KEY = 'cashbook:wxcode:%s:%s'  # appid, js_code -> openid
+ERRMSG = {
+    -1: '微信系统繁忙',
+    40029: 'code 无效',
+    45011: '请勿频繁操作',
+    40226: '微信用户被限制'
+}
+
+
+class WeChat:
+    '''微信接口客户端
+
+    每个进程共用一个带连接池的会话(`WECHAT_POOL_SIZE`)，连接、读取分别以`WECHAT_CONNECT_TIMEOUT`、`WECHAT_READ_TIMEOUT`秒为限，
+    gevent worker下socket已被patch，等待响应时不阻塞其他请求。
+    微信返回系统繁忙(-1)或建立连接失败(请求未发出)时最多重试`WECHAT_RETRIES`次；请求发出后的读取超时、连接断开不重试，
+    以免同一个code被用两次。
+    code换到的openid缓存`WECHAT_CODE_CACHE_TTL`秒，小程序重试登录时不再请求微信。
+    '''
+    __session = None
+
+    @classmethod
+    def session(cls) -> requests.Session:
+        if cls.__session is None:
+            size = current_app.config.get('WECHAT_POOL_SIZE', 20)
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=False))
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=False))
+            cls.__session = session
+        return cls.__session
+
+    @classmethod
+    def code2session(cls, appid: str, secret: str, js_code: str) -> str | None:
+        '''auth.code2Session：用小程序登录的code换取openid'''
+        key = CODE_KEY % (appid, js_code)
+        try:
+            openid = Cache().get(key)
+        except RedisError:
+            openid = None
+        if openid:
+            return openid
+        data = cls.request('/sns/jscode2session', {'appid': appid, 'secret': secret, 'js_code': js_code, 'grant_type': 'authorization_code'})
+        openid = data.get('openid')
+        if openid:
+            try:
+                Cache().set(key, openid, ex=current_app.config.get('WECHAT_CODE_CACHE_TTL', 300))
+            except RedisError:
+                pass
+        return openid
+
+    @classmethod
+    def request(cls, path: str, params: dict) -> dict:
+        config = current_app.config
+        url = config.get('WECHAT_API_URL', 'https://api.weixin.qq.com').rstrip('/') + path
+        timeout = (config.get('WECHAT_CONNECT_TIMEOUT', 1), config.get('WECHAT_READ_TIMEOUT', 3))
+        retries = config.get('WECHAT_RETRIES', 2)
+        for attempt in range(retries + 1):
+            try:
+                data = cls.session().get(url, params=params, timeout=timeout).json()
+            except requests.ConnectionError as e:
+                if not_sent(e) and attempt < retries:
+                    time.sleep(0.1 * 2 ** attempt)
+                    continue
+                current_app.logger.warning('wechat %s unavailable', path, exc_info=True)
+                raise ServiceUnavailable('微信服务暂不可用，请稍后重试')
+            except (requests.RequestException, ValueError):
+                current_app.logger.warning('wechat %s failed', path, exc_info=True)
+                raise ServiceUnavailable('微信服务暂不可用，请稍后重试')
+            errcode = data.get('errcode', 0)
+            if errcode == -1 and attempt < retries:
+                time.sleep(0.1 * 2 ** attempt)
+                continue
+            if errcode:
+                raise Unauthorized(ERRMSG.get(errcode, '微信验证失败'))
+            return data
+
+
+def not_sent(e: requests.ConnectionError) -> bool:
+    '''连接超时、拒绝连接、域名解析失败等建立连接阶段的错误，请求尚未发出'''
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, ConnectTimeoutError)  # 含NewConnectionError
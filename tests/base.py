@@ -0,0 +1,71 @@
+'''测试用的应用：临时SQLite数据库、进程内缓存，注册v1接口，预置一个用户、账本、分类、资金账户及标签'''
+from datetime import datetime
+from flask import Flask
+from werkzeug.exceptions import HTTPException
+from models import db, Authorize, Cache, User, Application, Book, BookConfigure, Account, Category, Tag, UserBook
+from utils import r, FastJSONProvider
+from v1.views import v1
+import os
+import tempfile
+import unittest
+
+PASSWORD = '123456'
+
+
+def create_app(**config) -> Flask:
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY='test', SQLALCHEMY_TRACK_MODIFICATIONS=False, CACHE_BACKEND='memory', RATE_LIMITS={})
+    app.config.update(config)
+    app.json = FastJSONProvider(app)
+    db.init_app(app)
+    app.register_blueprint(v1, url_prefix='/v1')
+    @app.errorhandler(HTTPException)
+    def error_handler(e):
+        return r(e.code, e.description)
+    @app.teardown_request
+    def remove_session(e):
+        db.session.remove()  # 用例推入的应用上下文一直存在，每个请求结束时像正式运行一样丢弃会话
+    return app
+
+
+class AppTestCase(unittest.TestCase):
+    '''每个用例使用新建的数据库，`self.user_id`、`self.book_id`、`self.category_id`、`self.account_id`、`self.tag_id`为预置数据'''
+    config = {}
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.app = create_app(SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(self.dir.name, 'cb.db'), **self.config)
+        self.context = self.app.app_context()
+        self.context.push()
+        Cache.reset()
+        db.create_all(bind_key=None)  # 只在主库建表，读库由`Replicas.init`准备
+        user = User(mobile='13800000000', nick_name='测试', password=Authorize.hash_password(PASSWORD))
+        book = Book(name='测试账本')
+        book.configure = BookConfigure(budget=1000)
+        user.books.append(book)
+        account = Account(name='现金')
+        user.accounts.append(account)
+        book.accounts.append(account)
+        category = Category(name='餐饮', type=-1)
+        book.categories.append(category)
+        tag = Tag(name='出差')
+        book.tags.append(tag)
+        self.application = Application(app_id='test', app_name='测试', secret_key='secret', expirydate=datetime(2099, 12, 31))
+        db.session.add_all([user, self.application])
+        db.session.commit()
+        db.session.get(UserBook, (user.id, book.id)).permission = 7
+        db.session.commit()
+        self.user_id, self.book_id, self.category_id, self.account_id, self.tag_id = user.id, book.id, category.id, account.id, tag.id
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        self.context.pop()
+        Cache.reset()
+        self.dir.cleanup()
+
+    def login(self) -> dict:
+        '''登录预置用户，返回请求头'''
+        res = self.client.post('/v1/authorize/login', json={'mobile': '13800000000', 'password': PASSWORD}, headers={'appid': 'test'})
+        return {'appid': 'test', 'Authorization': 'Bearer %s' % res.json['data']['token']}
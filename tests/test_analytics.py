@@ -0,0 +1,22 @@
+'''趋势分析：金额按万分之一元的整数合计'''
+from base import AppTestCase
+from decimal import Decimal
+from models import db, Analytics, Book, Tally
+from models.analytics import period_range
+
+NOW = 1700000000
+
+
+class TrendTest(AppTestCase):
+    def test_exact_sums(self):
+        start = period_range('month', NOW)[0]
+        amounts = [Decimal('0.0003'), Decimal('999999999.9999'), Decimal('0.1')] * 300  # 接近DECIMAL(13, 4)上限，按元的浮点数累加会丢掉末位
+        db.session.add_all(Tally(book_id=self.book_id, amount=i, record_timestamp=start + n, category_id=self.category_id)
+                           for n, i in enumerate(amounts))
+        db.session.commit()
+        data = Analytics.trend(db.session.get(Book, self.book_id), 'month', 2, 1, now=NOW)
+        total = float(sum(amounts))
+        self.assertEqual(data['expense'], [0.0, total])
+        self.assertEqual(data['movingAverage'], [0.0, total])
+        self.assertEqual(data['forecast']['spent'], total)
+        self.assertEqual(data['forecast']['cumulative'][-1], total)
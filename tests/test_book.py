@@ -0,0 +1,16 @@
+'''删除账本：先标记删除再提交清理任务'''
+from base import AppTestCase
+from redis import RedisError
+from unittest import mock
+from models import db, Book, Job, BOOK_DELETED
+
+
+class DeleteBookTest(AppTestCase):
+    def test_enqueue_failure(self):
+        headers = self.login()
+        with mock.patch.object(Job, 'enqueue', side_effect=RedisError('down')):
+            res = self.client.delete('/v1/book/%d' % self.book_id, headers=headers)
+        self.assertEqual(res.status_code, 202)
+        self.assertIsNone(res.json.get('data'))
+        self.assertEqual(db.session.get(Book, self.book_id).state, BOOK_DELETED)
+        self.assertEqual(self.client.get('/v1/book/%d' % self.book_id, headers=headers).status_code, 404)
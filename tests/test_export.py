@@ -0,0 +1,31 @@
+'''导出：用户填写的文本不会被表格软件当作公式'''
+from base import AppTestCase
+from models import db, Tally
+import csv
+import io
+import zipfile
+
+
+class ExportTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        db.session.add(Tally(book_id=self.book_id, amount=-12.5, record_timestamp=1700000000, category_id=self.category_id,
+                             remark='=HYPERLINK("http://example.com","x")'))
+        db.session.commit()
+
+    def export(self, format: str) -> bytes:
+        res = self.client.get('/v1/book/%d/export?format=%s' % (self.book_id, format), headers=self.login())
+        self.assertEqual(res.status_code, 200)
+        return res.data
+
+    def test_csv(self):
+        rows = list(csv.reader(io.StringIO(self.export('csv').decode('utf-8-sig'))))
+        self.assertEqual(rows[1][3], '-12.5000')  # 数值不加前缀
+        self.assertEqual(rows[1][6], '\'=HYPERLINK("http://example.com","x")')
+
+    def test_xlsx(self):
+        with zipfile.ZipFile(io.BytesIO(self.export('xlsx'))) as zf:
+            sheet = zf.read('xl/worksheets/sheet1.xml').decode()
+        self.assertNotIn('<f>', sheet)
+        self.assertIn('<c t="inlineStr"><is><t xml:space="preserve">=HYPERLINK(', sheet)
+        self.assertIn('<c><v>-12.5000</v></c>', sheet)
@@ -0,0 +1,90 @@
+'''批量导入：每组一条多行INSERT及不合法记录的返回'''
+from sqlalchemy import event, select
+from base import AppTestCase
+from models import db, Tally, TallyTag, TallyImporter
+from models.sync import Change
+
+
+class ImporterTest(AppTestCase):
+    def rows(self, count: int) -> list[dict]:
+        return [{'amount': '%d.5' % i, 'recordTimestamp': 1700000000 + i, 'categoryId': self.category_id,
+                 'accountId': self.account_id, 'tagIds': [self.tag_id] if i % 2 else []} for i in range(count)]
+
+    def run_import(self, rows: list, batch_size: int) -> tuple[dict, list[str]]:
+        '''导入`rows`，返回结果及写入tally表的INSERT语句'''
+        statements = []
+        def record(conn, cursor, statement, *args):
+            if statement.startswith('INSERT INTO tally '):
+                statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            return TallyImporter(self.book_id, batch_size).run(rows), statements
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+
+    def check_inserted(self, rows: list):
+        tallies = db.session.scalars(select(Tally).where(Tally.book_id == self.book_id).order_by(Tally.id)).all()
+        self.assertEqual([(str(i.amount), i.record_timestamp) for i in tallies],
+                         [('%.4f' % float(i['amountCheck']), i['recordTimestamp']) for i in rows])
+        self.assertTrue(all(i.import_token is None for i in tallies))
+        links = set(db.session.execute(select(TallyTag.tally_id, TallyTag.tag_id)).all())
+        self.assertEqual(links, {(t.id, self.tag_id) for t, i in zip(tallies, rows) if i['tagIds']})
+        logged = db.session.scalars(select(Change.obj_id).where(Change.type == 'tally')).all()
+        self.assertEqual(sorted(logged), [i.id for i in tallies])
+
+    def test_returning(self):
+        rows = self.rows(25)
+        result, statements = self.run_import(rows, 10)
+        self.assertEqual(result, {'inserted': 25, 'rejected': []})
+        self.assertEqual(len(statements), 3)
+        self.check_inserted([{**i, 'amountCheck': i['amount']} for i in rows])
+
+    def test_without_returning(self):
+        '''不支持RETURNING的数据库(MySQL)：每组仍是一条多行INSERT，id按`import_token`查回'''
+        dialect = db.engine.dialect
+        supported = dialect.insert_returning
+        dialect.insert_returning = False
+        try:
+            db.session.add(Tally(book_id=self.book_id, amount=0, record_timestamp=0, category_id=self.category_id))  # 其它写入的记录不应混进本组
+            db.session.commit()
+            rows = self.rows(25)
+            result, statements = self.run_import(rows, 10)
+        finally:
+            dialect.insert_returning = supported
+        self.assertEqual(result, {'inserted': 25, 'rejected': []})
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(all('RETURNING' not in i for i in statements))
+        self.check_inserted([{'amountCheck': '0', 'recordTimestamp': 0, 'tagIds': []}] + [{**i, 'amountCheck': i['amount']} for i in rows])
+
+    def test_rejected(self):
+        rows = [
+            {'amount': '1', 'recordTimestamp': 1700000000, 'categoryId': self.category_id},
+            'not a row',
+            {'amount': '-1', 'recordTimestamp': 1700000000, 'categoryId': self.category_id},
+            {'amount': 'abc', 'recordTimestamp': 1700000000, 'categoryId': self.category_id},
+            {'amount': '1', 'recordTimestamp': 'x', 'categoryId': self.category_id},
+            {'amount': '1', 'recordTimestamp': 1700000000, 'categoryId': 999},
+            {'amount': '1', 'recordTimestamp': 1700000000, 'categoryId': self.category_id, 'accountId': 999},
+            {'amount': '1', 'recordTimestamp': 1700000000, 'categoryId': self.category_id, 'tagIds': '999'},
+            {'amount': '1', 'recordTimestamp': 1700000000, 'categoryId': self.category_id, 'remark': 'x' * 256},
+            {'amount': '2', 'recordTimestamp': 1700000001, 'categoryId': self.category_id, 'tagIds': str(self.tag_id)},
+        ]
+        result, _ = self.run_import(rows, 1000)
+        self.assertEqual(result['inserted'], 2)
+        self.assertEqual(result['rejected'], [
+            {'row': 1, 'error': '记录格式错误'},
+            {'row': 2, 'error': '金额无效'},
+            {'row': 3, 'error': '金额无效'},
+            {'row': 4, 'error': '记录时间无效'},
+            {'row': 5, 'error': '分类不属于该账本'},
+            {'row': 6, 'error': '资金账户不属于该账本'},
+            {'row': 7, 'error': '标签不属于该账本'},
+            {'row': 8, 'error': '备注过长'},
+        ])
+
+    def test_rejected_over_http(self):
+        res = self.client.post('/v1/tallies?book-id=%d' % self.book_id, headers=self.login(), json=[
+            {'amount': '1', 'recordTimestamp': 1700000000, 'categoryId': self.category_id},
+            {'amount': '-5', 'recordTimestamp': 1700000000, 'categoryId': self.category_id}])
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(res.json['data'], {'inserted': 1, 'rejected': [{'row': 1, 'error': '金额无效'}]})
@@ -0,0 +1,77 @@
+'''读写分离：两个本地SQLite读库，一个可用、一个无法打开'''
+from base import AppTestCase
+from models import db, Cache, Replicas, Tally
+import os
+import tempfile
+
+DIR = tempfile.mkdtemp()
+
+
+class ReplicaTest(AppTestCase):
+    config = {
+        'SQLALCHEMY_BINDS': {'replica1': 'sqlite:///' + os.path.join(DIR, 'replica1.db'),
+                             'replica2': 'sqlite:///' + os.path.join(DIR, 'missing', 'replica2.db')},
+        'READ_REPLICAS': ('replica1',),
+        'REPLICA_CHECK_INTERVAL': 0,
+        'REPLICA_STICKY_SECONDS': 60,
+    }
+
+    def setUp(self):
+        super().setUp()
+        Replicas._Replicas__health = {}
+        Replicas._Replicas__checker = os.getpid()  # 不启动后台检查线程，由用例调用`check_replicas()`
+        self.assertEqual(Replicas.init('replica1'), 'copied')
+        db.session.add(Tally(book_id=self.book_id, amount=1, record_timestamp=1700000000, category_id=self.category_id))
+        db.session.commit()  # 只写入主库，读库上没有这条记录
+        self.headers = self.login()
+
+    def tearDown(self):
+        Replicas._Replicas__health = {}
+        Replicas._Replicas__checker = 0
+        super().tearDown()
+        for i in ('replica1.db',):
+            if os.path.exists(os.path.join(DIR, i)):
+                os.remove(os.path.join(DIR, i))
+
+    def check_replicas(self):
+        '''检查线程的一轮检查'''
+        rounds = iter((False, True))
+        Replicas.watch(lambda: next(rounds))
+
+    def count(self) -> int:
+        '''`GET /v1/tallies`返回的记录数，读库上为0、主库上为1'''
+        res = self.client.get('/v1/tallies?book-id=%d' % self.book_id, headers=self.headers)
+        self.assertEqual(res.status_code, 200, res.json)
+        return len(res.json['data'])
+
+    def test_unchecked_reads_primary(self):
+        self.assertIsNone(Replicas.choose())
+        self.assertEqual(self.count(), 1)
+
+    def test_reads_replica(self):
+        self.check_replicas()
+        self.assertEqual(Replicas.choose(), 'replica1')
+        self.assertEqual(self.count(), 0)
+
+    def test_sticky_after_write(self):
+        self.check_replicas()
+        self.assertEqual(self.count(), 0)
+        res = self.client.post('/v1/tallies?book-id=%d' % self.book_id, headers=self.headers,
+                               json=[{'amount': '2', 'recordTimestamp': 1700000001, 'categoryId': self.category_id}])
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(self.count(), 2)  # 写入后的读请求走主库
+        Cache().delete('cashbook:sticky:%d' % self.user_id)
+        self.assertEqual(self.count(), 0)
+
+    def test_unhealthy_falls_back(self):
+        self.app.config['READ_REPLICAS'] = ('replica1', 'replica2')
+        self.check_replicas()
+        self.assertTrue(Replicas.healthy('replica1'))
+        self.assertFalse(Replicas.healthy('replica2'))
+        for _ in range(10):
+            self.assertEqual(Replicas.choose(), 'replica1')
+        Replicas.down('replica1')  # 如连接断开
+        self.assertIsNone(Replicas.choose())
+        self.assertEqual(self.count(), 1)
+        self.check_replicas()
+        self.assertEqual(self.count(), 0)
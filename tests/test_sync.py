@@ -0,0 +1,83 @@
+'''增量同步：游标分页、墓碑及变更日志按提交顺序写入'''
+from sqlalchemy import func, select
+from base import AppTestCase
+from models import db, Sync, Tally
+from models.sync import Change, ChangeSeq
+
+
+class SyncTest(AppTestCase):
+    def setUp(self):
+        super().setUp()
+        self.headers = self.login()
+
+    def sync(self, since: str = None, **args) -> dict:
+        query = '&'.join('%s=%s' % i for i in {**({'since': since} if since else {}), **args}.items())
+        res = self.client.get('/v1/sync?' + query, headers=self.headers)
+        self.assertEqual(res.status_code, 200, res.json)
+        return res.json['data']
+
+    def add_tallies(self, count: int) -> list[int]:
+        tallies = [Tally(book_id=self.book_id, amount=i, record_timestamp=1700000000 + i, category_id=self.category_id) for i in range(count)]
+        db.session.add_all(tallies)
+        db.session.commit()
+        return [i.id for i in tallies]
+
+    def test_cursor(self):
+        cursor = self.sync()['cursor']
+        self.assertEqual(self.sync(cursor)['upserted'], {})
+        ids = self.add_tallies(3)
+        page = self.sync(cursor)
+        self.assertFalse(page['more'])
+        self.assertEqual(sorted(i['id'] for i in page['upserted']['tally']), ids)
+        self.assertTrue(all(i['bookId'] == self.book_id for i in page['upserted']['tally']))
+        self.assertEqual(self.sync(page['cursor']), {'cursor': page['cursor'], 'more': False, 'upserted': {}, 'deleted': {}})
+
+    def test_pages(self):
+        cursor = self.sync()['cursor']
+        ids = self.add_tallies(5)
+        seen, pages = [], 0
+        while True:
+            page = self.sync(cursor, limit=2)
+            seen += [i['id'] for i in page['upserted'].get('tally', [])]
+            cursor, pages = page['cursor'], pages + 1
+            if not page['more']:
+                break
+        self.assertEqual(pages, 3)
+        self.assertEqual(sorted(seen), ids)
+
+    def test_latest_state_and_tombstone(self):
+        cursor = self.sync()['cursor']
+        id, = self.add_tallies(1)
+        tally = db.session.get(Tally, id)
+        tally.remark = 'changed'
+        db.session.commit()
+        page = self.sync(cursor)
+        self.assertEqual([i['remark'] for i in page['upserted']['tally']], ['changed'])
+        db.session.delete(db.session.get(Tally, id))
+        db.session.commit()
+        page = self.sync(page['cursor'])
+        self.assertEqual(page['upserted'], {})
+        self.assertEqual(page['deleted'], {'tally': [{'id': id, 'bookId': self.book_id}]})
+
+    def test_written_at_commit(self):
+        '''变更日志在提交前持`ChangeSeq`的行锁写入，flush后、回滚后都看不到'''
+        head, seq = Sync.head(), db.session.get(ChangeSeq, 1).value
+        db.session.add(Tally(book_id=self.book_id, amount=1, record_timestamp=1700000000, category_id=self.category_id))
+        db.session.flush()
+        self.assertEqual(db.session.scalar(select(func.count(Change.id)).where(Change.id > head)), 0)
+        db.session.rollback()
+        self.assertEqual(Sync.head(), head)
+        self.add_tallies(2)
+        db.session.expire_all()
+        self.assertEqual(db.session.scalar(select(func.count(Change.id)).where(Change.id > head)), 2)
+        self.assertEqual(db.session.get(ChangeSeq, 1).value, seq + 1)
+
+    def test_expired_cursor(self):
+        cursor = self.sync()['cursor']
+        self.add_tallies(2)
+        head = Sync.head()
+        self.add_tallies(1)
+        db.session.execute(Change.__table__.delete().where(Change.id <= head))  # 清理了游标之后的变更
+        db.session.commit()
+        res = self.client.get('/v1/sync?since=' + cursor, headers=self.headers)
+        self.assertEqual(res.status_code, 410)
@@ -0,0 +1,58 @@
+'''限流：Redis熔断后退回进程内令牌桶，登录接口按连接地址计数'''
+from base import AppTestCase
+from flask import Flask
+from redis import RedisError
+from werkzeug.exceptions import TooManyRequests
+from models import Cache, RateLimit
+from models.cache import RedisUnavailable
+import socket
+import time
+import unittest
+
+
+class BreakerTest(unittest.TestCase):
+    def setUp(self):
+        with socket.socket() as s:  # 取一个没有监听的端口
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        self.app = Flask(__name__)
+        self.app.config.update(REDIS_CONFIG={'host': '127.0.0.1', 'port': port}, REDIS_RETRY_SECONDS=0.2,
+                               RATE_LIMITS={'default': (0.001, 2)})
+        self.context = self.app.app_context()
+        self.context.push()
+        Cache.reset()
+
+    def tearDown(self):
+        self.context.pop()
+        Cache.reset()
+
+    def test_open_then_retry(self):
+        with self.assertRaises(RedisError) as e:
+            Cache().get('k')
+        self.assertNotIsInstance(e.exception, RedisUnavailable)
+        with self.assertRaises(RedisUnavailable):  # 熔断期间不再连接
+            Cache().get('k')
+        time.sleep(0.25)
+        with self.assertRaises(RedisError) as e:
+            Cache().get('k')
+        self.assertNotIsInstance(e.exception, RedisUnavailable)
+
+    def test_rate_limit_falls_back(self):
+        RateLimit.check('breaker', 'app', 1)
+        RateLimit.check('breaker', 'app', 1)
+        with self.assertRaises(TooManyRequests):
+            RateLimit.check('breaker', 'app', 1)
+
+
+class ClientAddressTest(AppTestCase):
+    config = {'RATE_LIMITS': {'v1.user_login': (0.001, 2)}}
+
+    def test_forwarded_for_ignored(self):
+        codes = [self.client.post('/v1/authorize/login', json={'mobile': '13800000000', 'password': 'wrong'},
+                                  headers={'appid': 'test', 'X-Forwarded-For': '10.0.0.%d' % i}).status_code for i in range(3)]
+        self.assertNotEqual(codes[1], 429)
+        self.assertEqual(codes[2], 429)
+
+
+if __name__ == '__main__':
+    unittest.main()
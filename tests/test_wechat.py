@@ -0,0 +1,115 @@
+'''微信接口客户端对本地模拟服务的重试行为
+
+python -m pytest tests 或 python -m unittest discover tests
+'''
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from flask import Flask
+from werkzeug.exceptions import Unauthorized, ServiceUnavailable
+from models import Cache, WeChat
+import json
+import socket
+import threading
+import time
+import unittest
+
+
+class Stub(BaseHTTPRequestHandler):
+    '''按js_code模拟微信的各种响应，收到的code记在`server.hits`中'''
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        code = parse_qs(urlparse(self.path).query)['js_code'][0]
+        hits = self.server.hits
+        hits.append(code)
+        if code == 'drop':  # 收到请求后不响应直接断开
+            self.close_connection = True
+            return
+        if code == 'slow':
+            time.sleep(1)
+        if code == 'busy' or (code == 'flaky' and hits.count(code) == 1):
+            body = {'errcode': -1, 'errmsg': 'system busy'}
+        elif code == 'bad':
+            body = {'errcode': 40029, 'errmsg': 'invalid code'}
+        else:
+            body = {'openid': 'openid-%s' % code, 'session_key': 'key'}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class WeChatTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), Stub)
+        cls.server.hits = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.app = Flask(__name__)
+        cls.app.config.update(CACHE_BACKEND='memory', WECHAT_API_URL='http://127.0.0.1:%d' % cls.server.server_port,
+                              WECHAT_READ_TIMEOUT=0.5, WECHAT_RETRIES=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.hits.clear()
+        self.context = self.app.app_context()
+        self.context.push()
+        Cache.reset()
+
+    def tearDown(self):
+        self.context.pop()
+        Cache.reset()
+
+    def login(self, code: str):
+        return WeChat.code2session('appid', 'secret', code)
+
+    def test_ok_and_cached(self):
+        self.assertEqual(self.login('ok'), 'openid-ok')
+        self.assertEqual(self.login('ok'), 'openid-ok')
+        self.assertEqual(self.server.hits, ['ok'])
+
+    def test_busy_retried(self):
+        self.assertEqual(self.login('flaky'), 'openid-flaky')
+        self.assertEqual(self.server.hits, ['flaky', 'flaky'])
+        with self.assertRaises(Unauthorized):
+            self.login('busy')
+        self.assertEqual(self.server.hits.count('busy'), 3)
+
+    def test_invalid_code_not_retried(self):
+        with self.assertRaises(Unauthorized):
+            self.login('bad')
+        self.assertEqual(self.server.hits, ['bad'])
+
+    def test_read_timeout_not_retried(self):
+        with self.assertRaises(ServiceUnavailable):
+            self.login('slow')
+        self.assertEqual(self.server.hits, ['slow'])
+
+    def test_disconnect_after_send_not_retried(self):
+        with self.assertRaises(ServiceUnavailable):
+            self.login('drop')
+        self.assertEqual(self.server.hits, ['drop'])
+
+    def test_connect_failure_retried(self):
+        with socket.socket() as s:  # 取一个没有监听的端口
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        self.app.config['WECHAT_API_URL'] = 'http://127.0.0.1:%d' % port
+        try:
+            begin = time.perf_counter()
+            with self.assertRaises(ServiceUnavailable):
+                self.login('down')
+            self.assertGreaterEqual(time.perf_counter() - begin, 0.3)  # 两次重试分别等待0.1、0.2秒
+        finally:
+            self.app.config['WECHAT_API_URL'] = 'http://127.0.0.1:%d' % self.server.server_port
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,2 +1,7 @@
 from .reverse_proxied import ReverseProxied
-from .response_json import r
+from .metrics import Timing
+from .response_json import r, r_stream, is_stream, FastJSONProvider, compress
+from .lru_cache import LRUCache
+from .pagination import page_size, encode_cursor, decode_cursor, keyset, keyset_chunks
+from .benchmark import Benchmark
+from .spreadsheet import csv_stream, xlsx_stream, XLSX_MIMETYPE
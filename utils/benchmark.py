@@ -0,0 +1,91 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+import json
+import math
+import platform
+import time
+
+
+def percentile(values: list, p: float):
+    '''已排序列表的p分位数(最近秩法)'''
+    if not values:
+        return None
+    return values[min(len(values), max(1, math.ceil(p / 100 * len(values)))) - 1]
+
+
+class Benchmark:
+    '''按场景压测接口，统计延迟分位数、吞吐量及每个请求的SQL条数
+
+    :param request: `request(method, path, headers, json) -> status`，可以是Flask测试客户端或HTTP会话的封装
+    :param queries: 返回累计SQL条数的函数
+    :param concurrency: 并发数，大于1时每个请求的SQL条数为场景内的平均值
+    '''
+    def __init__(self, request, queries=None, concurrency: int = 1) -> None:
+        self.request = request
+        self.queries = queries
+        self.concurrency = max(1, concurrency)
+        self.results = {}
+
+    def run(self, name: str, method: str, path, count: int = 100, headers: dict = None, json: dict = None, warmup: int = 5) -> dict:
+        '''`path`可以是函数`path(i)`，按请求序号生成不同的地址'''
+        url = path if callable(path) else (lambda i: path)
+        for i in range(warmup):
+            self.request(method, url(i), headers, json)
+        latencies, errors, lock = [], 0, Lock()
+        def one(i):
+            nonlocal errors
+            begin = time.perf_counter()
+            status = self.request(method, url(i), headers, json)
+            elapsed = (time.perf_counter() - begin) * 1000
+            with lock:
+                latencies.append(elapsed)
+                if status >= 400:
+                    errors += 1
+        queries = self.queries() if self.queries else None
+        begin = time.perf_counter()
+        if self.concurrency == 1:
+            for i in range(count):
+                one(i)
+        else:
+            with ThreadPoolExecutor(self.concurrency) as pool:
+                list(pool.map(one, range(count)))
+        seconds = time.perf_counter() - begin
+        latencies.sort()
+        self.results[name] = result = {
+            'requests': count,
+            'errors': errors,
+            'p50': round(percentile(latencies, 50), 3),
+            'p95': round(percentile(latencies, 95), 3),
+            'p99': round(percentile(latencies, 99), 3),
+            'mean': round(sum(latencies) / len(latencies), 3),
+            'max': round(latencies[-1], 3),
+            'rps': round(count / seconds, 1),
+            'queries': None if queries is None else round((self.queries() - queries) / count, 2),
+        }
+        return result
+
+    def report(self, meta: dict = None) -> dict:
+        return {
+            'meta': {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'python': platform.python_version(), 'concurrency': self.concurrency, **(meta or {})},
+            'results': self.results,
+        }
+
+    def save(self, path: str, meta: dict = None):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.report(meta), f, ensure_ascii=False, indent=2)
+
+    def table(self, base: dict = None) -> str:
+        '''以文本表格输出结果，指定`base`(之前保存的结果)时附上p50、p95及吞吐量的变化比例'''
+        base = (base or {}).get('results', {})
+        lines = ['%-16s %8s %6s %9s %9s %9s %9s %8s' % ('scenario', 'requests', 'errors', 'p50(ms)', 'p95(ms)', 'p99(ms)', 'rps', 'queries')]
+        for name, i in self.results.items():
+            line = '%-16s %8d %6d %9.2f %9.2f %9.2f %9.1f %8s' % (
+                name, i['requests'], i['errors'], i['p50'], i['p95'], i['p99'], i['rps'], '-' if i['queries'] is None else i['queries'])
+            if name in base:
+                line += '  p50 %s  p95 %s  rps %s' % tuple(_change(base[name][k], i[k]) for k in ('p50', 'p95', 'rps'))
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def _change(old, new) -> str:
+    return '%+.1f%%' % ((new - old) / old * 100) if old else '-'
@@ -0,0 +1,61 @@
+from collections import OrderedDict
+from threading import RLock
+import time
+
+
+class LRUCache:
+    '''进程内LRU缓存，支持按条目设置过期时间
+
+    :param maxsize: 最大条目数，超出时淘汰最久未使用的条目
+    :param ttl: 默认过期秒数，None为不过期
+    '''
+    def __init__(self, maxsize: int = 1024, ttl: float = None) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__data = OrderedDict()
+        self.__lock = RLock()
+
+    def __len__(self):
+        return len(self.__data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        with self.__lock:
+            item = self.__data.get(key)
+            if item is None:
+                return default
+            value, expire = item
+            if expire is not None and expire <= time.time():
+                del self.__data[key]
+                return default
+            self.__data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ex: float = None, exat: float = None):
+        '''写入缓存，`ex`为过期秒数，`exat`为过期时间戳，都为空时使用默认`ttl`'''
+        if exat is None:
+            ex = self.ttl if ex is None else ex
+            exat = None if ex is None else time.time() + ex
+        with self.__lock:
+            self.__data[key] = (value, exat)
+            self.__data.move_to_end(key)
+            while len(self.__data) > self.maxsize:
+                self.__data.popitem(last=False)
+        return True
+
+    def expire_at(self, key):
+        '''条目的过期时间戳，不存在或永不过期时为None'''
+        with self.__lock:
+            item = self.__data.get(key)
+        return None if item is None else item[1]
+
+    def pop(self, key, default=None):
+        with self.__lock:
+            item = self.__data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self.__lock:
+            self.__data.clear()
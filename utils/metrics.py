@@ -0,0 +1,134 @@
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Mapper
+import os
+import sys
+import time
+
+current = ContextVar('request_stats', default=None)  # 当前请求的RequestStats，gevent下每个greenlet各自独立
+
+
+class RequestStats:
+    '''单个请求的耗时、SQL条数及耗时、读写行数、响应大小
+
+    `sample`为`trace`时`trace`记录每条SQL的(耗时, 语句, 参数)，为`profile`时还记录发起该SQL的代码位置。
+    '''
+    __slots__ = ('method', 'path', 'endpoint', 'status', 'start', 'wall', 'db', 'statements', 'rows', 'size', 'sample', 'trace')
+
+    def __init__(self, method: str, path: str, sample: str = None) -> None:
+        self.method = method
+        self.path = path
+        self.endpoint = None
+        self.status = 0
+        self.start = time.perf_counter()
+        self.wall = 0.0
+        self.db = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.size = 0
+        self.sample = sample
+        self.trace = [] if sample else None
+
+    def server_timing(self) -> str:
+        return 'app;dur=%.1f, db;dur=%.1f, sql;desc="%d", rows;desc="%d"' % (
+            (time.perf_counter() - self.start) * 1000, self.db * 1000, self.statements, self.rows)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current.get() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current.get()
+    if stats is None or not conn.info.get('query_start'):
+        return
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    stats.db += elapsed
+    stats.statements += 1
+    if context is not None and (context.isinsert or context.isupdate or context.isdelete) and cursor.rowcount > 0:
+        stats.rows += cursor.rowcount
+    if stats.trace is not None:
+        stats.trace.append((elapsed, statement, parameters, origin() if stats.sample == 'profile' else None))
+
+
+_LIBRARY = os.path.dirname(os.__file__)  # 标准库目录
+
+
+def origin() -> str | None:
+    '''调用栈中最内层的项目代码位置，如`models/serializer.py:84 __one`'''
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename != __file__ and not filename.startswith(_LIBRARY) and os.sep + 'site-packages' + os.sep not in filename:
+            return '%s:%d %s' % (os.path.relpath(filename), frame.f_lineno, frame.f_code.co_name)
+        frame = frame.f_back
+    return None
+
+
+@event.listens_for(Mapper, 'load')
+def _load(target, context):
+    stats = current.get()
+    if stats is not None:
+        stats.rows += 1
+
+
+class Timing:
+    '''统计每个请求的耗时及SQL执行情况的中间件
+
+    响应头`Server-Timing`带上截至开始响应时的总耗时、数据库耗时、SQL条数及读写行数，
+    响应体发送完毕后把完整的统计交给`metrics.observe(stats)`；`metrics.sample(environ)`决定是否记录每条SQL。
+    读取的行数为ORM加载的对象数，写入的行数为INSERT/UPDATE/DELETE影响的行数。
+
+    :param app: the WSGI application
+    :param metrics: 实现了`sample(environ)`及`observe(stats)`的统计对象
+    '''
+    def __init__(self, app, metrics):
+        self.app = app
+        self.metrics = metrics
+
+    def __call__(self, environ, start_response):
+        stats = RequestStats(environ.get('REQUEST_METHOD'), environ.get('PATH_INFO'), self.metrics.sample(environ))
+        environ['request_stats'] = stats
+        current.set(stats)
+
+        def timed_start_response(status, headers, exc_info=None):
+            stats.status = int(status.split(None, 1)[0])
+            headers.append(('Server-Timing', stats.server_timing()))
+            return start_response(status, headers, exc_info)
+
+        try:
+            body = self.app(environ, timed_start_response)
+        except BaseException:
+            stats.status = 500
+            self.finish(stats)
+            raise
+        return TimedBody(body, stats, self.finish)
+
+    def finish(self, stats: RequestStats):
+        stats.wall = time.perf_counter() - stats.start
+        current.set(None)
+        self.metrics.observe(stats)
+
+
+class TimedBody:
+    '''包装响应体以统计响应大小，`close`时结束计时'''
+    def __init__(self, body, stats: RequestStats, finish) -> None:
+        self.body = body
+        self.stats = stats
+        self.finish = finish
+
+    def __iter__(self):
+        for chunk in self.body:
+            self.stats.size += len(chunk)
+            yield chunk
+
+    def close(self):
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.finish(self.stats)
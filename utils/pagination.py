@@ -0,0 +1,54 @@
+from flask import current_app
+from sqlalchemy import and_, or_
+from werkzeug.exceptions import BadRequest
+import base64
+import json
+
+
+def page_size(limit: int = None) -> int:
+    '''每页条数，未指定时取`PAGE_SIZE`，不超过`MAX_PAGE_SIZE`'''
+    config = current_app.config
+    if not limit or limit < 1:
+        return config.get('PAGE_SIZE', 50)
+    return min(limit, config.get('MAX_PAGE_SIZE', 500))
+
+
+def encode_cursor(*values) -> str:
+    '''把分页位置编码为不透明的游标字符串'''
+    return base64.urlsafe_b64encode(json.dumps(values, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, length: int = None) -> tuple:
+    '''解析`encode_cursor`生成的游标，`length`为期望的字段个数'''
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except Exception:
+        raise BadRequest('无效的游标')
+    if not isinstance(values, list) or (length is not None and len(values) != length):
+        raise BadRequest('无效的游标')
+    return tuple(values)
+
+
+def keyset(columns: list | tuple, values: list | tuple, desc: bool = False):
+    '''按`columns`排序时位于游标`values`之后的行的过滤条件，首列可走索引范围扫描'''
+    after = (lambda c, v: c < v) if desc else (lambda c, v: c > v)
+    cond = after(columns[-1], values[-1])
+    for column, value in zip(reversed(columns[:-1]), reversed(values[:-1])):
+        cond = and_(column <= value if desc else column >= value, or_(after(column, value), cond))
+    return cond
+
+
+def keyset_chunks(query, columns: list | tuple, desc: bool = False, chunk_size: int = None):
+    '''按`columns`(末列唯一，`query`已按它排序)逐批执行带LIMIT的`query`，生成每批的结果列表
+
+    每批是一次独立取完的查询，不占用服务器端游标，批与批之间可以在同一连接上执行其它查询(如`selectinload`)。
+    '''
+    chunk_size = chunk_size or current_app.config.get('STREAM_CHUNK_SIZE', 500)
+    after = None
+    while True:
+        rows = (query if after is None else query.filter(keyset(columns, after, desc))).limit(chunk_size).all()
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            break
+        after = tuple(getattr(rows[-1], i.key) for i in columns)
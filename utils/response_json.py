@@ -1,4 +1,67 @@
-from flask import jsonify, make_response
+from flask import jsonify, make_response, request, current_app, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+from itertools import islice
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+NDJSON = 'application/x-ndjson'
+COMPRESS_MIMETYPES = ('application/json', NDJSON, 'text/plain', 'text/csv', 'text/html')
+
+
+class FastJSONProvider(DefaultJSONProvider):
+    """JSON编解码
+    ---
+
+    配置`JSON_BACKEND`：`auto`(默认，安装了orjson时使用)、`orjson`或`json`(标准库)。
+    输出与Flask默认的一致：键排序，`Decimal`为字符串，日期为HTTP日期格式，调试模式下缩进；
+    orjson输出的非ASCII字符不转义，orjson不支持的参数(如`cls`)交给标准库。
+    """
+
+    def __init__(self, app, backend:str=None) -> None:
+        super().__init__(app)
+        backend = backend or app.config.get('JSON_BACKEND', 'auto')
+        if backend == 'orjson' and orjson is None:
+            raise RuntimeError('JSON_BACKEND为orjson，但未安装orjson')
+        self.orjson = orjson if backend in ('auto', 'orjson') else None
+
+    def _options(self, kwargs:dict) -> int | None:
+        '''参数可由orjson处理时返回对应的option，否则返回None'''
+        if self.orjson is None or not set(kwargs) <= {'indent', 'separators', 'sort_keys', 'ensure_ascii'} \
+                or kwargs.get('indent') not in (None, 2):
+            return None
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def dumps(self, obj, **kwargs) -> str:
+        option = self._options(kwargs)
+        if option is None:
+            return super().dumps(obj, **kwargs)
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s:str|bytes, **kwargs):
+        if self.orjson is None or kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        option = self._options({'indent': 2} if indent else {})
+        if option is None:
+            return super().response(obj)
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=option | orjson.OPT_APPEND_NEWLINE), mimetype=self.mimetype)
 
 def r(code=200, msg:str=None, data=None, token:str=None):
     """返回JSON
@@ -36,4 +99,95 @@ def r(code=200, msg:str=None, data=None, token:str=None):
     if data is not None:
         res['data'] = data
 
-    return make_response(jsonify(res), code)
\ No newline at end of file
+    return make_response(jsonify(res), code)
+
+
+def is_stream() -> bool:
+    """客户端是否请求流式响应：`Accept: application/x-ndjson`或参数`stream=1`"""
+    return request.accept_mimetypes.best_match(('application/json', NDJSON)) == NDJSON or request.args.get('stream') == '1'
+
+
+def r_stream(rows, dump, chunk_size:int=None):
+    """流式返回列表
+    ---
+
+    `rows`为返回结果集(如`keyset_chunks`逐批查询)的函数，在开始发送时才执行，
+    按`chunk_size`分块经`dump`批量序列化后逐块发送，内存占用与总行数无关。
+
+    `Accept: application/x-ndjson`时每行一个JSON对象，否则仍为`{code, data}`结构的分块JSON。
+    """
+    chunk_size = chunk_size or current_app.config.get('STREAM_CHUNK_SIZE', 500)
+    dumps = current_app.json.dumps
+    ndjson = request.accept_mimetypes.best_match(('application/json', NDJSON)) == NDJSON
+
+    def generate():
+        rows_iter = iter(rows())
+        sep = ''
+        if not ndjson:
+            yield '{"code":200,"data":['
+        while True:
+            chunk = list(islice(rows_iter, chunk_size))
+            if not chunk:
+                break
+            items = [dumps(i) for i in dump(chunk)]
+            if ndjson:
+                yield '\n'.join(items) + '\n'
+            else:
+                yield sep + ','.join(items)
+                sep = ','
+        if not ndjson:
+            yield ']}'
+
+    return current_app.response_class(stream_with_context(generate()), mimetype=NDJSON if ndjson else 'application/json')
+
+def compress(res):
+    """按`Accept-Encoding`压缩响应，注册为`after_request`
+    ---
+
+    优先brotli(需安装brotli)，其次gzip。普通响应超过`COMPRESS_MIN_SIZE`字节才压缩，
+    流式响应逐块压缩后立即发送；压缩后的响应ETag改为弱ETag。
+    """
+    config = current_app.config
+    if not config.get('COMPRESS_ENABLED', True) or res.status_code < 200 or res.status_code in (204, 206, 304) \
+            or res.direct_passthrough or 'Content-Encoding' in res.headers or res.mimetype not in COMPRESS_MIMETYPES:
+        return res
+    res.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(('br', 'gzip') if brotli is not None else ('gzip',))
+    if encoding is None:
+        return res
+    if res.is_streamed:
+        res.response = _compress_stream(res.iter_encoded(), res.response, compressor(encoding))
+        res.headers.pop('Content-Length', None)
+    else:
+        data = res.get_data()
+        if len(data) < config.get('COMPRESS_MIN_SIZE', 1024):
+            return res
+        process, _, finish = compressor(encoding)
+        res.set_data(process(data) + finish())
+    res.headers['Content-Encoding'] = encoding
+    etag, weak = res.get_etag()
+    if etag and not weak:
+        res.set_etag(etag, weak=True)
+    return res
+
+
+def compressor(encoding:str) -> tuple:
+    """`(压缩, 刷新, 结束)`三个函数，刷新后已写入的数据可以完整解压"""
+    if encoding == 'br':
+        c = brotli.Compressor(quality=current_app.config.get('COMPRESS_BROTLI_QUALITY', 4))
+        return c.process, c.flush, c.finish
+    c = zlib.compressobj(current_app.config.get('COMPRESS_GZIP_LEVEL', 6), zlib.DEFLATED, 31)  # wbits=31为gzip格式
+    return c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush
+
+
+def _compress_stream(chunks, body, compressor:tuple):
+    process, flush, finish = compressor
+    try:
+        for chunk in chunks:
+            data = process(chunk) + flush()
+            if data:
+                yield data
+        yield finish()
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
@@ -0,0 +1,116 @@
+from decimal import Decimal
+from xml.sax.saxutils import escape
+import csv
+import io
+import re
+import zipfile
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+XLSX_MAX_ROWS = 1048576  # Excel单个工作表的行数上限
+_ILLEGAL_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_FORMULA_PREFIX = ('=', '+', '-', '@', '\t', '\r')  # Excel打开CSV时按公式解析的开头
+
+_XLSX_PARTS = {
+    '[Content_Types].xml': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>',
+    '_rels/.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>',
+    'xl/_rels/workbook.xml.rels': '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>',
+}
+_WORKBOOK = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>' \
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" ' \
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">' \
+    '<sheets><sheet name="%s" sheetId="1" r:id="rId1"/></sheets></workbook>'
+
+
+class _Sink(io.RawIOBase):
+    '''不可seek的输出，ZipFile写入的数据由生成器取走后发送'''
+    def __init__(self) -> None:
+        self.chunks = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def take(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def csv_stream(header: list, chunks):
+    """逐块生成CSV(UTF-8带BOM，Excel可直接打开)，`chunks`为行列表的迭代器
+    ---
+
+    以`=`、`+`、`-`、`@`等开头的文本前加`'`，防止用户填写的备注、名称被Excel当作公式执行，数值不受影响。
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    yield '\ufeff' + buffer.getvalue()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows([_csv_text(i) for i in row] for row in rows)
+        yield buffer.getvalue()
+
+
+def _csv_text(value):
+    if isinstance(value, str) and value.startswith(_FORMULA_PREFIX):
+        return "'" + value
+    return value
+
+
+def xlsx_stream(header: list, chunks, sheet: str = 'Sheet1'):
+    """逐块生成只有一个工作表的XLSX，`chunks`为行列表的迭代器
+    ---
+
+    工作表XML边生成边写入ZIP(不可seek时ZipFile以数据描述符记录大小)，每块写完即发送已压缩的数据，
+    内存占用与总行数无关。字符串为内联字符串(不会被当作公式，无需像CSV一样加`'`)，数字为数值，超出`XLSX_MAX_ROWS`的行不再写入。
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, xml in _XLSX_PARTS.items():
+            zf.writestr(name, xml)
+        zf.writestr('xl/workbook.xml', _WORKBOOK % escape(sheet, {'"': '&quot;'}))
+        with zf.open('xl/worksheets/sheet1.xml', 'w') as f:
+            f.write(b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+            f.write(_xlsx_row(header).encode())
+            count = 1
+            for rows in chunks:
+                rows = rows[:XLSX_MAX_ROWS - count]
+                f.write(''.join(_xlsx_row(i) for i in rows).encode())
+                count += len(rows)
+                data = sink.take()
+                if data:
+                    yield data
+                if count >= XLSX_MAX_ROWS:
+                    break
+            f.write(b'</sheetData></worksheet>')
+    yield sink.take()
+
+
+def _xlsx_row(values) -> str:
+    cells = []
+    for value in values:
+        if value is None:
+            cells.append('<c/>')
+        elif isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+            cells.append('<c><v>%s</v></c>' % value)
+        else:
+            cells.append('<c t="inlineStr"><is><t xml:space="preserve">%s</t></is></c>' % escape(_ILLEGAL_XML.sub('', str(value))))
+    return '<row>%s</row>' % ''.join(cells)
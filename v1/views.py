@@ -1,11 +1,19 @@
-from flask import Blueprint, request
-from models import db, Authorize as auth, User, Application, Book, Account, Category, Tag, Tally, UserBook
-from utils import r
+from flask import Blueprint, request, current_app, stream_with_context
+from sqlalchemy import inspect
+from redis import RedisError
+from sqlalchemy.orm import selectinload, load_only
+from models import db, estimate_count, to_snake, MAX_DEPTH, Authorize as auth, User, Application, Book, Account, Category, Tag, Tally, UserBook, TallyRollup, TallyTerm, Analytics, TallyExport, PERIODS, period_bucket, Budget, TallyImporter, Version, Batch, BatchError, Sync, RateLimit, Job, BOOK_DELETED
+from itertools import chain
+import csv
+import io
+import time
+from utils import r, r_stream, is_stream, page_size, encode_cursor, decode_cursor, keyset, keyset_chunks, csv_stream, xlsx_stream, XLSX_MIMETYPE
 
 v1 = Blueprint('v1', __name__)
 
 # ---------- authorize API ----------
 @v1.route('/authorize/login', methods=['POST'])
+@RateLimit.limited
 def user_login():
     '''用户登录'''
     req = dict(request.json)
@@ -17,10 +25,12 @@ def user_login():
 @v1.route('/my', methods=['GET'])
 @auth.login_required
 def my_for_id(user_id:int):
-    user: User = User.query.filter_by(id=user_id, state=0).first()
-    if not user:
-        return r(403, '用户被限制')
-    return r(data=user._get())
+    def build():
+        user: User = User.query.filter_by(id=user_id, state=0).first()
+        if not user:
+            return r(403, '用户被限制')
+        return r(data=user._get())
+    return Version.cached('user:%d' % user_id, build)
 
 
 # ---------- userinfo API ----------
@@ -44,9 +54,11 @@ def app_for_id(user_id:int, id:int):
         return r(404, 'APP不存在')
     if request.method == 'DELETE':
         app._del()
+        auth.expire_app()
         return r(204)
     elif request.method == 'PUT':
         app._set(dict(request.json))
+        auth.expire_app()
     return r(data=app._get())
 
 @v1.route('/application', methods=['POST'])
@@ -61,16 +73,29 @@ def app(user_id:int):
 @v1.route('/book/<int:id>', methods=['GET', 'PUT', 'DELETE'])
 @auth.login_required
 def book_for_id(user_id:int, id:int):
+    if request.method == 'GET':
+        return Version.cached('book:%d' % id, lambda: _book_get(id))
     book: Book = Book.query.get(id)
-    if not book:
+    if not book or book.state == BOOK_DELETED:
         return r(404, '账本不存在')
     if request.method == 'DELETE':
-        book._del()
-        return r(204)
+        book._set({'state': BOOK_DELETED})  # 先标记删除，记账记录等由后台任务分批清理
+        try:
+            job = Job.enqueue('purge_book', user_id, book_id=book.id)
+        except RedisError:  # 删除已提交，清理任务留给 flask purge-books 补交
+            current_app.logger.warning('purge_book %d not queued', book.id, exc_info=True)
+            job = None
+        return r(202, data=job)
     elif request.method == 'PUT':
         book._set(dict(request.json))
     return r(data=book._get())
 
+def _book_get(id:int):
+    book: Book = Book.query.get(id)
+    if not book or book.state == BOOK_DELETED:
+        return r(404, '账本不存在')
+    return r(data=book._get())
+
 @v1.route('/book', methods=['POST'])
 @auth.login_required
 def book(user_id:int):
@@ -83,6 +108,52 @@ def book(user_id:int):
 
     return r(201)
 
+@v1.route('/book/<int:id>/budget', methods=['GET'])
+@auth.login_required
+def book_budget(user_id:int, id:int):
+    '''当前周期的预算消费情况'''
+    book: Book = Book.query.get(id)
+    if not book or book.state == BOOK_DELETED:
+        return r(404, '账本不存在')
+    return r(data=Budget.status(book))
+
+@v1.route('/book/<int:id>/analytics', methods=['GET'])
+@auth.login_required
+def book_analytics(user_id:int, id:int):
+    '''最近`periods`个周期(day|week|month|year)的收支趋势、支出的`window`期移动平均、环比、分类占比及当前预算周期的支出预测'''
+    if not Analytics.available():
+        return r(501, '服务器未安装numpy')
+    args = request.args
+    period, periods, window = args.get('period', 'month'), args.get('periods', 12, type=int), args.get('window', 3, type=int)
+    if period not in PERIODS or not 0 < periods <= current_app.config.get('ANALYTICS_MAX_PERIODS', 60) or not 0 < window <= periods:
+        return r(400, '参数错误')
+    def build():
+        book: Book = Book.query.get(id)
+        if not book or book.state == BOOK_DELETED:
+            return r(404, '账本不存在')
+        return r(data=Analytics.trend(book, period, periods, window))
+    key = 'analytics:%d:%s:%d:%d:%d' % (id, period, periods, window, period_bucket('day', int(time.time())))  # 预测随日期变化
+    return Version.cached(key, build, ('book:%d' % id, 'tallies:%d' % id))
+
+@v1.route('/book/<int:id>/export', methods=['GET'])
+@auth.login_required
+def book_export(user_id:int, id:int):
+    '''导出账本[start, end]内的账单(format=csv|xlsx)，按记录时间顺序边读边发送'''
+    args = request.args
+    format = args.get('format', 'csv')
+    if format not in ('csv', 'xlsx'):
+        return r(400, '参数错误')
+    book: Book = Book.query.get(id)
+    if not book or book.state == BOOK_DELETED:
+        return r(404, '账本不存在')
+    export = TallyExport(book.id, args.get('start', type=int), args.get('end', type=int))
+    if format == 'csv':
+        res = current_app.response_class(stream_with_context(csv_stream(TallyExport.HEADER, export.chunks())), mimetype='text/csv')
+    else:
+        res = current_app.response_class(stream_with_context(xlsx_stream(TallyExport.HEADER, export.chunks(), '账单')), mimetype=XLSX_MIMETYPE)
+    res.headers['Content-Disposition'] = 'attachment; filename=book-%d.%s' % (book.id, format)
+    return res
+
 
 # ---------- account API ----------
 @v1.route('/account/<int:id>', methods=['GET', 'PUT', 'DELETE'])
@@ -96,7 +167,7 @@ def account_for_id(user_id:int, id:int):
         return r(204)
     elif request.method == 'PUT':
         account._set(dict(request.json))
-    return r(data=account._get())
+    return r(data=account._get(Account.__cloumns__ + ('balance',)))
 
 @v1.route('/account', methods=['POST'])
 @auth.login_required
@@ -155,7 +226,8 @@ def tag(user_id:int):
 @auth.login_required
 def tally_for_id(user_id:int, id:int):
     tally: Tally = Tally.query.get(id)
-    if not tally:
+    book: Book = Book.query.get(tally.book_id) if tally else None
+    if not book or book.state == BOOK_DELETED:
         return r(404, '记录不存在')
     if request.method == 'DELETE':
         tally._del()
@@ -174,27 +246,215 @@ def tally(user_id:int):
 @v1.route('/tallies', methods=['GET'])
 @auth.login_required
 def tallies(user_id:int):
-    args = dict(request.args)
-    tallies: list[Tally] = db.session.query(Tally).filter(Tally.book_id==args.get('book-id'), Tally.record_timestamp.between(args.get('start'), args.get('end'))).all()
-    return r(data=[i._get() for i in tallies])
+    '''按记录时间倒序分页，下一页游标在响应头`X-Next-Cursor`中；流式请求不分页
+
+    输出与`Tally.__cloumns__`一致，`expand=category,account`时附带分类、资金账户对象。
+    '''
+    args = request.args
+    fields = tally_fields(args.get('expand'))
+    try:
+        book_id = int(args['book-id'])
+        start, end = (int(args[k]) if args.get(k) is not None else None for k in ('start', 'end'))
+    except (KeyError, ValueError):
+        return r(400, '参数错误')
+    if fields is None:
+        return r(400, '参数错误')
+    book: Book = Book.query.get(book_id)
+    if not book or book.state == BOOK_DELETED:
+        return r(404, '账本不存在')
+    keys, relations, options = fields
+    query = db.session.query(Tally).filter(Tally.book_id==book_id)
+    if start is not None:
+        query = query.filter(Tally.record_timestamp >= start)
+    if end is not None:
+        query = query.filter(Tally.record_timestamp <= end)
+    if args.get('cursor'):
+        query = query.filter(keyset((Tally.record_timestamp, Tally.id), decode_cursor(args['cursor'], 2), desc=True))
+    query = query.options(*options).order_by(Tally.record_timestamp.desc(), Tally.id.desc())
+    if is_stream():
+        rows = lambda: chain.from_iterable(keyset_chunks(query, (Tally.record_timestamp, Tally.id), desc=True))
+        return r_stream(rows, lambda chunk: Tally._get_all(chunk, keys, relations))
+    limit = page_size(args.get('limit', type=int))
+    tallies: list[Tally] = query.limit(limit + 1).all()
+    res = r(data=Tally._get_all(tallies[:limit], keys, relations))
+    if len(tallies) > limit:
+        res.headers['X-Next-Cursor'] = encode_cursor(tallies[limit - 1].record_timestamp, tallies[limit - 1].id)
+    return res
 
+TALLY_EXPAND = ('category', 'account')  # `expand`参数可附带的关联对象
+TALLY_TAGS = tuple('tags' + '.children' * i for i in range(MAX_DEPTH))  # 标签及其下级，与原来的`_get`一致
+
+def tally_fields(expand:str = None) -> tuple | None:
+    '''`expand`参数对应的(输出字段, 展开的关联, 预加载选项)，参数无效时返回None'''
+    expand = tuple(dict.fromkeys(i for i in (expand or '').split(',') if i))
+    if not set(expand) <= set(TALLY_EXPAND):
+        return None
+    options = [selectinload(Tally.tags).selectinload(Tag.children, recursion_depth=MAX_DEPTH - 1)]
+    options += [selectinload(getattr(Tally, i)) for i in expand]
+    return Tally.__cloumns__ + expand, TALLY_TAGS + expand, options
+
+@v1.route('/tallies/search', methods=['GET'])
+@auth.login_required
+def tallies_search(user_id:int):
+    '''在账本中搜索备注、分类名、标签名含有关键词`q`的记账记录，按相关度(`score`)及记录时间倒序分页，下一页游标在响应头`X-Next-Cursor`中'''
+    args = request.args
+    book: Book = Book.query.get(args.get('book-id', type=int))
+    if not book or book.state == BOOK_DELETED:
+        return r(404, '账本不存在')
+    fields = tally_fields(args.get('expand'))
+    if not args.get('q', '').strip() or fields is None:
+        return r(400, '参数错误')
+    keys, relations, options = fields
+    cursor = decode_cursor(args['cursor'], 3) if args.get('cursor') else None
+    hits, next = TallyTerm.search(book.id, args['q'], args.get('start', type=int), args.get('end', type=int), page_size(args.get('limit', type=int)), cursor)
+    tallies = {i.id: i for i in db.session.query(Tally).filter(Tally.id.in_([i for i, _ in hits])).options(*options)}
+    hits = [(tallies[i], score) for i, score in hits if i in tallies]
+    data = Tally._get_all([i for i, _ in hits], keys, relations)
+    for item, (_, score) in zip(data, hits):
+        item['score'] = score
+    res = r(data=data)
+    if next:
+        res.headers['X-Next-Cursor'] = encode_cursor(*next)
+    return res
+
+@v1.route('/tallies', methods=['POST'])
+@auth.login_required
+def tallies_import(user_id:int):
+    '''批量导入记账记录：JSON数组，或上传CSV文件`file`(首行为字段名，编码由参数`encoding`指定)；
+    参数`async=1`时交给后台任务，返回202及任务，进度由`/v1/jobs/<id>`查询'''
+    book: Book = Book.query.get(request.args.get('book-id', type=int))
+    if not book or book.state == BOOK_DELETED:
+        return r(404, '账本不存在')
+    if 'file' in request.files:
+        rows = csv.DictReader(io.TextIOWrapper(request.files['file'].stream, encoding=request.args.get('encoding', 'utf-8-sig')))
+    else:
+        rows = request.get_json(silent=True)
+        if not isinstance(rows, list):
+            return r(400, '参数错误')
+    if request.args.get('async') == '1':
+        try:
+            rows = list(rows)
+        except (UnicodeDecodeError, LookupError, csv.Error):
+            return r(400, '文件格式或编码错误')
+        return r(202, data=Job.enqueue('import_tallies', user_id, book_id=book.id, rows=rows))
+    try:
+        result = TallyImporter(book.id, current_app.config.get('IMPORT_BATCH_SIZE', 1000)).run(rows)
+    except (UnicodeDecodeError, LookupError, csv.Error):
+        db.session.rollback()
+        return r(400, '文件格式或编码错误')
+    if not result['inserted'] and result['rejected']:
+        return r(400, '没有可导入的记录', data=result)
+    return r(201, data=result)
+
+
+# ---------- batch API ----------
+@v1.route('/batch', methods=['POST'])
+@auth.login_required
+def batch(user_id:int):
+    '''在一个事务中执行多个增删改操作，任一操作失败则全部回滚，返回每个操作的结果'''
+    try:
+        results = Batch(user_id).run(request.get_json(silent=True))
+    except BatchError as e:
+        return r(400, str(e), data=None if e.index is None else {'index': e.index})
+    return r(data=results)
+
+
+# ---------- sync API ----------
+@v1.route('/sync', methods=['GET'])
+@auth.login_required
+def sync(user_id:int):
+    '''增量同步：`since`为上次返回的游标，按页返回之后的变更，`more`为真时继续请求；
+    首次同步先不带`since`取得当前游标，再全量下载'''
+    if not request.args.get('since'):
+        return r(data={'cursor': encode_cursor(Sync.head()), 'more': False, 'upserted': {}, 'deleted': {}})
+    since, = decode_cursor(request.args['since'], 1)
+    if not isinstance(since, int):
+        return r(400, '无效的游标')
+    if Sync.expired(since):
+        return r(410, '变更记录已清理，请全量同步')
+    page = Sync(user_id).page(since, page_size(request.args.get('limit', type=int)))
+    page['cursor'] = encode_cursor(page['cursor'])
+    return r(data=page)
+
+
+# ---------- job API ----------
+@v1.route('/jobs/<id>', methods=['GET'])
+@auth.login_required
+def job(user_id:int, id:str):
+    '''后台任务的状态、进度及结果'''
+    job = Job.get(id)
+    if not job or job.get('userId') != user_id:
+        return r(404, '任务不存在')
+    return r(data=job)
+
+
+# ---------- summary API ----------
+@v1.route('/summary', methods=['GET'])
+@auth.login_required
+def summary(user_id:int):
+    '''按周期(day|week|month|year)及分类或收支类型汇总'''
+    args = request.args
+    period, by = args.get('period', 'month'), args.get('by', 'category')
+    if period not in PERIODS or by not in ('category', 'type'):
+        return r(400, '参数错误')
+    book: Book = Book.query.get(args.get('book-id', type=int))
+    if not book or book.state == BOOK_DELETED:
+        return r(404, '账本不存在')
+    return r(data=TallyRollup.summary(book.id, period, args.get('start', type=int), args.get('end', type=int), by))
 
 
 # ---------- list for filter API ----------
-objs = {
-    'users': (User, ()),
-    'applications': (Application, ()),
-    'books': (Book, ('id', 'name', 'remark', 'created')),
-    'accounts': (Account, ()),
-    'categories': (Category, ()),
-    'tags': (Tag, ()),
+objs = { # 模型, 默认字段, 可筛选字段(须有索引)
+    'users': (User, (), ('id', 'mobile', 'mail', 'wx_openid')),
+    'applications': (Application, (), ('id', 'app_id')),
+    'books': (Book, ('id', 'name', 'remark', 'created'), ('id',)),
+    'accounts': (Account, Account.__cloumns__ + ('balance',), ('id', 'user_id')),
+    'categories': (Category, (), ('id', 'pid')),
+    'tags': (Tag, (), ('id', 'pid')),
 }
 @v1.route('/<obj_str>', methods=['GET'])
 @auth.login_required
 def filter_obj(user_id:int, obj_str:str):
+    '''按有索引的字段筛选，`fields`指定返回字段，`order`指定排序(`-`为倒序)，按`limit`/`cursor`分页'''
     obj = objs.get(obj_str)
     if not obj:
         return r(404, '%s 未找到' % obj_str)
+    model, keys, filters = obj
     args = dict(request.args)
-    lists: list[any] = obj[0].query.filter_by(**args)
-    return r(data=[i._get(obj[1]) for i in lists])
+    for k in ('stream', 'limit', 'cursor', 'fields', 'order'):
+        args.pop(k, None)
+    args = {to_snake(k): v for k, v in args.items()}
+    if not set(args) <= set(filters):
+        return r(400, '不支持的筛选字段: %s' % ','.join(set(args) - set(filters)))
+    keys = keys or model.__cloumns__
+    if request.args.get('fields'):
+        fields = tuple(to_snake(i) for i in request.args['fields'].split(',') if i)
+        if not set(fields) <= set(keys):
+            return r(400, '不支持的字段: %s' % ','.join(set(fields) - set(keys)))
+        keys = fields
+    order = request.args.get('order', 'id')
+    desc = order.startswith('-')
+    order = to_snake(order.lstrip('-'))
+    if order not in filters or model.__table__.c[order].nullable:
+        return r(400, '不支持的排序字段: %s' % order)
+    order_by = (getattr(model, order), model.id) if order != 'id' else (model.id,)
+    columns = {k for k in keys if k in model.__table__.c} | {'id', order}
+    query = model.query.filter_by(**args)
+    if model is Book:
+        query = query.filter(Book.state != BOOK_DELETED)
+    relations = [selectinload(getattr(model, k)) for k in keys if k in inspect(model).relationships and not hasattr(model, '_load_' + k)]
+    lists = query.options(load_only(*[getattr(model, k) for k in columns]), *relations)
+    if request.args.get('cursor'):
+        lists = lists.filter(keyset(order_by, decode_cursor(request.args['cursor'], len(order_by)), desc))
+    lists = lists.order_by(*[i.desc() if desc else i for i in order_by])
+    if is_stream():
+        return r_stream(lambda: chain.from_iterable(keyset_chunks(lists, order_by, desc)), lambda chunk: model._get_all(chunk, keys))
+    limit = page_size(request.args.get('limit', type=int))
+    rows = lists.limit(limit + 1).all()
+    res = r(data=model._get_all(rows[:limit], keys))
+    if len(rows) > limit:
+        res.headers['X-Next-Cursor'] = encode_cursor(*[getattr(rows[limit - 1], i.key) for i in order_by])
+    if not request.args.get('cursor'):
+        total, exact = estimate_count(query, current_app.config.get('COUNT_CAP', 1000))
+        res.headers['X-Total-Count' if exact else 'X-Total-Estimate'] = str(total)
+    return res